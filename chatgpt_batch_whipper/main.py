@@ -1,7 +1,19 @@
 import argparse
 import sys
 import os
+import shlex
+import time
+import pandas as pd
+from chatgpt_batch_whipper.pub.batch_engine import BatchEngine
 from chatgpt_batch_whipper.pub.chatgpt_wrapper import ChatGPT
+from chatgpt_batch_whipper.pub.distributed import Coordinator, LeaseWorker
+from chatgpt_batch_whipper.pub.mock_backend import MockBackend
+from chatgpt_batch_whipper.pub.parsers import ParseStage, build_parser
+from chatgpt_batch_whipper.pub.replay import Recorder, replay_job
+from chatgpt_batch_whipper.pub.exporter import ResultExporter
+from chatgpt_batch_whipper.pub.result_store import ResultStore
+from chatgpt_batch_whipper.pub.soak import SoakTest
+from chatgpt_batch_whipper.pub.telemetry import format_status, read_status, status_path
 from chatgpt_batch_whipper.version import __version__
 import cmd
 
@@ -18,17 +30,255 @@ def main():
     parser.add_argument(
         "params",
         nargs="*",
-        help="Use 'auth' for auth mode, or run 'ui' to start the streamlit UI.",
+        help="Use 'auth' for auth mode, run 'ui' to start the streamlit UI, "
+             "'export <No>' to export the result of a prompt, 'parse <No>' to parse its replies, "
+             "'status <No>' to show the progress of its batch job, 'soak' to run the soak test, "
+             "'coordinate <No>' to serve a batch job to workers on other machines, 'work <url>' to work for a "
+             "coordinator, 'mock' to run a local mock of ChatGPT, or 'replay <archive>' to replay a recorded job.",
+    )
+    parser.add_argument(
+        "--profile",
+        "-p",
+        default=ChatGPT.default_profile,
+        help="The auth profile to log in with in auth mode, one per ChatGPT account.",
+    )
+    parser.add_argument(
+        "--format",
+        "-f",
+        default="csv",
+        choices=list(ResultExporter.FORMATS.keys()),
+        help="The format of the file in export mode.",
+    )
+    parser.add_argument(
+        "--columns",
+        "-c",
+        default=None,
+        help="The comma separated columns to export, all of them by default.",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        default=None,
+        help="The file to export to, buff/exports/<No>.<format> by default.",
+    )
+    parser.add_argument(
+        "--result-dir",
+        default="./buff/",
+        help="The folder of the results to export.",
+    )
+    parser.add_argument(
+        "--parser",
+        default=None,
+        help="The parser of the replies in parse and replay mode: csv, csv:header, table, json or regex:<pattern>, "
+             "json by default in parse mode.",
+    )
+    parser.add_argument(
+        "--record",
+        default=None,
+        help="The archive (.jsonl.gz) to record the questions and the timing of their answers to, in ui and work "
+             "mode.",
+    )
+    parser.add_argument(
+        "--replay",
+        default=None,
+        help="The recorded archive to answer from instead of ChatGPT, in ui mode.",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=None,
+        help="How many times faster than recorded the replayed answers come, 0 for no waiting. "
+             "1 by default in ui mode and 0 in replay mode.",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=100000,
+        help="The number of questions the soak test asks.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        help="The number of parallel sessions of the soak test.",
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.01,
+        help="The share of the requests the mock backend of the soak test fails.",
+    )
+    parser.add_argument(
+        "--reset-every",
+        type=int,
+        default=1000,
+        help="Reset a session of the soak test every this many questions, 0 to only reset on failures.",
+    )
+    parser.add_argument(
+        "--input",
+        "-i",
+        default=None,
+        help="The input CSV file of the batch job in coordinate mode.",
+    )
+    parser.add_argument(
+        "--column",
+        default=None,
+        help="The input column appended to a prompt which references no column, in coordinate mode.",
+    )
+    parser.add_argument(
+        "--prompts",
+        default="./prompt_master.csv",
+        help="The prompts file in coordinate mode.",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="The address the coordinator listens on, 0.0.0.0 to serve the workers of other machines.",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="The port the coordinator or the mock listens on.",
+    )
+    parser.add_argument(
+        "--lease-rows",
+        type=int,
+        default=Coordinator.LEASE_ROWS,
+        help="The most rows a worker leases at a time, in coordinate mode.",
+    )
+    parser.add_argument(
+        "--lease-timeout",
+        type=int,
+        default=Coordinator.LEASE_TIMEOUT,
+        help="The seconds after which the rows of a silent worker go to another one, in coordinate mode.",
+    )
+    parser.add_argument(
+        "--base-url",
+        default=None,
+        help="The ChatGPT url the workers use, e.g. the url of the mock, in work mode.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Show the progress again every few seconds until the job is finished, in status mode.",
+    )
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="The JSON lines file the soak test writes its samples to.",
     )
 
     args = parser.parse_args()
     auth_mode = (len(args.params) == 1 and args.params[0] == "auth") or len(args.params) == 0
     run_mode = len(args.params) == 1 and args.params[0].upper() == "UI"
+    export_mode = len(args.params) == 2 and args.params[0] == "export"
+    soak_mode = len(args.params) == 1 and args.params[0] == "soak"
+    coordinate_mode = len(args.params) == 2 and args.params[0] == "coordinate"
+    work_mode = len(args.params) == 2 and args.params[0] == "work"
+    mock_mode = len(args.params) == 1 and args.params[0] == "mock"
+    parse_mode = len(args.params) == 2 and args.params[0] == "parse"
+    replay_mode = len(args.params) == 2 and args.params[0] == "replay"
+    status_mode = len(args.params) == 2 and args.params[0] == "status"
+
+    if coordinate_mode:
+        prompt_no = args.params[1]
+        prompts_df = pd.read_csv(args.prompts)
+        setting = prompts_df[prompts_df["No"] == prompt_no]
+        if len(setting) != 1 or args.input is None:
+            print("Give the input CSV with --input, and the No of a saved prompt.")
+            return
+        data = pd.read_csv(args.input)
+        store = ResultStore(args.result_dir, prompt_no,
+                            ["result", "input", "Is false", "Comment", "row_id", "prompt_key"])
+        coordinator = Coordinator(store, setting["prompt"].values[0], data, args.column,
+                                  lease_rows=args.lease_rows, lease_timeout=args.lease_timeout,
+                                  host=args.host, port=args.port,
+                                  status_file=status_path(args.result_dir, prompt_no))
+        print("Serving the prompt %s at %s" % (prompt_no, coordinator.url))
+        coordinator.serve()
+        return
+    if work_mode:
+        recorder = Recorder.get(args.record) if args.record is not None else None
+        engine = BatchEngine(session_factory=lambda profile: ChatGPT(shared=False, profile=profile,
+                                                                     base_url=args.base_url, recorder=recorder))
+        engine.ensure_workers(args.workers, ChatGPT.list_profiles() or [ChatGPT.default_profile])
+        LeaseWorker(args.params[1], engine=engine).run()
+        return
+    if mock_mode:
+        backend = MockBackend(port=args.port, failure_rate=args.failure_rate).start()
+        print("The mock of ChatGPT runs at %s, press Ctrl+C to stop it" % backend.url)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            backend.stop()
+        return
+
+    if soak_mode:
+        failures = SoakTest(requests=args.requests, workers=args.workers, failure_rate=args.failure_rate,
+                            reset_every=args.reset_every, report_path=args.report).run()
+        sys.exit(1 if len(failures) > 0 else 0)
 
+    if parse_mode:
+        result_no = args.params[1]
+        store = ResultStore(args.result_dir, result_no, [])
+        if not os.path.isfile(store.csv_path) and not os.path.isfile(store.journal_path):
+            print("There is no result for the prompt %s in %s." % (result_no, args.result_dir))
+            return
+        parse_stage = ParseStage(build_parser(args.parser or "json"), store)
+        parse_stage.parse_store()
+        parse_stage.close()
+        print("Parsed %d replies of the prompt %s, %d could not be parsed."
+              % (parse_stage.parsed, result_no, parse_stage.failed))
+        return
+    if status_mode:
+        path = status_path(args.result_dir, args.params[1])
+        while True:
+            status = read_status(path)
+            if status is None:
+                print("There is no batch job status for the prompt %s in %s." % (args.params[1], args.result_dir))
+                return
+            print(format_status(status) + (" | finished" if status["finished"] else ""))
+            if not args.watch or status["finished"]:
+                return
+            time.sleep(2)
+    if replay_mode:
+        stats = replay_job(args.params[1], workers=args.workers, speed=args.speed or 0.0,
+                           parser=build_parser(args.parser))
+        print("Replayed %(questions)d questions in %(seconds).1fs (%(questions_per_second).1f questions/s, "
+              "%(failed)d failed), recorded over %(recorded_seconds).1fs. The result is in %(result)s." % stats)
+        return
+    if export_mode:
+        try:
+            ResultExporter.check_format(args.format)
+        except ValueError as error:
+            print(error)
+            return
+        result_no = args.params[1]
+        output = args.output or os.path.join(args.result_dir, "exports", "%s.%s" % (result_no, args.format))
+        store = ResultStore(args.result_dir, result_no, [])
+        if not os.path.isfile(store.csv_path) and not os.path.isfile(store.journal_path):
+            print("There is no result for the prompt %s in %s." % (result_no, args.result_dir))
+            return
+        ResultExporter(store).export(output, args.format, ResultExporter.parse_columns(args.columns))
+        print("Exported the result of the prompt %s to %s." % (result_no, output))
+        return
     if auth_mode:
-        ChatGPT(headless=False, timeout=90)
+        ChatGPT(headless=False, timeout=90, profile=args.profile)
     if run_mode:
-        os.system("streamlit run start_whipper.py")
+        options = []
+        if args.record is not None:
+            options += ["--record", os.path.abspath(args.record)]
+        if args.replay is not None:
+            options += ["--replay", os.path.abspath(args.replay)]
+        if args.speed is not None:
+            options += ["--speed", str(args.speed)]
+        # The options after "--" go to start_whipper.py
+        command = "streamlit run start_whipper.py"
+        if len(options) > 0:
+            command += " -- " + " ".join(shlex.quote(option) for option in options)
+        os.system(command)
     else:
         print("please input the right command. Use 'auth' for auth mode, or run 'UI' to start the streamlit UI.")
 
@@ -0,0 +1,94 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+Account: the rate tracking of the ChatGPT accounts.
+Author: CodeDigger
+Description: This module defines the Account class, which counts the questions sent with one auth profile over
+the last hour, and knows when the account hit the hourly cap of ChatGPT. The workers of the batch engine only
+take work while their account has headroom, so the work goes to whichever account can run it.
+"""
+import threading
+import time
+from collections import deque
+
+
+class Account:
+    """
+    The rate of the questions sent with one auth profile.
+    """
+    WINDOW = 60 * 60
+    # How long an account rests after ChatGPT answered "Too many requests in 1 hour"
+    CAP_PAUSE = 60 * 60
+    CAP_STATUS = 429
+
+    def __init__(self, profile, hourly_cap=None):
+        """
+        :param profile: the name of the auth profile
+        :param hourly_cap: the most questions to send in an hour, or None to only rely on ChatGPT's answer
+        """
+        self.profile = profile
+        self.hourly_cap = hourly_cap
+        self.blocked_until = 0.0
+        self._sent = deque()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while len(self._sent) > 0 and self._sent[0] <= now - self.WINDOW:
+            self._sent.popleft()
+
+    def sent_last_hour(self):
+        with self._lock:
+            self._expire(time.time())
+            return len(self._sent)
+
+    def wait_time(self):
+        """
+        Returns how long to wait before the account can send a question.
+
+        :return: the seconds to wait, 0 when the account has headroom
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            wait = max(0.0, self.blocked_until - now)
+            if self.hourly_cap is not None and len(self._sent) >= self.hourly_cap:
+                wait = max(wait, self._sent[0] + self.WINDOW - now)
+            return wait
+
+    def record(self):
+        """
+        Counts a question sent.
+        """
+        with self._lock:
+            self._sent.append(time.time())
+
+    def block(self, seconds=CAP_PAUSE):
+        """
+        Stops the account from sending questions for a while, after it hit the cap.
+
+        :param seconds: the seconds to rest
+        """
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
@@ -0,0 +1,431 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+BatchEngine: the parallel submission engine of the batch jobs.
+Author: CodeDigger
+Description: This module defines the BatchEngine class, a pool of worker threads which each own a ChatGPT
+session. Playwright objects can only be used from the thread which created them, so every worker creates its
+own session and the callers only exchange BatchTask objects with the workers through the JobQueue, which
+decides the order the questions of the different jobs are asked in.
+Every worker belongs to the Account of an auth profile, and only takes work while its account has headroom,
+so the work flows to the accounts which can run it. With adaptive concurrency, the workers of an account also
+wait for a slot of its AdaptiveLimiter, which follows the latency and the failures of the account.
+A question identical to one in flight is not asked again, it shares the answer of the first (see SingleFlight).
+"""
+import queue
+import threading
+import time
+
+from .accounts import Account
+from .chatgpt_wrapper import ChatGPT
+from .coalescing import SingleFlight
+from .concurrency import AdaptiveLimiter
+from .job_queue import Job, JobQueue
+
+
+class BatchTask:
+    """
+    One question to ask, and its answer once a worker is done with it.
+    """
+
+    def __init__(self, key, prompt, conversation_id="", parent_message_id="", profile=None):
+        """
+        :param key: an id chosen by the caller, e.g. the row index or the input key
+        :param prompt: the prompt text to send
+        :param conversation_id: the conversation to continue when the first try failed
+        :param parent_message_id: the parent message to continue when the first try failed
+        :param profile: the auth profile the conversation belongs to, None when unknown
+        """
+        self.key = key
+        self.prompt = prompt
+        self.conversation_id = conversation_id
+        self.parent_message_id = parent_message_id
+        self.profile = profile
+        self.answer = None
+        self.error = None
+        self.retries = 0
+        # The queue the chunks of the answer are put on when the task is streamed, ended by None
+        self.chunks = None
+        # The number of identical questions which shared the answer, and whether this one joined the flight
+        # of another instead of being asked, see SingleFlight
+        self.coalesced = 0
+        self.joined = False
+        self.flight_key = None
+        # Whether the answer was cut before the end of its stream, and the timeout which cut it, if any,
+        # see ChatGPT.last_truncated
+        self.truncated = False
+        self.timeout = None
+
+
+class BatchEngine:
+    """
+    A pool of worker threads, each with its own ChatGPT session.
+    The engine lives as long as the process, so the browsers are reused across batch jobs.
+    """
+    WAITING_TIME = 10
+    # The times a question whose answer was cut by a timeout is asked again before the partial answer is kept
+    TRUNCATED_RETRIES = 1
+    # The times a question without an answer is asked again before the task fails
+    FAILED_RETRIES = 5
+    # The longest a worker sleeps before looking at its account and the queue again
+    IDLE_TIME = 5
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, session_factory=None, waiting_time=WAITING_TIME, truncated_retries=TRUNCATED_RETRIES,
+                 failed_retries=FAILED_RETRIES):
+        """
+        :param session_factory: a callable returning a new session for an auth profile, called in the worker thread
+        :param waiting_time: the seconds to wait before resubmitting a failed question
+        :param truncated_retries: the times a question whose answer was cut by a timeout is asked again
+        :param failed_retries: the times a question without an answer is asked again
+        """
+        self.session_factory = session_factory or (lambda profile: ChatGPT(shared=False, profile=profile))
+        self.waiting_time = waiting_time
+        self.truncated_retries = truncated_retries
+        self.failed_retries = failed_retries
+        self.accounts = {}
+        # The AdaptiveLimiter of every account, when the concurrency is adaptive
+        self.limiters = {}
+        self.flights = SingleFlight()
+        self._tasks = JobQueue()
+        self._workers = []
+        self._closed = threading.Event()
+        # The worker seconds spent waiting for the rate limits and the limiters, and asking questions
+        self._timings = {"waiting": 0.0, "working": 0.0}
+        self._timings_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, workers=1, profiles=(ChatGPT.default_profile,), hourly_cap=None, adaptive=False,
+            session_factory=None):
+        """
+        Returns the engine of the process, with at least the given number of workers per account.
+        The engine is shared by every session of the app, so hourly_cap and adaptive only apply to the accounts
+        new to it, see ensure_workers.
+
+        :param workers: the number of parallel sessions wanted per account
+        :param profiles: the auth profiles of the accounts to use
+        :param hourly_cap: the most questions a new account sends in an hour, or None for no limit
+        :param adaptive: whether the number of questions in flight per new account adapts to the latency and the
+            failures, up to the number of workers
+        :param session_factory: the session factory of the engine when it is created, e.g. to record or replay
+        :return: the BatchEngine
+        """
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls(session_factory)
+            cls._instance.ensure_workers(workers, profiles, hourly_cap, adaptive)
+            return cls._instance
+
+    def ensure_workers(self, workers, profiles=(ChatGPT.default_profile,), hourly_cap=None, adaptive=False):
+        """
+        Starts workers until every account has at least the given number of them.
+        The hourly cap and the adaptive limit of an account are set when it joins the engine, and kept after:
+        the jobs of the other users may be running on it.
+
+        :param workers: the number of workers wanted per account
+        :param profiles: the auth profiles of the accounts
+        :param hourly_cap: the most questions a new account sends in an hour, or None for no limit
+        :param adaptive: whether to limit the questions in flight per new account with an AdaptiveLimiter
+        """
+        for profile in profiles:
+            account = self.accounts.get(profile)
+            if account is None:
+                account = self.accounts[profile] = Account(profile)
+                account.hourly_cap = hourly_cap
+                if adaptive:
+                    self.limiters[profile] = AdaptiveLimiter(workers)
+            elif profile in self.limiters and self.limiters[profile].max_limit < workers:
+                # More workers only raise the ceiling of the limit, what it learnt is kept
+                self.limiters[profile].max_limit = workers
+            running = len([worker for worker, worker_account in self._workers if worker_account is account])
+            for index in range(running, workers):
+                worker = threading.Thread(target=self._work, args=(account,), daemon=True,
+                                          name="whipper-worker-%s-%d" % (profile, index))
+                self._workers.append((worker, account))
+                worker.start()
+
+    def close(self, timeout=None):
+        """
+        Stops the workers once they are done with the question they are asking, and closes their sessions.
+        The questions still queued are not asked.
+
+        :param timeout: the seconds to wait for each worker, or None to wait until it stops
+        """
+        self._closed.set()
+        for worker, _ in self._workers:
+            worker.join(timeout)
+        self._workers = []
+        with self._lock:
+            if BatchEngine._instance is self:
+                BatchEngine._instance = None
+
+    @property
+    def workers(self):
+        return len(self._workers)
+
+    def limit_history(self):
+        """
+        Returns the changes of the adaptive limits, to tune the limiter.
+
+        :return: a dict of auth profile to the list of the limit changes, see AdaptiveLimiter.history
+        """
+        return {profile: list(limiter.history) for profile, limiter in self.limiters.items()}
+
+    def timings(self):
+        """
+        :return: a dict of the worker seconds spent "waiting" for the rate limits and "working" on questions
+        """
+        with self._timings_lock:
+            return dict(self._timings)
+
+    def _count_time(self, kind, seconds):
+        with self._timings_lock:
+            self._timings[kind] += seconds
+
+    def blocked_for(self):
+        """
+        :return: the seconds until an account can ask again, 0 when one can ask now
+        """
+        waits = [account.wait_time() for account in list(self.accounts.values())]
+        return min(waits) if len(waits) > 0 else 0.0
+
+    def _ask_once(self, session, account, job, task, conversation_id="", parent_message_id=""):
+        """
+        Asks a question once, and tells the limiter of the account how it went. A streamed task gets its chunks
+        as they arrive, and stops as soon as its job is cancelled.
+        """
+        limiter = self.limiters.get(account.profile)
+        start = time.time()
+        res = self._ask_session(session, job, task, conversation_id, parent_message_id)
+        # "Failed to read response" comes back as an answer, but it is mostly an overloaded backend
+        failed = res is None or getattr(session, "last_failed", False)
+        if limiter is not None:
+            # A cut stream is a sign of overload too
+            ok = not failed and not getattr(session, "last_truncated", False)
+            limiter.record(time.time() - start, getattr(session, "last_ttft", None), ok)
+        if failed and task.chunks is None:
+            return None
+        return res
+
+    def _ask_session(self, session, job, task, conversation_id="", parent_message_id=""):
+        if task.chunks is None:
+            return session.ask(task.prompt, conversation_id, parent_message_id)
+        parts = []
+        for chunk in session.ask_stream(task.prompt, conversation_id, parent_message_id):
+            # The stream of a cancelled job goes on for the identical questions which joined it
+            if job.cancelled.is_set() and self.flights.abandon(task):
+                break
+            parts.append(chunk)
+            self.flights.publish(task, chunk)
+        return "".join(parts) if len(parts) > 0 else None
+
+    def _ask(self, session, account, job, task):
+        """
+        Asks a question, resetting the session and retrying up to failed_retries times until it gets an answer.
+        A session which can not answer at all, see ChatGPT.last_error, fails the task at once with task.error set.
+        An answer cut by a timeout is asked again up to truncated_retries times, then kept with task.truncated set,
+        so the caller decides what to do with it. A streamed answer is never asked again, its chunks are out.
+
+        :return: False if the account hit its hourly cap and the question has to go to another account
+        """
+        # A conversation can only be continued with the account it was started with
+        same_account = task.profile is None or task.profile == account.profile
+        conversation_id = task.conversation_id if same_account else ""
+        parent_message_id = task.parent_message_id if same_account else ""
+        account.record()
+        res = self._ask_once(session, account, job, task)
+        truncations = 0
+        failures = 0
+        while not job.cancelled.is_set():
+            truncated = getattr(session, "last_truncated", False)
+            if res is None:
+                if getattr(session, "last_status", None) == Account.CAP_STATUS:
+                    account.block()
+                    return False
+                # Asking again does not help a logged out profile, the caller reports the error
+                error = getattr(session, "last_error", None)
+                if error is not None:
+                    task.error = RuntimeError(error)
+                    break
+                if failures >= self.failed_retries:
+                    task.error = RuntimeError("No answer after %d tries" % (failures + 1))
+                    break
+                failures += 1
+                print("Process failed will resubmit it after %d seconds" % self.waiting_time)
+                time.sleep(self.waiting_time)
+                session.reset()
+            elif truncated and task.chunks is None and truncations < self.truncated_retries:
+                truncations += 1
+                print("The answer was cut (%s), will resubmit it"
+                      % (getattr(session, "last_timeout", None) or "the stream ended early"))
+            else:
+                break
+            task.retries += 1
+            account.record()
+            res = self._ask_once(session, account, job, task, conversation_id, parent_message_id)
+        task.truncated = res is not None and getattr(session, "last_truncated", False)
+        task.timeout = getattr(session, "last_timeout", None) if task.truncated else None
+        task.answer = res
+        task.profile = account.profile
+        task.conversation_id = session.get_conversation_id()
+        task.parent_message_id = session.get_parent_message_id()
+        return True
+
+    def _work(self, account):
+        session = None
+        while not self._closed.is_set():
+            wait = account.wait_time()
+            if wait > 0:
+                wait = min(wait, self.IDLE_TIME)
+                time.sleep(wait)
+                self._count_time("waiting", wait)
+                continue
+            limiter = self.limiters.get(account.profile)
+            if limiter is not None:
+                start = time.time()
+                acquired = limiter.acquire(timeout=self.IDLE_TIME)
+                self._count_time("waiting", time.time() - start)
+                if not acquired:
+                    continue
+            try:
+                item = self._tasks.get(account.profile, timeout=self.IDLE_TIME)
+                if item is None:
+                    continue
+                job, task = item
+                if job.cancelled.is_set():
+                    continue
+                # A task joining the flight of another one is in flight as well
+                job.running.add(task)
+                if self.flights.join(job, task):
+                    continue
+                answered = False
+                try:
+                    if session is None:
+                        session = self.session_factory(account.profile)
+                    start = time.time()
+                    answered = self._ask(session, account, job, task)
+                    self._count_time("working", time.time() - start)
+                    if not answered:
+                        print("Account %s hit its hourly cap, its question goes back to the queue"
+                              % account.profile)
+                except Exception as error:
+                    task.error = error
+                    answered = True
+                followers = self.flights.land(task)
+            finally:
+                if limiter is not None:
+                    limiter.release()
+            if not answered:
+                job.running.discard(task)
+                self._tasks.put(job, task)
+            else:
+                self._reply(job, task)
+            for follower_job, follower in followers:
+                if not answered or (job.cancelled.is_set() and task.answer is None):
+                    # The leader has no answer to share, and streamed no chunk, the follower is asked on its own
+                    follower_job.running.discard(follower)
+                    self._tasks.put(follower_job, follower)
+                    continue
+                follower.answer = task.answer
+                follower.error = task.error
+                follower.truncated = task.truncated
+                follower.timeout = task.timeout
+                follower.profile = task.profile
+                follower.conversation_id = task.conversation_id
+                follower.parent_message_id = task.parent_message_id
+                self._reply(follower_job, follower)
+        # The session was created in this thread, and a ChatGPT can only be closed from it
+        close = getattr(session, "close", None)
+        if close is not None:
+            close()
+
+    @staticmethod
+    def _reply(job, task):
+        job.running.discard(task)
+        if task.chunks is not None:
+            task.chunks.put(None)
+        job.replies.put(task)
+
+    def stream(self, task, job=None):
+        """
+        Submits one task and yields the chunks of its answer as they arrive.
+        Closing the generator cancels the job, and the worker stops the stream at the next chunk.
+
+        :param task: the BatchTask
+        :param job: the Job of the task, an interactive one by default
+        :return: a generator of str
+        """
+        job = job or Job(interactive=True)
+        task.chunks = queue.Queue()
+        self._tasks.put(job, task)
+        answered = False
+        try:
+            chunk = task.chunks.get()
+            while chunk is not None:
+                yield chunk
+                chunk = task.chunks.get()
+            job.replies.get()
+            answered = True
+        finally:
+            if not answered:
+                job.cancelled.set()
+                self._tasks.discard(job)
+
+    def run(self, tasks, job=None, window=None):
+        """
+        Submits tasks to the workers and yields them as they are answered, in completion order.
+        Closing the generator, e.g. when Streamlit stops the script, cancels the job and drops the tasks
+        not started yet.
+
+        :param tasks: a list or an iterator of BatchTask
+        :param job: the Job the tasks belong to, which sets their user, prompt and priority
+        :param window: the most tasks queued or in flight at a time, so an iterator of tasks is only read as the
+            workers need them, or None to submit them all at once
+        :return: a generator of BatchTask
+        """
+        job = job or Job()
+        tasks = iter(tasks)
+        submitted = 0
+        answered = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and (window is None or submitted - answered < window):
+                    task = next(tasks, None)
+                    if task is None:
+                        exhausted = True
+                        break
+                    self._tasks.put(job, task)
+                    submitted += 1
+                if answered >= submitted:
+                    break
+                yield job.replies.get()
+                answered += 1
+        finally:
+            if answered < submitted or not exhausted:
+                job.cancelled.set()
+                self._tasks.discard(job)
+            self._tasks.release(job)
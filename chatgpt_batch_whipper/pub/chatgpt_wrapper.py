@@ -41,12 +41,27 @@ import operator
 import time
 import uuid
 import shutil
+import glob
 from functools import reduce
 from time import sleep
 from typing import Optional
 import os
 from playwright.sync_api import sync_playwright
 from playwright._impl._api_structures import ProxySettings
+from .token_manager import TokenManager
+
+
+class Answer(str):
+    """
+    The text of an answer, which knows whether its stream was cut before it ended, by a timeout or not.
+    """
+
+    def __new__(cls, text, truncated=False, timeout=None):
+        answer = super().__new__(cls, text)
+        answer.truncated = truncated
+        # "first_token", "idle" or "total", the timeout which cut the stream, None when it was cut otherwise
+        answer.timeout = timeout
+        return answer
 
 
 class ChatGPT:
@@ -58,16 +73,72 @@ class ChatGPT:
 
     stream_div_id = "chatgpt-wrapper-conversation-stream-data"
     eof_div_id = "chatgpt-wrapper-conversation-stream-data-eof"
-    session_div_id = "chatgpt-wrapper-session-data"
-    _instance = None
+    profiles_root = "/tmp/playwright"
+    default_profile = "default"
+    base_url = "https://chat.openai.com"
+    # The seconds to wait for /api/auth/session
+    session_timeout = 15
+    # The seconds a stream may go without new text once it started, and the longest a whole answer may take
+    idle_timeout = 30
+    total_timeout = 600
+    # The seconds between two reads of the stream in the page
+    poll_interval = 0.2
+    session_js = """
+        async ([url, timeout]) => {
+          const controller = new AbortController();
+          const timer = setTimeout(() => controller.abort(), timeout);
+          try {
+            const response = await fetch(url + '/api/auth/session', {signal: controller.signal});
+            return response.status == 200 ? await response.json() : null;
+          } finally {
+            clearTimeout(timer);
+          }
+        }
+        """
+    _instances = {}
+    # Whether this process started a browser already, the left over browsers are only killed before the first one
+    _browsers_started = False
 
-    def __new__(cls, headless: bool = True, browser="firefox", timeout=60, proxy: Optional[ProxySettings] = None):
+    def __new__(cls, headless: bool = True, browser="firefox", timeout=60, proxy: Optional[ProxySettings] = None,
+                shared: bool = True, profile: str = default_profile, base_url: Optional[str] = None,
+                idle_timeout: Optional[float] = None, total_timeout: Optional[float] = None, recorder=None):
+        """
+        The shared ChatGPT of a profile should be only be created once.
+        Pass shared=False to get a separate instance, e.g. one per worker thread of the batch engine.
         """
-        ChatGPT should be only be created once.
+        if not shared:
+            return super().__new__(cls)
+        if profile not in cls._instances:
+            cls._instances[profile] = super().__new__(cls)
+        return cls._instances[profile]
+
+    @classmethod
+    def profile_path(cls, profile: str = default_profile) -> str:
         """
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-        return cls._instance
+        Returns the browser data directory of an auth profile.
+
+        Args:
+            profile (str): The name of the profile.
+
+        Returns:
+            str: The directory, /tmp/playwright for the default profile and /tmp/playwright-<profile> otherwise.
+        """
+        if profile == cls.default_profile:
+            return cls.profiles_root
+        return f"{cls.profiles_root}-{profile}"
+
+    @classmethod
+    def list_profiles(cls) -> list:
+        """
+        Lists the auth profiles created with `run_chatgpt auth --profile <name>`.
+
+        Returns:
+            list: The names of the profiles.
+        """
+        profiles = [cls.default_profile] if os.path.isdir(cls.profiles_root) else []
+        prefix = cls.profiles_root + "-"
+        profiles += sorted(path[len(prefix):] for path in glob.glob(prefix + "*") if os.path.isdir(path))
+        return profiles
 
     def _connect(self):
         self.play = sync_playwright().start()
@@ -75,17 +146,17 @@ class ChatGPT:
         try:
             playbrowser = getattr(self.play, self.browser_type)
         except Exception:
-            print(f"Browser {self.browser} is invalid, falling back on firefox")
+            print(f"Browser {self.browser_type} is invalid, falling back on firefox")
             playbrowser = self.play.firefox
         try:
             self.browser = playbrowser.launch_persistent_context(
-                user_data_dir="/tmp/playwright",
+                user_data_dir=self.profile_dir,
                 headless=self.headless,
                 proxy=self.proxy,
             )
         except Exception:
             self.user_data_dir = f"/tmp/{str(uuid.uuid4())}"
-            shutil.copytree("/tmp/playwright", self.user_data_dir)
+            shutil.copytree(self.profile_dir, self.user_data_dir)
             self.browser = playbrowser.launch_persistent_context(
                 user_data_dir=self.user_data_dir,
                 headless=self.headless,
@@ -100,50 +171,61 @@ class ChatGPT:
         self.parent_message_id = str(uuid.uuid4())
         self.conversation_id = None
         self.session = None
-        atexit.register(self._cleanup)
-
-    def __init__(self, headless: bool = True, browser="firefox", timeout=60, proxy: Optional[ProxySettings] = None):
-        self._kill_nightly_processes()
-        self.play = sync_playwright().start()
-
-        try:
-            playbrowser = getattr(self.play, browser)
-        except Exception:
-            print(f"Browser {browser} is invalid, falling back on firefox")
-            playbrowser = self.play.firefox
-        try:
-            self.browser = playbrowser.launch_persistent_context(
-                user_data_dir="/tmp/playwright",
-                headless=headless,
-                proxy=proxy,
-            )
-        except Exception:
-            self.user_data_dir = f"/tmp/{str(uuid.uuid4())}"
-            shutil.copytree("/tmp/playwright", self.user_data_dir)
-            self.browser = playbrowser.launch_persistent_context(
-                user_data_dir=self.user_data_dir,
-                headless=headless,
-                proxy=proxy,
-            )
 
-        if len(self.browser.pages) > 0:
-            self.page = self.browser.pages[0]
-        else:
-            self.page = self.browser.new_page()
-        self._start_browser()
-        self.parent_message_id = str(uuid.uuid4())
-        self.conversation_id = None
-        self.session = None
+    def __init__(self, headless: bool = True, browser="firefox", timeout=60, proxy: Optional[ProxySettings] = None,
+                 shared: bool = True, profile: str = default_profile, base_url: Optional[str] = None,
+                 idle_timeout: Optional[float] = None, total_timeout: Optional[float] = None, recorder=None):
+        """
+        Args:
+            timeout (float): The seconds to wait for the first token of an answer.
+            idle_timeout (float): The seconds a stream may go without new text, idle_timeout by default.
+            total_timeout (float): The longest an answer may take, total_timeout by default.
+            recorder (Recorder): Records every question and the timing of its answer, see replay.Recorder.
+        """
+        if shared and not ChatGPT._browsers_started:
+            # Killed once per process, the browsers of the other profiles and of the separate instances run on
+            self._kill_nightly_processes()
+        ChatGPT._browsers_started = True
+        if getattr(self, "play", None) is not None:
+            # The shared instance of the profile is initialised again, do not leak its previous browser
+            self._cleanup()
+        self.profile = profile
+        self.profile_dir = self.profile_path(profile)
+        self.base_url = base_url or ChatGPT.base_url
+        self.tokens = TokenManager.for_profile(self.profile_dir)
+        self.last_status = None
+        # The seconds to the first chunk of the last answer, and whether it failed
+        self.last_ttft = None
+        self.last_failed = False
+        # Why the last question can not be answered by asking again, e.g. a logged out profile, or None
+        self.last_error = None
+        # Whether the last answer was cut before the end of its stream, and the timeout which cut it, if any
+        self.last_truncated = False
+        self.last_timeout = None
         self.timeout = timeout
+        self.idle_timeout = idle_timeout or ChatGPT.idle_timeout
+        self.total_timeout = total_timeout or ChatGPT.total_timeout
+        self.recorder = recorder
         self.proxy = proxy
         self.browser_type = browser
         self.headless = headless
-        atexit.register(self._cleanup)
+        self.play = None
+        self._connect()
+        # Registered once per instance, reset() reconnects without registering again
+        if not getattr(self, "_cleanup_registered", False):
+            atexit.register(self._cleanup)
+            self._cleanup_registered = True
 
     def reset(self):
         self._cleanup()
         self._connect()
 
+    def close(self):
+        """
+        Closes the browser of the session, it can not ask anymore.
+        """
+        self._cleanup()
+
 
     @staticmethod
     def _kill_nightly_processes():
@@ -158,52 +240,125 @@ class ChatGPT:
         os.system(f"{pkill_command} Nightly")
 
     def _start_browser(self):
-        self.page.goto("https://chat.openai.com/")
+        self.page.goto(self.base_url + "/")
 
     def _cleanup(self):
-        self.browser.close()
+        """
+        Closes the browser and stops Playwright. Calling it again, e.g. at exit after a reset, does nothing.
+        """
+        if self.play is None:
+            return
+        try:
+            self.browser.close()
+        except Exception as error:
+            print(f"Failed to close the browser: {error}")
         # remove the user data dir in case this is a second instance
         if hasattr(self, "user_data_dir"):
-            shutil.rmtree(self.user_data_dir)
-        self.play.stop()
+            shutil.rmtree(self.user_data_dir, ignore_errors=True)
+            del self.user_data_dir
+        try:
+            self.play.stop()
+        except Exception as error:
+            print(f"Failed to stop playwright: {error}")
+        # Drop the Playwright objects so nothing from the old connection outlives a reset
+        self.page = None
+        self.browser = None
+        self.play = None
+
+    def _fetch_session(self):
+        """
+        Gets the session from /api/auth/session in the page, waiting at most session_timeout seconds.
+
+        Returns:
+            dict: The session, or None if it could not be read.
+        """
+        try:
+            return self.page.evaluate(self.session_js, [self.base_url, self.session_timeout * 1000])
+        except Exception as error:
+            print(f"Failed to read the session: {error}")
+            return None
 
     def refresh_session(self):
-        self.page.evaluate(
-            """
-        const xhr = new XMLHttpRequest();
-        xhr.open('GET', 'https://chat.openai.com/api/auth/session');
-        xhr.onload = () => {
-          if(xhr.status == 200) {
-            var mydiv = document.createElement('DIV');
-            mydiv.id = "SESSION_DIV_ID"
-            mydiv.innerHTML = xhr.responseText;
-            document.body.appendChild(mydiv);
-          }
-        };
-        xhr.send();
-        """.replace(
-                "SESSION_DIV_ID", self.session_div_id
-            )
-        )
+        """
+        Gets a new session, shared with the other pages of the same profile.
+        """
+        self.tokens.invalidate(self.tokens.session)
+        self.session = self.tokens.get(self._fetch_session)
+
+    def _cleanup_divs(self):
+        for div_id in (self.stream_div_id, self.eof_div_id):
+            self.page.evaluate(f"const div = document.getElementById('{div_id}'); if (div) div.remove();")
 
-        while True:
-            session_datas = self.page.query_selector_all(f"div#{self.session_div_id}")
-            if len(session_datas) > 0:
-                break
-            sleep(0.2)
+    def _abort_stream(self):
+        """
+        Aborts the request of the stream in progress, without touching the browser.
+        """
+        self.page.evaluate("if (window.chatgptWrapperXhr) window.chatgptWrapperXhr.abort();")
 
-        session_data = json.loads(session_datas[0].inner_text())
-        self.session = session_data
+    def _stream_timeout(self, start_time, last_progress_time):
+        """
+        Tells whether a stream ran out of time.
 
-        self.page.evaluate(f"document.getElementById('{self.session_div_id}').remove()")
+        Args:
+            start_time (float): When the message was sent.
+            last_progress_time (float): When the last new text arrived, None before the first token.
 
-    def _cleanup_divs(self):
-        self.page.evaluate(f"document.getElementById('{self.stream_div_id}').remove()")
-        self.page.evaluate(f"document.getElementById('{self.eof_div_id}').remove()")
+        Returns:
+            str: "first_token", "idle" or "total" for the timeout reached, None while there is time left.
+        """
+        now = time.time()
+        if now - start_time > self.total_timeout:
+            return "total"
+        if last_progress_time is None:
+            return "first_token" if now - start_time > self.timeout else None
+        return "idle" if now - last_progress_time > self.idle_timeout else None
 
     def ask_stream(self, prompt: str, conversation_id: str = "", parent_message_id: str = ""):
+        """
+        Send a message to chatGPT and yield the response as it arrives.
+        When the server refuses the access token, the token is refreshed and the message sent again once,
+        without resetting the browser.
+
+        Args:
+            prompt (str): The message to send.
+            conversation_id (str): Conversation id.
+            parent_message_id (str): parent_message_id.
+
+        Yields:
+            str: The chunks of the response.
+        """
+        start_time = time.time()
+        events = []
+        try:
+            for _ in range(2):
+                answered = False
+                for chunk in self._ask_stream(prompt, conversation_id, parent_message_id):
+                    answered = True
+                    if self.recorder is not None:
+                        events.append((time.time() - start_time, chunk))
+                    yield chunk
+                if answered or self.last_status not in (401, 403):
+                    return
+                self.tokens.invalidate(self.session)
+        finally:
+            if self.recorder is not None:
+                self.recorder.record(self, prompt, conversation_id, parent_message_id, start_time, events)
+
+    def _ask_stream(self, prompt: str, conversation_id: str = "", parent_message_id: str = ""):
+        self.session = self.tokens.get(self._fetch_session)
+        self.last_status = None
+        self.last_ttft = None
+        self.last_failed = False
+        self.last_error = None
+        self.last_truncated = False
+        self.last_timeout = None
         if self.session is None:
-            self.refresh_session()
+            self.last_failed = True
+            yield (
+                "Your ChatGPT session could not be read.\n"
+                "* Make sure chat.openai.com can be reached and try again."
+            )
+            return
         if conversation_id != conversation_id \
                 or parent_message_id != parent_message_id or \
                 len(conversation_id) == 0 \
@@ -216,6 +371,8 @@ class ChatGPT:
         new_message_id = str(uuid.uuid4())
 
         if "accessToken" not in self.session:
+            self.last_failed = True
+            self.last_error = "The ChatGPT session of the profile %s is not usable, log in again" % self.profile
             yield (
                 "Your ChatGPT session is not usable.\n"
                 "* Run this program with the `install` parameter and log in to ChatGPT.\n"
@@ -243,7 +400,8 @@ class ChatGPT:
             stream_div.id = "STREAM_DIV_ID";
             document.body.appendChild(stream_div);
             const xhr = new XMLHttpRequest();
-            xhr.open('POST', 'https://chat.openai.com/backend-api/conversation');
+            window.chatgptWrapperXhr = xhr;
+            xhr.open('POST', 'BASE_URL/backend-api/conversation');
             xhr.setRequestHeader('Accept', 'text/event-stream');
             xhr.setRequestHeader('Content-Type', 'application/json');
             xhr.setRequestHeader('Authorization', 'Bearer BEARER_TOKEN');
@@ -277,6 +435,9 @@ class ChatGPT:
               if(xhr.readyState == 4) {
                 const eof_div = document.createElement('DIV');
                 eof_div.id = "EOF_DIV_ID";
+                eof_div.innerHTML = xhr.status;
+                // A stream which ends without its end marker, e.g. a dropped connection, was cut
+                eof_div.dataset.done = xhr.responseText.indexOf("data: [DONE]") !== -1 ? "1" : "0";
                 document.body.appendChild(eof_div);
               }
             };
@@ -284,56 +445,83 @@ class ChatGPT:
             """.replace(
                 "BEARER_TOKEN", self.session["accessToken"]
             )
-            .replace("REQUEST_JSON", json.dumps(request))
+            .replace("BASE_URL", self.base_url)
             .replace("STREAM_DIV_ID", self.stream_div_id)
             .replace("EOF_DIV_ID", self.eof_div_id)
+            # The prompt goes in last, so the text of the user is never taken for a placeholder
+            .replace("REQUEST_JSON", json.dumps(request))
         )
-        self.page.evaluate(code)
         last_event_msg = ""
         start_time = time.time()
-        while True:
-            eof_datas = self.page.query_selector_all(f"div#{self.eof_div_id}")
-
-            conversation_datas = self.page.query_selector_all(
-                f"div#{self.stream_div_id}"
-            )
-            if len(conversation_datas) == 0:
-                continue
-
-            full_event_message = None
-
-            try:
-                event_raw = base64.b64decode(conversation_datas[0].inner_html())
-                if len(event_raw) > 0:
-                    event = json.loads(event_raw)
-                    if event is not None:
-                        self.parent_message_id = event["message"]["id"]
-                        self.conversation_id = event["conversation_id"]
-                        full_event_message = "\n".join(
-                            event["message"]["content"]["parts"]
-                        )
-            except Exception:
-                yield (
-                    "Failed to read response from ChatGPT.  Tips:\n"
-                    " * Try again.  ChatGPT can be flaky.\n"
-                    " * Use the `session` command to refresh your session, and then try again.\n"
-                    " * Restart the program in the `install` mode and make sure you are logged in."
+        last_progress_time = None
+        finished = False
+        try:
+            self.page.evaluate(code)
+            while True:
+                self.last_timeout = self._stream_timeout(start_time, last_progress_time)
+                if self.last_timeout is not None:
+                    print(f"The answer was cut by the {self.last_timeout} timeout")
+                    self.last_truncated = True
+                    break
+                eof_datas = self.page.query_selector_all(f"div#{self.eof_div_id}")
+
+                conversation_datas = self.page.query_selector_all(
+                    f"div#{self.stream_div_id}"
                 )
-                break
-
-            if full_event_message is not None:
-                chunk = full_event_message[len(last_event_msg):]
-                last_event_msg = full_event_message
-                yield chunk
-
-            # if we saw the eof signal, this was the last event we
-            # should process and we are done
-            if len(eof_datas) > 0 or (((time.time() - start_time) > self.timeout) and full_event_message is None):
-                break
-
-            sleep(0.2)
-
-        self._cleanup_divs()
+                if len(conversation_datas) == 0:
+                    sleep(self.poll_interval)
+                    continue
+
+                full_event_message = None
+
+                try:
+                    event_raw = base64.b64decode(conversation_datas[0].inner_html())
+                    if len(event_raw) > 0:
+                        event = json.loads(event_raw)
+                        if event is not None:
+                            self.parent_message_id = event["message"]["id"]
+                            self.conversation_id = event["conversation_id"]
+                            full_event_message = "\n".join(
+                                event["message"]["content"]["parts"]
+                            )
+                except Exception:
+                    self.last_failed = True
+                    yield (
+                        "Failed to read response from ChatGPT.  Tips:\n"
+                        " * Try again.  ChatGPT can be flaky.\n"
+                        " * Use the `session` command to refresh your session, and then try again.\n"
+                        " * Restart the program in the `install` mode and make sure you are logged in."
+                    )
+                    break
+
+                if full_event_message is not None and full_event_message != last_event_msg:
+                    chunk = full_event_message[len(last_event_msg):]
+                    last_event_msg = full_event_message
+                    last_progress_time = time.time()
+                    if self.last_ttft is None:
+                        self.last_ttft = last_progress_time - start_time
+                    yield chunk
+
+                # if we saw the eof signal, this was the last event we
+                # should process and we are done
+                finished = len(eof_datas) > 0
+                if finished:
+                    status = eof_datas[0].inner_text()
+                    self.last_status = int(status) if status.isdigit() else None
+                    if len(last_event_msg) > 0 and eof_datas[0].get_attribute("data-done") != "1":
+                        print("The answer stream ended before its end marker")
+                        self.last_truncated = True
+                    break
+
+                sleep(self.poll_interval)
+        finally:
+            # The request is still running when the caller closed the generator or the stream failed
+            try:
+                if not finished:
+                    self._abort_stream()
+            finally:
+                # Always remove the divs, or every failed request leaves two more nodes in the page
+                self._cleanup_divs()
 
     def ask(self, message: str, conversation_id: str = "", parent_message_id: str = "") -> str:
         """
@@ -345,11 +533,12 @@ class ChatGPT:
             parent_message_id (str): parent_message_id.
 
         Returns:
-            str: The response received from OpenAI.
+            Answer: The response received from OpenAI, with truncated set when a timeout cut it,
+            or None when nothing came back.
         """
         response = list(self.ask_stream(message, conversation_id,parent_message_id))
         return (
-            reduce(operator.add, response)
+            Answer(reduce(operator.add, response), self.last_truncated, self.last_timeout)
             if len(response) > 0
             else None
         )
@@ -0,0 +1,147 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+SingleFlight: the coalescing of identical questions.
+Author: CodeDigger
+Description: This module defines the SingleFlight class. When a worker of the batch engine takes a question
+which is already being asked by another worker, e.g. because two people run the same sample, it does not ask
+it again: the question joins the flight of the first one, gets the chunks streamed so far and then the next
+ones, and finally its answer. Questions are identical when they have the same prompt text (the prompt with its
+input) and continue the same conversation. A leader whose job is cancelled keeps asking while it has followers,
+and a flight abandoned by its leader takes no new followers, so a follower never gets a partial answer.
+"""
+import hashlib
+import threading
+
+
+class _Flight:
+
+    def __init__(self, leader):
+        self.leader = leader
+        self.followers = []
+        self.chunks = []
+        self.abandoned = False
+
+
+class SingleFlight:
+    """
+    The questions in flight, by key, with the identical questions waiting for their answer.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(task):
+        """
+        :param task: a BatchTask
+        :return: the key of the question: the hash of its prompt and the conversation it continues
+        """
+        return (hashlib.sha1(task.prompt.encode("utf-8")).hexdigest(),
+                task.conversation_id or "", task.parent_message_id or "")
+
+    def join(self, job, task):
+        """
+        Starts the flight of a question, or joins the flight of an identical one.
+
+        :param job: the Job of the task
+        :param task: the BatchTask
+        :return: True if the task joined another flight and must not be asked
+        """
+        key = self.key(task)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight.abandoned:
+                # The leader stops before the end of its answer, the task is asked on its own
+                return False
+            if flight is None:
+                self._flights[key] = _Flight(task)
+                task.flight_key = key
+                return False
+            flight.followers.append((job, task))
+            task.joined = True
+            self.hits += 1
+            if task.chunks is not None:
+                for chunk in flight.chunks:
+                    task.chunks.put(chunk)
+            return True
+
+    def publish(self, task, chunk):
+        """
+        Streams a chunk of the answer of a leader to its task and to the tasks of its flight.
+
+        :param task: the BatchTask being asked
+        :param chunk: the chunk
+        """
+        with self._lock:
+            flight = self._flights.get(task.flight_key)
+            if flight is not None and flight.leader is task:
+                flight.chunks.append(chunk)
+                for _, follower in flight.followers:
+                    if follower.chunks is not None:
+                        follower.chunks.put(chunk)
+            if task.chunks is not None:
+                task.chunks.put(chunk)
+
+    def abandon(self, task):
+        """
+        Ends the stream of a leader whose job was cancelled, unless tasks joined its flight.
+
+        :param task: the BatchTask being asked
+        :return: True if nobody waits for the answer and the stream can stop, False if it has to go on
+        """
+        with self._lock:
+            flight = self._flights.get(task.flight_key)
+            if flight is None or flight.leader is not task:
+                return True
+            if len(flight.followers) > 0:
+                return False
+            flight.abandoned = True
+            return True
+
+    def land(self, task):
+        """
+        Ends the flight of a task.
+
+        :param task: the BatchTask which was asked
+        :return: the list of the (job, task) which joined the flight
+        """
+        with self._lock:
+            key = task.flight_key
+            flight = self._flights.get(key)
+            if flight is None or flight.leader is not task:
+                return []
+            del self._flights[key]
+            task.flight_key = None
+            streamed = len(flight.chunks) > 0
+        for _, follower in flight.followers:
+            follower.coalesced = len(flight.followers)
+            # A follower which wanted a stream of a question asked without one gets the answer in one chunk
+            if follower.chunks is not None and not streamed and task.answer is not None:
+                follower.chunks.put(task.answer)
+        task.coalesced = len(flight.followers)
+        return flight.followers
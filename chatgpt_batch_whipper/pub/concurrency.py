@@ -0,0 +1,141 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+AdaptiveLimiter: the adaptive concurrency of the batch engine.
+Author: CodeDigger
+Description: This module defines the AdaptiveLimiter class, an AIMD (additive increase, multiplicative decrease)
+limit on the number of questions an account has in flight. After every window of answers it looks at the
+failure rate, the p50/p95 latency and the time to the first token. When the failures go up, or the latency
+grows well past the best one seen, the backend is overloaded and the limit is cut. Otherwise, if the limit was
+reached, it is raised by one. Every change is kept in the history, to tune the thresholds.
+"""
+import statistics
+import threading
+import time
+
+
+def _percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+class AdaptiveLimiter:
+    """
+    An AIMD limit on the questions in flight, shared by the workers of an account.
+    """
+    # The number of answers the limit is judged on
+    WINDOW = 20
+    # Cut the limit when more than this share of the questions failed
+    MAX_FAILURE_RATE = 0.1
+    # Cut the limit when the p50 latency or the p50 time to first token grows past this many times the best one
+    LATENCY_TOLERANCE = 2.0
+    DECREASE = 0.7
+    HISTORY = 1000
+
+    def __init__(self, max_limit, min_limit=1, initial=None):
+        """
+        :param max_limit: the highest limit, the number of workers of the account
+        :param min_limit: the lowest limit
+        :param initial: the limit to start with, half of max_limit by default
+        """
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(initial if initial is not None else max(self.min_limit, max_limit // 2))
+        self.in_flight = 0
+        self.history = []
+        self._samples = []
+        self._saturated = False
+        self._best_latency = None
+        self._best_ttft = None
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Waits for a free slot.
+
+        :param timeout: the seconds to wait, or None to wait forever
+        :return: False on timeout
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                return False
+            self.in_flight += 1
+            if self.in_flight >= int(self.limit):
+                self._saturated = True
+            return True
+
+    def release(self):
+        """
+        Frees a slot taken with acquire.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def record(self, latency, ttft=None, ok=True):
+        """
+        Counts the outcome of a question, and adjusts the limit at the end of a window.
+
+        :param latency: the seconds the question took
+        :param ttft: the seconds to the first token, None when unknown
+        :param ok: whether an answer came back
+        """
+        with self._cond:
+            self._samples.append((latency, ttft, ok))
+            if len(self._samples) >= self.WINDOW:
+                self._adjust()
+                self._cond.notify_all()
+
+    def _adjust(self):
+        latencies = [latency for latency, _, ok in self._samples if ok]
+        ttfts = [ttft for _, ttft, ok in self._samples if ok and ttft is not None]
+        failure_rate = 1 - len(latencies) / len(self._samples)
+        p50 = statistics.median(latencies) if len(latencies) > 0 else None
+        p95 = _percentile(latencies, 0.95) if len(latencies) > 0 else None
+        ttft = statistics.median(ttfts) if len(ttfts) > 0 else None
+        # The p50 is judged against the best p50, the p95 of a healthy window is already well above it
+        if p50 is not None:
+            self._best_latency = p50 if self._best_latency is None else min(self._best_latency, p50)
+        if ttft is not None:
+            self._best_ttft = ttft if self._best_ttft is None else min(self._best_ttft, ttft)
+        if failure_rate > self.MAX_FAILURE_RATE:
+            reason = "failures"
+        elif p50 is not None and p50 > self.LATENCY_TOLERANCE * self._best_latency:
+            reason = "latency"
+        elif ttft is not None and ttft > self.LATENCY_TOLERANCE * self._best_ttft:
+            reason = "ttft"
+        else:
+            reason = None
+        if reason is not None:
+            self.limit = max(float(self.min_limit), self.limit * self.DECREASE)
+        elif self._saturated:
+            self.limit = min(float(self.max_limit), self.limit + 1)
+            reason = "increase"
+        self.history.append({"time": time.time(), "limit": int(self.limit), "in_flight": self.in_flight,
+                             "p50": p50, "p95": p95, "ttft": ttft, "failure_rate": failure_rate,
+                             "reason": reason or "hold"})
+        del self.history[:-self.HISTORY]
+        self._samples = []
+        self._saturated = self.in_flight >= int(self.limit)
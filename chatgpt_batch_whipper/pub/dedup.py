@@ -0,0 +1,90 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+Dedup: input deduplication for batch jobs.
+Author: CodeDigger
+Description: This module defines the input normalisation and hashing used by the batch job so that every
+distinct input is submitted only once per prompt, and its answer is fanned out to every row with the same input.
+"""
+import hashlib
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalise_input(text):
+    """
+    Normalises an input so that values which only differ by unicode form or white spaces are the same.
+
+    :param text: the input value
+    :return: the normalised string
+    """
+    if text is None or text != text:
+        # None and NaN are empty inputs
+        return ""
+    return _SPACES.sub(" ", unicodedata.normalize("NFC", str(text))).strip()
+
+
+def input_key(text):
+    """
+    Returns the hash of a normalised input.
+
+    :param text: the input value
+    :return: the hex digest
+    """
+    return hashlib.sha1(normalise_input(text).encode("utf-8")).hexdigest()
+
+
+def input_hashes(values):
+    """
+    Hashes many inputs at once, normalised as normalise_input does, e.g. to group the rows of a large batch
+    without keeping their text.
+
+    :param values: a list or Series of input values
+    :return: a numpy array of uint64
+    """
+    texts = pd.Series(values, dtype=object).fillna("").astype(str)
+    texts = texts.str.normalize("NFC").str.replace(_SPACES.pattern, " ", regex=True).str.strip()
+    return pd.util.hash_pandas_object(texts, index=False).to_numpy(dtype=np.uint64)
+
+
+def group_inputs(texts):
+    """
+    Groups positions by input, normalised as normalise_input does.
+
+    :param texts: a list of (position, input value)
+    :return: a dict of input key to (first input value, list of positions), in first seen order
+    """
+    groups = {}
+    for position, text in texts:
+        key = input_key(text)
+        if key not in groups:
+            groups[key] = (text, [])
+        groups[key][1].append(position)
+    return groups
@@ -0,0 +1,371 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+Distributed: the batch jobs run over several machines.
+Author: CodeDigger
+Description: This module defines the Coordinator and the LeaseWorker classes. The coordinator owns the input, the
+checkpoint and the ResultStore of a prompt job. It hands out leases on ranges of the rows left, over HTTP.
+The workers, on any host and each with its own BatchEngine and authed browsers, pull a lease, ask its rows and
+post the answers back as they come, renewing the lease meanwhile. The rows of a lease which expires, e.g.
+because its worker died, go back to the queue for another worker. The workers keep no state, so one can be
+added or killed at any time.
+"""
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .batch_engine import BatchEngine, BatchTask
+from .job_queue import Job
+from .result_store import input_row_ids
+from .telemetry import BatchTelemetry, format_status
+from .templates import PromptTemplate
+
+
+class _Lease:
+    """
+    The rows leased to a worker, and until when.
+    """
+
+    def __init__(self, worker, positions, expires_at):
+        self.id = uuid.uuid4().hex
+        self.worker = worker
+        self.positions = set(positions)
+        self.expires_at = expires_at
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self._reply(200, self.server.coordinator.status())
+        else:
+            self._reply(404, {"error": "unknown path"})
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+            if not isinstance(request, dict):
+                raise ValueError("The body must be a JSON object")
+        except ValueError as error:
+            self._reply(400, {"error": str(error)})
+            return
+        coordinator = self.server.coordinator
+        routes = {"/lease": coordinator.lease, "/results": coordinator.report, "/renew": coordinator.renew}
+        if self.path not in routes:
+            self._reply(404, {"error": "unknown path"})
+            return
+        try:
+            self._reply(200, routes[self.path](**request))
+        except (KeyError, TypeError, ValueError) as error:
+            self._reply(400, {"error": str(error)})
+
+
+class Coordinator:
+    """
+    Serves the leases of the rows of a prompt job left to do, and collects their answers.
+    """
+    LEASE_ROWS = 50
+    LEASE_TIMEOUT = 300
+    # The seconds a worker waits before asking again when every row left is leased
+    RETRY_AFTER = 5
+
+    def __init__(self, store, prompt, data, target_column=None, input_col="input", result_col="result",
+                 row_id_col="row_id", check_col="Is false", prompt_key_col="prompt_key", lease_rows=LEASE_ROWS,
+                 lease_timeout=LEASE_TIMEOUT, host="127.0.0.1", port=8765, status_file=None):
+        """
+        :param store: the ResultStore of the prompt
+        :param prompt: the prompt text, a PromptTemplate referencing the columns of the data
+        :param data: the input DataFrame
+        :param target_column: the column appended to a prompt which references no column
+        :param input_col: the input column of the result
+        :param result_col: the result column of the result
+        :param row_id_col: the row id column of the result
+        :param check_col: the column of the rows to redo, set for the answers cut by a timeout
+        :param prompt_key_col: the column of the key of the prompt a row was answered with, see PromptTemplate.key
+        :param lease_rows: the most rows of a lease
+        :param lease_timeout: the seconds a lease lasts without being renewed
+        :param host: the address to listen on, the leases are not authenticated so only the local host by default
+        :param port: the port to listen on
+        :param status_file: the status file to write the progress to, see telemetry.status_path, or None
+        """
+        self.store = store
+        self.input_col = input_col
+        self.result_col = result_col
+        self.row_id_col = row_id_col
+        self.check_col = check_col
+        self.prompt_key_col = prompt_key_col
+        self.lease_rows = lease_rows
+        self.lease_timeout = lease_timeout
+        template = PromptTemplate(prompt, data.columns, target_column)
+        self.prompt_key = template.key
+        self.row_ids = input_row_ids(data)
+        self._positions = {row_id: position for position, row_id in enumerate(self.row_ids)}
+        self.inputs = template.inputs(data)
+        processed_data = store.load()
+        done_ids = set(processed_data[row_id_col].dropna()) if row_id_col in processed_data.columns else set()
+        todo = [position for position, row_id in enumerate(self.row_ids) if row_id not in done_ids]
+        # The prompts of the rows not answered yet, by position in the input
+        self.prompts = dict(zip(todo, template.render(data.iloc[todo])))
+        self.total = len(self.row_ids)
+        self.done = self.total - len(todo)
+        self._pending = deque(todo)
+        self.telemetry = BatchTelemetry(self.total, path=status_file, done=self.done)
+        self._leases = {}
+        self._lock = threading.Lock()
+        self.finished = threading.Event()
+        if len(todo) == 0:
+            self.finished.set()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.coordinator = self
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d" % ("127.0.0.1" if host == "0.0.0.0" else host, port)
+
+    def _expire(self, now):
+        """
+        Puts the rows of the expired leases back in front of the queue.
+        """
+        for lease_id in [lease_id for lease_id, lease in self._leases.items() if lease.expires_at < now]:
+            lease = self._leases.pop(lease_id)
+            print("The lease %s of %s expired, its %d rows go to another worker"
+                  % (lease_id, lease.worker, len(lease.positions)))
+            self._pending.extendleft(sorted((position for position in lease.positions if position in self.prompts),
+                                            reverse=True))
+
+    def lease(self, worker):
+        """
+        Leases the next range of rows to a worker.
+
+        :param worker: the name of the worker
+        :return: {"lease_id", "expires_in", "rows": [{"row_id", "prompt"}]}, {"wait": seconds} when every row
+            left is leased, or {"done": True}
+        """
+        with self._lock:
+            self._expire(time.time())
+            if self.finished.is_set():
+                return {"done": True}
+            positions = []
+            while len(self._pending) > 0 and len(positions) < self.lease_rows:
+                position = self._pending.popleft()
+                # A row answered by the worker of an expired lease may still be queued
+                if position in self.prompts:
+                    positions.append(position)
+            if len(positions) == 0:
+                return {"wait": self.RETRY_AFTER}
+            lease = _Lease(worker, positions, time.time() + self.lease_timeout)
+            self._leases[lease.id] = lease
+            return {"lease_id": lease.id, "expires_in": self.lease_timeout,
+                    "rows": [{"row_id": self.row_ids[position], "prompt": self.prompts[position]}
+                             for position in positions]}
+
+    def renew(self, lease_id):
+        """
+        Extends a lease, the worker calls it while it works on the rows.
+
+        :return: {"ok": False} when the lease expired already and its rows went to another worker
+        """
+        with self._lock:
+            lease = self._leases.get(lease_id)
+            if lease is None:
+                return {"ok": False}
+            lease.expires_at = time.time() + self.lease_timeout
+            return {"ok": True}
+
+    def report(self, lease_id, results):
+        """
+        Stores the answers of some rows of a lease. The answers of an expired lease are kept too, for the rows
+        nobody answered yet.
+
+        :param lease_id: the id of the lease
+        :param results: a list of {"row_id", "answer", "truncated"}
+        :return: {"ok": True}
+        :raise ValueError: when a result has no row_id or no answer
+        """
+        # Every result is checked before any row is taken off, a bad report changes nothing
+        if not isinstance(results, list) or not all(
+                isinstance(result, dict) and isinstance(result.get("row_id"), str)
+                and isinstance(result.get("answer"), str) for result in results):
+            raise ValueError("Every result needs a row_id and an answer")
+        with self._lock:
+            lease = self._leases.get(lease_id)
+            rows = []
+            for result in results:
+                position = self._positions.get(result["row_id"])
+                if position is None or self.prompts.pop(position, None) is None:
+                    # Unknown, or answered already by another worker
+                    continue
+                if lease is not None:
+                    lease.positions.discard(position)
+                rows.append({self.row_id_col: self.row_ids[position], self.input_col: self.inputs[position],
+                             self.result_col: result["answer"], self.check_col: result.get("truncated", False),
+                             self.prompt_key_col: self.prompt_key})
+            if len(rows) > 0:
+                self.store.append(rows)
+                self.done += len(rows)
+                self.telemetry.record(len(rows))
+            if lease is not None and len(lease.positions) == 0:
+                del self._leases[lease_id]
+            if self.done >= self.total and not self.finished.is_set():
+                self.store.compact()
+                self.finished.set()
+            return {"ok": True}
+
+    def status(self):
+        """
+        :return: the progress of the job
+        """
+        with self._lock:
+            leased = sum(len(lease.positions) for lease in self._leases.values())
+            status = {"total": self.total, "done": self.done, "pending": len(self._pending), "leased": leased,
+                      "workers": sorted({lease.worker for lease in self._leases.values()}),
+                      "finished": self.finished.is_set()}
+            # The queue may still hold rows answered by the worker of an expired lease, the prompts do not
+            self.telemetry.set_counts(pending=len(self.prompts) - leased, in_flight=leased, done=self.done)
+        status["telemetry"] = self.telemetry.snapshot()
+        return status
+
+    def serve(self, linger=10):
+        """
+        Serves the workers until every row is answered.
+
+        :param linger: the seconds to keep answering "done" to the workers once the job is finished
+        """
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True, name="coordinator")
+        thread.start()
+        try:
+            while not self.finished.wait(10):
+                status = self.status()
+                print("[coordinator] %s | workers: %s" % (format_status(status["telemetry"]),
+                                                          ", ".join(status["workers"])))
+                self.telemetry.write(force=True)
+            # The last counts, then the status file says the job is finished
+            self.status()
+            self.telemetry.close()
+            time.sleep(linger)
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class LeaseWorker:
+    """
+    Pulls leases from a Coordinator and asks their rows with a local BatchEngine.
+    """
+    # The consecutive failed calls after which the coordinator is taken as gone
+    MAX_CALL_FAILURES = 5
+    # Post the answers of a lease in batches of at most this many rows
+    REPORT_ROWS = 10
+
+    def __init__(self, url, name=None, engine=None):
+        """
+        :param url: the url of the coordinator
+        :param name: the name of the worker, the host and a random id by default
+        :param engine: the BatchEngine to ask with
+        """
+        self.url = url.rstrip("/")
+        self.name = name or "worker-%s" % uuid.uuid4().hex[:8]
+        self.engine = engine or BatchEngine.get()
+
+    def _call(self, path, body):
+        failures = 0
+        while True:
+            request = urllib.request.Request(self.url + path, data=json.dumps(body).encode("utf-8"),
+                                             headers={"Content-Type": "application/json"})
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    return json.loads(response.read())
+            except (urllib.error.URLError, ConnectionError, TimeoutError) as error:
+                failures += 1
+                if failures >= self.MAX_CALL_FAILURES:
+                    raise
+                print("Failed to reach the coordinator (%s), will retry" % error)
+                time.sleep(2 ** failures)
+
+    def _renew_until(self, lease_id, interval, stop):
+        while not stop.wait(interval):
+            if not self._call("/renew", {"lease_id": lease_id}).get("ok"):
+                print("The lease %s expired, its rows went to another worker" % lease_id)
+                return
+
+    def _work_lease(self, lease):
+        stop = threading.Event()
+        renewer = threading.Thread(target=self._renew_until, args=(lease["lease_id"], lease["expires_in"] / 3, stop),
+                                   daemon=True)
+        renewer.start()
+        results = []
+        try:
+            tasks = [BatchTask(row["row_id"], row["prompt"]) for row in lease["rows"]]
+            for task in self.engine.run(tasks, Job(self.name, lease["lease_id"])):
+                if task.error is not None or task.answer is None:
+                    # Left out of the results, the row goes back to the queue when the lease expires
+                    print("Process failed: %s" % task.error)
+                    continue
+                results.append({"row_id": task.key, "answer": task.answer, "truncated": task.truncated})
+                if len(results) >= self.REPORT_ROWS:
+                    self._call("/results", {"lease_id": lease["lease_id"], "results": results})
+                    results = []
+        finally:
+            stop.set()
+            if len(results) > 0:
+                self._call("/results", {"lease_id": lease["lease_id"], "results": results})
+
+    def run(self):
+        """
+        Works on leases until the coordinator has no row left.
+        """
+        while True:
+            try:
+                lease = self._call("/lease", {"worker": self.name})
+            except (urllib.error.URLError, ConnectionError, TimeoutError):
+                print("The coordinator is gone, stopping")
+                return
+            if lease.get("done"):
+                print("The job is done")
+                return
+            if "wait" in lease:
+                time.sleep(lease["wait"])
+                continue
+            print("%s got %d rows" % (self.name, len(lease["rows"])))
+            self._work_lease(lease)
@@ -0,0 +1,159 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+ResultExporter: the export of the batch results.
+Author: CodeDigger
+Description: This module defines the ResultExporter class, which writes a result to CSV, JSONL, Parquet or
+XLSX. The result is read from its ResultStore and written chunk by chunk, so exporting a large result never
+holds it twice in memory. Parquet needs pyarrow and XLSX needs openpyxl.
+"""
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+
+class ResultExporter:
+    """
+    Writes the result of a ResultStore to a file, chunk by chunk.
+    """
+    CHUNK_SIZE = 10000
+    FORMATS = {"csv": "text/csv",
+               "jsonl": "application/jsonl",
+               "parquet": "application/octet-stream",
+               "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
+    # The optional package each format needs
+    DEPENDENCIES = {"parquet": "pyarrow", "xlsx": "openpyxl"}
+
+    def __init__(self, store, chunk_size=CHUNK_SIZE):
+        """
+        :param store: the ResultStore to export
+        :param chunk_size: the number of rows read and written at a time
+        """
+        self.store = store
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def available_formats(cls):
+        """
+        :return: the formats whose optional dependency is installed
+        """
+        return [fmt for fmt in cls.FORMATS
+                if (fmt != "parquet" or pyarrow is not None) and (fmt != "xlsx" or openpyxl is not None)]
+
+    @classmethod
+    def check_format(cls, fmt):
+        """
+        Checks that a format can be written, before anything is read or written.
+
+        :param fmt: one of FORMATS
+        :raise: ValueError if the format is unknown or its optional dependency is not installed
+        """
+        if fmt not in cls.FORMATS:
+            raise ValueError("Unknown export format: %s" % fmt)
+        if fmt not in cls.available_formats():
+            raise ValueError("The %s export needs %s, please pip install %s."
+                             % (fmt, cls.DEPENDENCIES[fmt], cls.DEPENDENCIES[fmt]))
+
+    def _write_csv(self, chunks, path):
+        with open(path, "w", encoding="utf-8-sig", newline="") as f:
+            header = True
+            for chunk in chunks:
+                chunk.to_csv(f, index=False, header=header)
+                header = False
+
+    def _write_jsonl(self, chunks, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                if len(chunk) > 0:
+                    lines = chunk.to_json(orient="records", lines=True, force_ascii=False)
+                    # Recent pandas already end the lines with a newline, the older ones leave it out
+                    f.write(lines if lines.endswith("\n") else lines + "\n")
+
+    def _write_parquet(self, chunks, path):
+        writer = None
+        try:
+            for chunk in chunks:
+                # Every column is written as text so the chunks always share the same schema
+                table = pyarrow.Table.from_pandas(chunk.astype("string"), preserve_index=False)
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def _write_xlsx(self, chunks, path):
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        header = True
+        for chunk in chunks:
+            if header:
+                sheet.append(list(chunk.columns))
+                header = False
+            for row in chunk.itertuples(index=False):
+                sheet.append([None if value != value else value for value in row])
+        workbook.save(path)
+
+    def export(self, path, fmt="csv", columns=None):
+        """
+        Writes the result to a file.
+
+        :param path: the path of the file to write
+        :param fmt: one of FORMATS
+        :param columns: the columns to export, or None for all of them
+        :return: the path of the file
+        :raise: ValueError if the format can not be written, see check_format
+        """
+        self.check_format(fmt)
+        folder = os.path.dirname(path)
+        if len(folder) > 0 and not os.path.exists(folder):
+            os.makedirs(folder)
+        chunks = self.store.iter_chunks(self.chunk_size, columns)
+        # Write next to the target and rename, so a half written export is never picked up
+        tmp_path = path + ".tmp"
+        getattr(self, "_write_%s" % fmt)(chunks, tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    @staticmethod
+    def parse_columns(text):
+        """
+        Parses a comma separated list of columns, as given on the command line.
+
+        :param text: the columns, e.g. "input,result"
+        :return: a list of str, or None for all the columns
+        """
+        if text is None or len(text.strip()) == 0:
+            return None
+        return [column.strip() for column in text.split(",") if len(column.strip()) > 0]
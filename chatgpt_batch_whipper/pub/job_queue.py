@@ -0,0 +1,186 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+JobQueue: the scheduling of the questions sent to the batch engine.
+Author: CodeDigger
+Description: This module defines the Job and JobQueue classes. Every call of the batch engine is a Job of a
+user for a prompt. The JobQueue hands the questions to the workers one row at a time: the interactive lane
+first, then the jobs of the highest priority, shared between the users and, for each user, between their
+prompts in proportion to the job weights. As the choice is made again for every row, a new job of higher
+priority preempts a running batch at the next row boundary.
+"""
+import queue
+import threading
+from collections import deque
+
+
+class Job:
+    """
+    The questions submitted by one call of the batch engine, and the queue their answers come back on.
+    """
+    NORMAL = 0
+    HIGH = 10
+    LOW = -10
+
+    def __init__(self, user="", prompt_id="", priority=NORMAL, weight=1.0, interactive=False, profile=None):
+        """
+        :param user: the name of the user submitting the job
+        :param prompt_id: the id of the prompt of the job
+        :param priority: the jobs of the highest priority are served first
+        :param weight: the share of the job against the other jobs of the same user and priority
+        :param interactive: whether the job goes to the interactive lane, served before any batch
+        :param profile: the auth profile the job is pinned to, or None to run on any account
+        """
+        self.user = user
+        self.prompt_id = prompt_id
+        self.priority = priority
+        self.weight = max(weight, 1e-3)
+        self.interactive = interactive
+        self.profile = profile
+        self.replies = queue.Queue()
+        self.cancelled = threading.Event()
+        # The tasks a worker has taken and not answered yet, the rest are queued, see BatchTelemetry
+        self.running = set()
+
+    @property
+    def flow(self):
+        return self.user, self.prompt_id
+
+
+class _Flow:
+    """
+    The queued questions of one user for one prompt.
+    """
+
+    def __init__(self, vtime):
+        self.tasks = deque()
+        self.vtime = vtime
+
+
+class JobQueue:
+    """
+    A blocking queue of (job, task) with priorities and weighted fair sharing.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._interactive = deque()
+        self._flows = {}
+        self._user_vtimes = {}
+
+    def __len__(self):
+        with self._cond:
+            return len(self._interactive) + sum(len(flow.tasks) for flow in self._flows.values())
+
+    def _min_vtime(self, vtimes):
+        return min(vtimes) if len(vtimes) > 0 else 0.0
+
+    def put(self, job, task):
+        """
+        Queues a question of a job.
+
+        :param job: the Job
+        :param task: the task to hand to a worker
+        """
+        with self._cond:
+            if job.interactive:
+                self._interactive.append((job, task))
+            else:
+                flow = self._flows.get(job.flow)
+                if flow is None or len(flow.tasks) == 0:
+                    # A flow coming back from idle starts at the current virtual time instead of
+                    # using the share it did not use while idle
+                    active = [f.vtime for f in self._flows.values() if len(f.tasks) > 0]
+                    vtime = max(flow.vtime if flow is not None else 0.0, self._min_vtime(active))
+                    flow = self._flows.setdefault(job.flow, _Flow(vtime))
+                    flow.vtime = vtime
+                    active_users = {user for (user, _), f in self._flows.items() if len(f.tasks) > 0}
+                    if job.user not in active_users:
+                        user_vtime = self._min_vtime([self._user_vtimes[user] for user in active_users])
+                        self._user_vtimes[job.user] = max(self._user_vtimes.get(job.user, 0.0), user_vtime)
+                flow.tasks.append((job, task))
+            self._cond.notify_all()
+
+    @staticmethod
+    def _eligible(job, profile):
+        return profile is None or job.profile is None or job.profile == profile
+
+    def _pop(self, profile=None):
+        for item in self._interactive:
+            if self._eligible(item[0], profile):
+                self._interactive.remove(item)
+                return item
+        active = [(key, flow) for key, flow in self._flows.items()
+                  if len(flow.tasks) > 0 and self._eligible(flow.tasks[0][0], profile)]
+        if len(active) == 0:
+            return None
+        priority = max(flow.tasks[0][0].priority for _, flow in active)
+        active = [(key, flow) for key, flow in active if flow.tasks[0][0].priority == priority]
+        user = min({key[0] for key, _ in active}, key=lambda u: self._user_vtimes.get(u, 0.0))
+        _, flow = min([(key, flow) for key, flow in active if key[0] == user], key=lambda item: item[1].vtime)
+        job, task = flow.tasks.popleft()
+        flow.vtime += 1.0 / job.weight
+        self._user_vtimes[user] = self._user_vtimes.get(user, 0.0) + 1.0
+        return job, task
+
+    def get(self, profile=None, timeout=None):
+        """
+        Takes the next question to ask, blocking until there is one.
+
+        :param profile: the auth profile of the worker, only the jobs which can run on it are taken
+        :param timeout: the seconds to wait, or None to wait forever
+        :return: a (job, task), or None on timeout
+        """
+        with self._cond:
+            item = self._pop(profile)
+            while item is None:
+                if not self._cond.wait(timeout) and timeout is not None:
+                    return None
+                item = self._pop(profile)
+            return item
+
+    def discard(self, job):
+        """
+        Drops the questions of a job which are still queued.
+
+        :param job: the Job
+        """
+        with self._cond:
+            self._interactive = deque(item for item in self._interactive if item[0] is not job)
+            flow = self._flows.get(job.flow)
+            if flow is not None:
+                flow.tasks = deque(item for item in flow.tasks if item[0] is not job)
+
+    def release(self, job):
+        """
+        Forgets the flow of a job once nothing of it is queued, so the flows of short lived jobs, e.g. one per
+        lease of a distributed worker, do not pile up.
+
+        :param job: the Job
+        """
+        with self._cond:
+            flow = self._flows.get(job.flow)
+            if flow is not None and len(flow.tasks) == 0:
+                del self._flows[job.flow]
@@ -0,0 +1,165 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+MockBackend: a local stand-in for the ChatGPT web backend.
+Author: CodeDigger
+Description: This module defines the MockBackend class, an HTTP server answering the three calls the ChatGPT
+wrapper makes: the chat page, /api/auth/session and the event stream of /backend-api/conversation. Pointing a
+ChatGPT at it with base_url runs the real browser code without an account, and it can inject failures (server
+errors, streams cut in the middle and streams which stall) to exercise the retry and reset paths, e.g. in the soak test.
+"""
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith("/api/auth/session"):
+            self._send(200, json.dumps(self.server.backend.session()), "application/json")
+        else:
+            self._send(200, "<html><head><title>ChatGPT</title></head><body></body></html>", "text/html")
+
+    def do_POST(self):
+        if not self.path.startswith("/backend-api/conversation"):
+            self._send(404, "", "text/plain")
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+        self.server.backend.answer(self, request)
+
+
+class MockBackend:
+    """
+    A local ChatGPT backend, run in a background thread.
+    """
+    FAILURES = ("error", "cut", "stall")
+
+    def __init__(self, port=0, failure_rate=0.0, latency=0.01, chunks=5, seed=None, stall=60, failure_kinds=FAILURES):
+        """
+        :param port: the port to listen on, 0 to pick a free one
+        :param failure_rate: the share of the conversations which fail, evenly with a 500, cut off, or stalled
+            after the first event
+        :param latency: the seconds between two events of a stream
+        :param stall: the seconds a stalled stream stays silent before it ends
+        :param failure_kinds: the kinds of failure to inject, some of FAILURES
+        :param chunks: the number of events of an answer
+        :param seed: the seed of the failure injection, to replay a run
+        """
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.chunks = chunks
+        self.stall = stall
+        self.failure_kinds = tuple(failure_kinds)
+        self.requests = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self._server.daemon_threads = True
+        self._server.backend = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name="mock-backend")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @staticmethod
+    def session():
+        """
+        :return: a session whose accessToken is a JWT expiring in an hour
+        """
+        header = base64.urlsafe_b64encode(b'{"alg":"none"}').decode().rstrip("=")
+        payload = base64.urlsafe_b64encode(json.dumps({"exp": int(time.time()) + 3600}).encode()).decode().rstrip("=")
+        return {"accessToken": "%s.%s." % (header, payload)}
+
+    def _failure(self):
+        with self._lock:
+            self.requests += 1
+            if self._random.random() >= self.failure_rate:
+                return None
+            self.failures += 1
+            return self._random.choice(self.failure_kinds)
+
+    def answer(self, handler, request):
+        """
+        Streams the answer of a conversation request, which echoes the prompt.
+        """
+        failure = self._failure()
+        if failure == "error":
+            handler._send(500, "Internal Server Error", "text/plain")
+            return
+        prompt = request["messages"][0]["content"]["parts"][0]
+        conversation_id = request.get("conversation_id") or str(uuid.uuid4())
+        message_id = str(uuid.uuid4())
+        words = ("Answer to: %s" % prompt).split(" ")
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        step = max(1, len(words) // self.chunks)
+        try:
+            for end in list(range(step, len(words), step)) + [len(words)]:
+                event = {"message": {"id": message_id, "content": {"parts": [" ".join(words[:end])]}},
+                         "conversation_id": conversation_id}
+                handler.wfile.write(("data: %s\n\n" % json.dumps(event)).encode("utf-8"))
+                handler.wfile.flush()
+                if failure == "cut":
+                    break
+                if failure == "stall":
+                    # Keep the connection open without a word, as an overloaded backend does
+                    time.sleep(self.stall)
+                    failure = None
+                time.sleep(self.latency)
+            if failure != "cut":
+                handler.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        handler.close_connection = True
@@ -0,0 +1,360 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+Parsers: the post-processing of the batch replies.
+Author: CodeDigger
+Description: This module defines the answer parsers, which turn a reply from ChatGPT (a CSV in the text, a
+markdown table, a JSON fragment, or the named groups of a regex) into structured columns, and a ParseStage which
+runs them in a process pool as the replies come in, so a heavy parsing never slows the submission loop. The parsed
+columns are written to the ResultStore next to the raw result.
+"""
+import csv
+import io
+import json
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _rows_to_columns(header, rows):
+    """
+    Turns the rows of a parsed table into columns. A reply with several rows keeps one line per row in each
+    column, so that the columns of a reply always fit in its result row.
+
+    :param header: the column names
+    :param rows: a list of list of values
+    :return: a dict of column to value
+    """
+    columns = {}
+    for position, name in enumerate(header):
+        values = [row[position] if position < len(row) else "" for row in rows]
+        columns[name] = values[0] if len(values) == 1 else "\n".join(values)
+    return columns
+
+
+class AnswerParser:
+    """
+    Keeps the whole reply, without the code fences around it. Base class of all the parsers.
+    """
+    name = "text"
+    _FENCE = re.compile(r"^\s*```[\w-]*\s*$", re.MULTILINE)
+
+    def clean(self, answer):
+        """
+        Normalises a reply before it is parsed: the code fences and the blank lines around it are removed.
+
+        :param answer: the reply from ChatGPT
+        :return: the text to parse
+        """
+        return self._FENCE.sub("", answer).strip()
+
+    def parse(self, answer):
+        """
+        Parses a reply.
+
+        :param answer: the reply from ChatGPT
+        :return: a dict of column to value, or None when the reply could not be parsed
+        """
+        if not isinstance(answer, str) or len(answer.strip()) == 0:
+            return None
+        return {"text": self.clean(answer)}
+
+
+class CsvParser(AnswerParser):
+    """
+    Parses the CSV in a reply. The lines around it, e.g. an explanation, are skipped: the CSV lines are the ones
+    with the most common number of fields.
+    """
+    name = "csv"
+
+    def __init__(self, header=False, delimiter=","):
+        """
+        :param header: whether the first CSV line names the columns, otherwise they are named 1, 2, ...
+        :param delimiter: the CSV delimiter
+        """
+        self.header = header
+        self.delimiter = delimiter
+
+    def parse(self, answer):
+        if super().parse(answer) is None:
+            return None
+        try:
+            rows = [[field.strip() for field in row]
+                    for row in csv.reader(io.StringIO(self.clean(answer)), delimiter=self.delimiter)]
+        except csv.Error:
+            return None
+        widths = Counter(len(row) for row in rows if len(row) > 1)
+        if len(widths) == 0:
+            return None
+        width = widths.most_common(1)[0][0]
+        rows = [row for row in rows if len(row) == width]
+        if self.header:
+            header, rows = rows[0], rows[1:]
+            if len(rows) == 0:
+                return None
+        else:
+            header = [str(position + 1) for position in range(width)]
+        return _rows_to_columns(header, rows)
+
+
+class TableParser(AnswerParser):
+    """
+    Parses the first markdown table of a reply, whose first line names the columns.
+    """
+    name = "table"
+    _SEPARATOR = re.compile(r"^\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?$")
+
+    @staticmethod
+    def _cells(line):
+        return [cell.strip() for cell in line.strip().strip("|").split("|")]
+
+    def parse(self, answer):
+        if super().parse(answer) is None:
+            return None
+        lines = []
+        for line in self.clean(answer).splitlines():
+            if line.strip().startswith("|"):
+                lines.append(line.strip())
+            elif len(lines) > 0:
+                break
+        lines = [line for line in lines if self._SEPARATOR.match(line) is None]
+        if len(lines) < 2:
+            return None
+        return _rows_to_columns(self._cells(lines[0]), [self._cells(line) for line in lines[1:]])
+
+
+class JsonParser(AnswerParser):
+    """
+    Parses the first JSON object or array of a reply. The keys of an object become columns, nested values are kept
+    as JSON; an array of objects is parsed as the rows of a table.
+    """
+    name = "json"
+    _START = re.compile(r"[\[{]")
+
+    @staticmethod
+    def _value(value):
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, ensure_ascii=False)
+        return "" if value is None else str(value)
+
+    def _document(self, text):
+        decoder = json.JSONDecoder()
+        for match in self._START.finditer(text):
+            try:
+                return decoder.raw_decode(text, match.start())[0]
+            except ValueError:
+                continue
+        return None
+
+    def parse(self, answer):
+        if super().parse(answer) is None:
+            return None
+        document = self._document(self.clean(answer))
+        if isinstance(document, dict):
+            return {str(key): self._value(value) for key, value in document.items()}
+        if isinstance(document, list) and len(document) > 0:
+            if all(isinstance(item, dict) for item in document):
+                header = list(dict.fromkeys(str(key) for item in document for key in item))
+                return _rows_to_columns(header, [[self._value(item.get(key)) for key in header]
+                                                 for item in document])
+            return {"value": "\n".join(self._value(item) for item in document)}
+        return None
+
+
+class RegexParser(AnswerParser):
+    """
+    Parses a reply with the named groups of a regular expression, e.g. (?P<name>.+) - (?P<price>\\d+).
+    """
+    name = "regex"
+
+    def __init__(self, pattern):
+        """
+        :param pattern: the regular expression searched in the reply, each named group is a column
+        """
+        try:
+            self.pattern = re.compile(pattern, re.DOTALL)
+        except re.error as error:
+            raise ValueError("Invalid regex: %s" % error) from error
+        if len(self.pattern.groupindex) == 0:
+            raise ValueError("The regex parser needs named groups, e.g. (?P<name>...)")
+
+    def parse(self, answer):
+        if super().parse(answer) is None:
+            return None
+        match = self.pattern.search(self.clean(answer))
+        if match is None:
+            return None
+        return {name: (value or "").strip() for name, value in match.groupdict().items()}
+
+
+def build_parser(spec):
+    """
+    Builds a parser from the spec typed in the UI or given on the command line.
+
+    Supported specs:
+        "" or "none"          -> None, the replies are not parsed
+        "text"                -> AnswerParser
+        "csv" or "csv:header" -> CsvParser, optionally with a header line
+        "table"               -> TableParser
+        "json"                -> JsonParser
+        "regex:<pattern>"     -> RegexParser
+
+    :param spec: the parser spec
+    :return: an AnswerParser, or None
+    """
+    spec = (spec or "").strip()
+    name, _, arg = spec.partition(":")
+    name = name.strip().lower()
+    if name in ("", "none"):
+        return None
+    if name == AnswerParser.name:
+        return AnswerParser()
+    if name == CsvParser.name:
+        return CsvParser(header=arg.strip().lower() == "header")
+    if name == TableParser.name:
+        return TableParser()
+    if name == JsonParser.name:
+        return JsonParser()
+    if name == RegexParser.name:
+        return RegexParser(arg)
+    raise ValueError("Unknown parser: %s" % spec)
+
+
+def _parse_one(parser, answer):
+    try:
+        return parser.parse(answer)
+    except Exception:
+        # A reply which breaks the parser is a parse failure like any other
+        return None
+
+
+def _parse_all(parser, answers):
+    # Runs in a worker process, a batch of replies at a time to pay the pickling once per batch
+    return [_parse_one(parser, answer) for answer in answers]
+
+
+class ParseStage:
+    """
+    Parses replies in a process pool and writes the parsed columns to the result.
+    The replies are sent to the pool in batches, and the parsed ones are written back by the thread which calls
+    collect or drain, so the ResultStore is only ever written from one thread.
+    """
+    BATCH_SIZE = 50
+    PREFIX = "parsed_"
+
+    def __init__(self, parser, store, workers=2, batch_size=BATCH_SIZE, prefix=PREFIX):
+        """
+        :param parser: the AnswerParser to use, it is pickled to the worker processes
+        :param store: the ResultStore to write the parsed columns to
+        :param workers: the number of parsing processes
+        :param batch_size: the number of replies sent to a process at a time
+        :param prefix: the prefix of the parsed columns, so they never overwrite the columns of the result
+        """
+        self.parser = parser
+        self.store = store
+        self.batch_size = batch_size
+        self.prefix = prefix
+        self.parsed = 0
+        self.failed = 0
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._batch = []
+        self._pending = []
+
+    def submit(self, row_indexes, answer):
+        """
+        Queues a reply for parsing and returns immediately.
+
+        :param row_indexes: the indexes in the result of the rows with this reply
+        :param answer: the reply to parse
+        """
+        self._batch.append((list(row_indexes), answer))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        self.collect()
+
+    def _flush(self):
+        if len(self._batch) == 0:
+            return
+        batch, self._batch = self._batch, []
+        future = self._executor.submit(_parse_all, self.parser, [answer for _, answer in batch])
+        self._pending.append(([row_indexes for row_indexes, _ in batch], future))
+
+    def _write(self, rows, future):
+        try:
+            parsed = future.result()
+        except Exception as error:
+            # The replies are paid for already, a batch the pool could not parse, e.g. with a parser which can
+            # not be pickled, only leaves its parsed columns empty
+            print("Failed to parse %d replies: %s" % (len(rows), error))
+            self.failed += len(rows)
+            return
+        changes = []
+        for row_indexes, columns in zip(rows, parsed):
+            if columns is None:
+                self.failed += 1
+                continue
+            self.parsed += 1
+            values = {self.prefix + column: value for column, value in columns.items()}
+            changes.extend((row_index, values) for row_index in row_indexes)
+        if len(changes) > 0:
+            self.store.update(changes)
+
+    def collect(self):
+        """
+        Writes the parsed columns of the batches done, without waiting for the others.
+        """
+        pending = []
+        for rows, future in self._pending:
+            if future.done():
+                self._write(rows, future)
+            else:
+                pending.append((rows, future))
+        self._pending = pending
+
+    def drain(self):
+        """
+        Parses the replies left and waits until all the parsed columns are written.
+        """
+        self._flush()
+        for rows, future in self._pending:
+            self._write(rows, future)
+        self._pending = []
+
+    def parse_store(self, result_col="result", chunk_size=10000):
+        """
+        Parses all the replies already in the result, e.g. to reprocess an old job with a new parser.
+
+        :param result_col: the result column
+        :param chunk_size: the number of rows read at a time
+        """
+        for chunk in self.store.iter_chunks(chunk_size, [result_col]):
+            for row_index, answer in zip(chunk.index, chunk[result_col]):
+                if isinstance(answer, str):
+                    self.submit([row_index], answer)
+        self.drain()
+        self.store.compact()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
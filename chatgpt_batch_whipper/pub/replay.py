@@ -0,0 +1,323 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+Replay: the recording and the replay of the ChatGPT traffic.
+Author: CodeDigger
+Description: This module defines the Recorder, which writes every question a ChatGPT asks and the chunks of its
+answer, with their timing, to a gzipped JSON lines archive, and the ReplaySession, which answers the same questions
+from such an archive without a browser, at the original speed or faster. A ReplaySession stands in for a ChatGPT
+in the BatchEngine, so a recorded job can be rerun offline to benchmark the batch, the persistence and the UI
+against the shape of real traffic, or reprocessed with a new parser without spending any quota.
+"""
+import atexit
+import gzip
+import json
+import operator
+import threading
+import time
+import zlib
+from collections import defaultdict
+from functools import reduce
+
+from .accounts import Account
+from .chatgpt_wrapper import Answer
+
+
+class Recorder:
+    """
+    Appends the recorded questions to an archive. One Recorder is shared by all the sessions of a process.
+    """
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        :param path: the archive, a .jsonl.gz file appended to
+        """
+        self.path = path
+        self.records = 0
+        self._file = gzip.open(path, "at", encoding="utf-8")
+        self._write_lock = threading.Lock()
+        atexit.register(self.close)
+
+    @classmethod
+    def get(cls, path):
+        """
+        Returns the Recorder of an archive, the same one on every Streamlit rerun.
+
+        :param path: the archive
+        :return: the Recorder
+        """
+        with cls._lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def record(self, session, prompt, conversation_id, parent_message_id, start_time, events):
+        """
+        Writes the question a session just asked, and how it answered.
+
+        :param session: the ChatGPT which asked it, whose last_* attributes tell how the answer went
+        :param prompt: the prompt text
+        :param conversation_id: the conversation id asked with
+        :param parent_message_id: the parent message id asked with
+        :param start_time: when the question was sent
+        :param events: a list of (seconds since start_time, chunk) of the answer
+        """
+        record = {"time": start_time,
+                  "profile": getattr(session, "profile", None),
+                  "prompt": prompt,
+                  "conversation_id": conversation_id,
+                  "parent_message_id": parent_message_id,
+                  "events": [[round(offset, 4), chunk] for offset, chunk in events],
+                  "duration": round(time.time() - start_time, 4),
+                  "status": session.last_status,
+                  "ttft": session.last_ttft,
+                  "failed": session.last_failed,
+                  "error": getattr(session, "last_error", None),
+                  "truncated": session.last_truncated,
+                  "timeout": session.last_timeout,
+                  "answer_conversation_id": session.get_conversation_id(),
+                  "answer_parent_message_id": session.get_parent_message_id()}
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._write_lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            # A sync flush per record keeps the archive readable up to the last record if the process dies
+            self._file.flush()
+            self.records += 1
+
+    def close(self):
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_archive(path):
+    """
+    Reads the records of an archive. A record cut by a crash in the middle of a write ends the archive.
+
+    :param path: the archive
+    :return: a generator of dict
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        except (EOFError, zlib.error):
+            return
+
+
+class ReplayArchive:
+    """
+    The records of an archive, by prompt. The answers to a prompt are replayed in the order they were recorded,
+    so a failure followed by its retry replays the same way, then the last good answer is given again.
+    """
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        :param path: the archive
+        """
+        self.path = path
+        self.records = list(read_archive(path))
+        self._by_prompt = defaultdict(list)
+        for record in self.records:
+            self._by_prompt[record["prompt"]].append(record)
+        self._taken = defaultdict(int)
+        self._take_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path):
+        """
+        Returns the archive loaded once per process, the same one on every Streamlit rerun.
+
+        :param path: the archive
+        :return: the ReplayArchive
+        """
+        with cls._lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def prompts(self):
+        """
+        :return: the distinct prompts of the archive, in the order they were first asked
+        """
+        return list(self._by_prompt.keys())
+
+    def take(self, prompt):
+        """
+        Returns the next recorded answer to a prompt.
+
+        :param prompt: the prompt text
+        :return: the record, or None when the prompt was never recorded
+        """
+        records = self._by_prompt.get(prompt)
+        if records is None:
+            return None
+        with self._take_lock:
+            taken = self._taken[prompt]
+            self._taken[prompt] = taken + 1
+        if taken < len(records):
+            return records[taken]
+        good = [record for record in records if not record["failed"] and len(record["events"]) > 0]
+        return good[-1] if len(good) > 0 else records[-1]
+
+
+class ReplaySession:
+    """
+    A session answering from a ReplayArchive, with the interface the BatchEngine uses of a ChatGPT.
+    """
+
+    def __init__(self, archive, speed=1.0, profile=None):
+        """
+        :param archive: the ReplayArchive
+        :param speed: how many times faster than recorded the chunks come, 0 for no waiting at all
+        :param profile: the auth profile the session stands for
+        """
+        self.archive = archive
+        self.speed = speed
+        self.profile = profile
+        self.conversation_id = None
+        self.parent_message_id = None
+        self.last_status = None
+        self.last_ttft = None
+        self.last_failed = False
+        self.last_error = None
+        self.last_truncated = False
+        self.last_timeout = None
+
+    def ask_stream(self, prompt, conversation_id="", parent_message_id=""):
+        """
+        Yields the recorded chunks of the answer to a prompt, with the recorded timing.
+
+        :raise KeyError: when the prompt is not in the archive
+        """
+        record = self.archive.take(prompt)
+        if record is None:
+            raise KeyError("The prompt is not in the replay archive %s: %s" % (self.archive.path, prompt[:80]))
+        self.last_status = None
+        self.last_ttft = None
+        self.last_failed = False
+        self.last_error = None
+        self.last_truncated = False
+        self.last_timeout = None
+        start_time = time.time()
+        for offset, chunk in record["events"]:
+            if self.speed > 0:
+                wait = start_time + offset / self.speed - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            if self.last_ttft is None:
+                self.last_ttft = time.time() - start_time
+            yield chunk
+        if self.speed > 0:
+            wait = start_time + record["duration"] / self.speed - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        # A recorded hourly cap is replayed as a plain failure: the replay spends no quota, so it must not block
+        # the account for an hour, and the engine asks again, taking the recorded retry of the question
+        self.last_status = record["status"] if record["status"] != Account.CAP_STATUS else None
+        self.last_failed = record["failed"]
+        self.last_error = record.get("error")
+        self.last_truncated = record.get("truncated", record["timeout"] is not None)
+        self.last_timeout = record["timeout"]
+        self.conversation_id = record["answer_conversation_id"]
+        self.parent_message_id = record["answer_parent_message_id"]
+
+    def ask(self, message, conversation_id="", parent_message_id=""):
+        response = list(self.ask_stream(message, conversation_id, parent_message_id))
+        return (
+            Answer(reduce(operator.add, response), self.last_truncated, self.last_timeout)
+            if len(response) > 0
+            else None
+        )
+
+    def reset(self):
+        pass
+
+    def get_conversation_id(self):
+        return self.conversation_id
+
+    def get_parent_message_id(self):
+        return self.parent_message_id
+
+
+def replay_job(path, workers=2, speed=0.0, parser=None, folder=None):
+    """
+    Replays the questions of an archive through a BatchEngine into a ResultStore, e.g. to benchmark them.
+    Each distinct prompt is asked once, a recorded failure and its retries are replayed as they happened.
+
+    :param path: the archive
+    :param workers: the number of parallel sessions
+    :param speed: how many times faster than recorded the answers come, 0 for no waiting
+    :param parser: the AnswerParser to parse the replies with, or None
+    :param folder: the folder of the result, a temporary one by default
+    :return: a dict of the numbers of the replay
+    """
+    # Imported here, the engine and the store are not needed to record
+    import tempfile
+    from .batch_engine import BatchEngine, BatchTask
+    from .job_queue import Job
+    from .parsers import ParseStage
+    from .result_store import ResultStore
+
+    archive = ReplayArchive(path)
+    folder = folder or tempfile.mkdtemp(prefix="whipper-replay-")
+    store = ResultStore(folder, "replay", ["input", "result"])
+    engine = BatchEngine(session_factory=lambda profile: ReplaySession(archive, speed, profile), waiting_time=0)
+    engine.ensure_workers(workers, profiles=("replay",))
+    parse_stage = ParseStage(parser, store) if parser is not None else None
+    prompts = archive.prompts()
+    start_time = time.time()
+    failed = 0
+    for task in engine.run([BatchTask(key, prompt) for key, prompt in enumerate(prompts)],
+                           Job(user="replay", prompt_id="replay")):
+        if task.error is not None or task.answer is None:
+            failed += 1
+            continue
+        row_index = store.append([{"input": task.prompt, "result": task.answer}])
+        if parse_stage is not None:
+            parse_stage.submit([row_index], task.answer)
+    if parse_stage is not None:
+        parse_stage.drain()
+        parse_stage.close()
+    store.compact()
+    seconds = time.time() - start_time
+    recorded = [(record["time"], record["time"] + record["duration"]) for record in archive.records]
+    return {"questions": len(prompts),
+            "failed": failed,
+            "seconds": seconds,
+            "questions_per_second": len(prompts) / max(seconds, 1e-9),
+            "recorded_seconds": (max(end for _, end in recorded) - min(start for start, _ in recorded)
+                                 if len(recorded) > 0 else 0.0),
+            "result": store.csv_path}
@@ -0,0 +1,363 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+ResultStore: the persistence of the batch results.
+Author: CodeDigger
+Description: This module defines the ResultStore class. The result of a prompt is kept in buff/<No>.csv, and
+every change made while a batch runs is appended to a journal next to it (buff/<No>.journal), so that storing
+a row costs the size of the row and not the size of the result. The journal is folded back into the CSV with
+an atomic write-rename when the batch is done.
+Every result row keeps the id of the input row it answers (see input_row_ids), so the rows already in the result
+are the checkpoint of the batch, whatever the order of the input.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Mixes the occurrence into the row hash of a row key
+_OCCURRENCE_MIX = np.uint64(0x9E3779B97F4A7C15)
+# The row id of the answers which answer no input row, e.g. a single shoot
+NO_INPUT_ROW_ID = "no-input"
+
+
+def input_row_hashes(data):
+    """
+    Returns the hash of the values of every row of an input DataFrame, and the number of identical rows before it.
+
+    :param data: the input DataFrame
+    :return: two numpy arrays of uint64
+    """
+    hashes = pd.util.hash_pandas_object(data, index=False)
+    occurrences = hashes.groupby(hashes).cumcount()
+    return hashes.to_numpy(dtype=np.uint64), occurrences.to_numpy(dtype=np.uint64)
+
+
+def format_row_id(row_hash, occurrence):
+    return "%016x-%d" % (row_hash, occurrence)
+
+
+def input_row_ids(data):
+    """
+    Returns a stable id for every row of an input DataFrame, which does not change when the rows are reordered.
+    The id is the hash of the values of the row, plus the number of identical rows before it.
+
+    :param data: the input DataFrame
+    :return: a list of str
+    """
+    return [format_row_id(row_hash, occurrence) for row_hash, occurrence in zip(*input_row_hashes(data))]
+
+
+def row_keys(hashes, occurrences):
+    """
+    Packs row ids into numbers, to find the rows done among millions without keeping their ids as text.
+
+    :param hashes: the row hashes, see input_row_hashes
+    :param occurrences: the occurrences, see input_row_hashes
+    :return: a numpy array of uint64
+    """
+    return hashes ^ (occurrences * _OCCURRENCE_MIX)
+
+
+def parse_row_keys(row_ids):
+    """
+    Packs row ids read back from a result, see row_keys.
+
+    :param row_ids: a Series of row ids, the missing ones and the ones of no input row are skipped
+    :return: a numpy array of uint64
+    """
+    row_ids = row_ids.dropna().astype(str)
+    row_ids = row_ids[row_ids.str.fullmatch(r"[0-9a-f]{16}-\d+")]
+    parts = row_ids.str.split("-", n=1, expand=True)
+    if len(parts) == 0:
+        return np.empty(0, dtype=np.uint64)
+    hashes = np.array([int(part, 16) for part in parts[0]], dtype=np.uint64)
+    return row_keys(hashes, parts[1].astype(np.uint64).to_numpy())
+
+
+class ResultStore:
+    """
+    A result CSV file plus the journal of the changes not folded into it yet.
+    """
+    JOURNAL_SUFFIX = ".journal"
+
+    def __init__(self, folder, result_no, columns):
+        """
+        :param folder: the folder of the result files
+        :param result_no: the number of the result
+        :param columns: the default columns of an empty result
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.columns = columns
+        self.csv_path = os.path.join(folder, f"{result_no}.csv")
+        self.journal_path = self.csv_path + self.JOURNAL_SUFFIX
+        self._length = None
+
+    def _read_csv(self):
+        if os.path.isfile(self.csv_path):
+            return pd.read_csv(self.csv_path)
+        return pd.DataFrame(columns=self.columns)
+
+    def _iter_journal(self):
+        """
+        Reads the journal entries one at a time. A line cut by a crash in the middle of a write is skipped.
+
+        :return: a generator of dict
+        """
+        if not os.path.isfile(self.journal_path):
+            return
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                yield entry
+
+    def _journal_updates(self):
+        """
+        Reads the updates of the journal, without the appended rows.
+
+        :return: a (dict of row index to the dict of column to value, list of the columns the journal writes),
+            the later updates of a row win
+        """
+        updates = {}
+        columns = {}
+        for entry in self._iter_journal():
+            if entry["op"] == "update":
+                updates.setdefault(entry["index"], {}).update(entry["values"])
+            columns.update(dict.fromkeys(entry["values"]))
+        return updates, list(columns)
+
+    @staticmethod
+    def _apply_updates(data, updates, update_indexes, columns=None):
+        """
+        Applies the journaled updates of the rows of a chunk, in place.
+
+        :param data: the chunk, indexed by the index of its rows in the result
+        :param updates: the updates, see _journal_updates
+        :param update_indexes: the sorted row indexes of the updates, as a numpy array
+        :param columns: the columns of the chunk, or None for all of them
+        """
+        if len(data) == 0:
+            return
+        start, end = np.searchsorted(update_indexes, [data.index[0], data.index[-1] + 1])
+        for index in update_indexes[start:end]:
+            for column, value in updates[int(index)].items():
+                if columns is not None and column not in columns:
+                    continue
+                if column not in data.columns:
+                    data[column] = None
+                elif data[column].dtype != object:
+                    # read_csv typed the column from the file, e.g. an empty Comment is float64,
+                    # and pandas refuses a text in it
+                    data[column] = data[column].astype(object)
+                data.at[index, column] = value
+
+    def _iter_appended(self, chunk_size, start):
+        """
+        Reads the rows appended in the journal, a chunk of rows at a time.
+
+        :param chunk_size: the number of rows of a chunk
+        :param start: the index of the first appended row, the number of rows of the CSV
+        :return: a generator of DataFrame, indexed by the index of the rows in the result
+        """
+        rows = []
+        for entry in self._iter_journal():
+            if entry["op"] != "append":
+                continue
+            rows.append(entry["values"])
+            if len(rows) == chunk_size:
+                yield pd.DataFrame(rows, index=pd.RangeIndex(start, start + len(rows)))
+                start += len(rows)
+                rows = []
+        if len(rows) > 0:
+            yield pd.DataFrame(rows, index=pd.RangeIndex(start, start + len(rows)))
+
+    def load(self, chunk_size=100000):
+        """
+        Loads the result with all the journaled changes applied.
+
+        :param chunk_size: the number of journaled rows read at a time
+        :return: a pandas DataFrame containing the result data
+        """
+        data = self._read_csv()
+        updates, _ = self._journal_updates()
+        update_indexes = np.array(sorted(updates), dtype=np.int64)
+        self._apply_updates(data, updates, update_indexes)
+        appended = []
+        for chunk in self._iter_appended(chunk_size, len(data)):
+            self._apply_updates(chunk, updates, update_indexes)
+            appended.append(chunk)
+        if len(appended) > 0:
+            data = pd.concat([data] + appended, ignore_index=True)
+        self._length = len(data)
+        return data
+
+    def iter_chunks(self, chunk_size, columns=None):
+        """
+        Reads the result a chunk of rows at a time, with the journaled changes applied. The CSV is streamed, then
+        the rows appended in the journal, only the journaled updates are held in memory.
+
+        :param chunk_size: the number of rows of a chunk
+        :param columns: the columns to read, or None for all of them
+        :return: a generator of DataFrame, indexed by the index of the rows in the result
+        """
+        updates, journal_columns = self._journal_updates()
+        update_indexes = np.array(sorted(updates), dtype=np.int64)
+        if columns is None:
+            # Every chunk has all the columns of the result, like the loaded result
+            columns = self._csv_columns()
+            columns += [column for column in journal_columns if column not in columns]
+        length = 0
+        if os.path.isfile(self.csv_path):
+            # A column missing from the file, e.g. in an old result, comes back empty
+            for chunk in pd.read_csv(self.csv_path, chunksize=chunk_size, usecols=lambda column: column in columns):
+                chunk.index = pd.RangeIndex(length, length + len(chunk))
+                length += len(chunk)
+                self._apply_updates(chunk, updates, update_indexes, columns)
+                yield chunk.reindex(columns=columns)
+        for chunk in self._iter_appended(chunk_size, length):
+            self._apply_updates(chunk, updates, update_indexes, columns)
+            length += len(chunk)
+            yield chunk.reindex(columns=columns)
+        # Always at least one chunk, so the columns of an empty result are known
+        if length == 0:
+            yield pd.DataFrame(columns=columns)
+        # Rows appended while the chunks were read are counted by append, the count read here is older
+        if self._length is None:
+            self._length = length
+
+    def _csv_columns(self):
+        if os.path.isfile(self.csv_path):
+            return list(pd.read_csv(self.csv_path, nrows=0).columns)
+        return list(self.columns)
+
+    def is_legacy(self, row_id_col):
+        """
+        Tells whether the result was written before the results had row ids, i.e. its CSV has no row id column.
+        Reads the header of the CSV only.
+
+        :param row_id_col: the row id column
+        :return: bool
+        """
+        if not os.path.isfile(self.csv_path):
+            return False
+        return row_id_col not in pd.read_csv(self.csv_path, nrows=0).columns
+
+    def done_row_keys(self, row_id_col, chunk_size=100000):
+        """
+        Reads the ids of the input rows already in the result, a chunk at a time.
+
+        :param row_id_col: the row id column
+        :param chunk_size: the number of rows read at a time
+        :return: the row keys as a numpy array of uint64, see row_keys
+        """
+        keys = [parse_row_keys(chunk[row_id_col]) for chunk in self.iter_chunks(chunk_size, [row_id_col])]
+        return np.concatenate(keys) if len(keys) > 0 else np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        if self._length is None:
+            # Counted by streaming, the result is never loaded to know its length
+            length = 0
+            if os.path.isfile(self.csv_path):
+                length = sum(len(chunk) for chunk in pd.read_csv(self.csv_path, usecols=[0], chunksize=100000))
+            self._length = length + sum(1 for entry in self._iter_journal() if entry["op"] == "append")
+        return self._length
+
+    def _write_journal(self, entries):
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _jsonable(values):
+        # NaN becomes null and numpy scalars become python ones
+        return {column: (None if value != value else value.item() if hasattr(value, "item") else value)
+                for column, value in values.items()}
+
+    def append(self, rows):
+        """
+        Appends rows to the result.
+
+        :param rows: a list of dict of column to value
+        :return: the index of the first appended row
+        """
+        index = len(self)
+        self._write_journal([{"op": "append", "values": self._jsonable(values)} for values in rows])
+        self._length += len(rows)
+        return index
+
+    def update(self, changes):
+        """
+        Updates some rows of the result in place.
+
+        :param changes: a list of (row index, dict of column to value)
+        """
+        self._write_journal([{"op": "update", "index": int(index), "values": self._jsonable(values)}
+                             for index, values in changes])
+
+    def save(self, data):
+        """
+        Replaces the result with a DataFrame, atomically, and clears the journal.
+
+        :param data: the DataFrame to save
+        """
+        tmp_path = self.csv_path + ".tmp"
+        data.to_csv(tmp_path, encoding='utf-8-sig', index=False)
+        os.replace(tmp_path, self.csv_path)
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+        self._length = len(data)
+
+    def compact(self, chunk_size=100000):
+        """
+        Folds the journal into the result CSV file, a chunk of rows at a time, with an atomic write-rename.
+
+        :param chunk_size: the number of rows read and written at a time
+        """
+        if not os.path.isfile(self.journal_path):
+            return
+        tmp_path = self.csv_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8-sig", newline="") as f:
+            header = True
+            for chunk in self.iter_chunks(chunk_size):
+                chunk.to_csv(f, index=False, header=header)
+                header = False
+        os.replace(tmp_path, self.csv_path)
+        os.remove(self.journal_path)
+
+    def delete(self):
+        """
+        Deletes the result and its journal.
+        """
+        for path in (self.csv_path, self.journal_path):
+            if os.path.isfile(path):
+                os.remove(path)
+        self._length = 0
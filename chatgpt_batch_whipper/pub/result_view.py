@@ -0,0 +1,137 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+ResultView: the result as the review grid shows it.
+Author: CodeDigger
+Description: This module defines the ResultView class, the result of a prompt kept in the Streamlit session between
+the reruns. The result is only read again when its files change, the edits of the review grid are found by
+comparing the edited columns with the view, and only the rows which changed are written, through the journal of
+the ResultStore. A rerun without any edit writes nothing.
+"""
+import os
+
+import numpy as np
+
+
+class ResultView:
+    """
+    A versioned copy of a result in memory, with the review edits applied to it row by row.
+    """
+    INDEX_COL = "index"
+
+    def __init__(self, store, result_no, check_col, comment_col):
+        """
+        :param store: the ResultStore of the result
+        :param result_no: the number of the result
+        :param check_col: the column of the rows checked as false
+        :param comment_col: the column of the review comments
+        """
+        self.store = store
+        self.result_no = result_no
+        self.check_col = check_col
+        self.comment_col = comment_col
+        # Bumped on every change of the view, by the review or by a reload
+        self.version = 0
+        self.data = None
+        self._signature = None
+        self.reload()
+
+    def _files_signature(self):
+        # The view is stale as soon as the CSV or the journal changed on disk, e.g. after a batch
+        signature = []
+        for path in (self.store.csv_path, self.store.journal_path):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def reload(self):
+        """
+        Reads the result again, with the review columns normalised once for all the reruns.
+        """
+        signature = self._files_signature()
+        data = self.store.load()
+        # A result saved by an old version kept the index of the grid as a column
+        data = data.drop(columns=[self.INDEX_COL], errors="ignore")
+        for column in (self.check_col, self.comment_col):
+            if column not in data.columns:
+                data[column] = None
+        data[self.check_col] = (data[self.check_col] == True) | (data[self.check_col].astype(str) == "True")
+        data[self.comment_col] = data[self.comment_col].fillna("").astype(str)
+        self.data = data
+        self._signature = signature
+        self.version += 1
+
+    def stale(self):
+        """
+        :return: True when the result changed on disk since the view read it
+        """
+        return self._files_signature() != self._signature
+
+    def table(self, columns, false_only=False):
+        """
+        Returns the rows to show in the grid, with the index of every row in the result.
+
+        :param columns: the columns to show
+        :param false_only: whether to only show the rows checked as false
+        :return: a DataFrame with an index column
+        """
+        table = self.data[columns]
+        if false_only:
+            table = table[self.data[self.check_col]]
+        table = table.reset_index(drop=True)
+        table.insert(0, self.INDEX_COL, np.flatnonzero(self.data[self.check_col]) if false_only
+                     else np.arange(len(self.data)))
+        return table
+
+    def apply(self, edited):
+        """
+        Applies the edits of the grid to the view, and writes the rows which changed to the result.
+
+        :param edited: the DataFrame the grid returned, with the index column of table
+        :return: the number of rows written
+        """
+        if edited is None or len(edited) == 0 or self.INDEX_COL not in edited.columns:
+            return 0
+        positions = edited[self.INDEX_COL].to_numpy(dtype=np.int64)
+        checks = (edited[self.check_col] == True).to_numpy()
+        comments = edited[self.comment_col].fillna("").astype(str).to_numpy()
+        dirty = np.flatnonzero((checks != self.data[self.check_col].to_numpy()[positions])
+                               | (comments != self.data[self.comment_col].to_numpy()[positions]))
+        if len(dirty) == 0:
+            return 0
+        positions = positions[dirty]
+        checks = checks[dirty]
+        comments = comments[dirty]
+        self.data.loc[positions, self.check_col] = checks
+        self.data.loc[positions, self.comment_col] = comments
+        self.store.update([(position, {self.check_col: bool(check), self.comment_col: comment})
+                           for position, check, comment in zip(positions, checks, comments)])
+        # The view wrote these changes itself, it is not stale because of them
+        self._signature = self._files_signature()
+        self.version += 1
+        return len(dirty)
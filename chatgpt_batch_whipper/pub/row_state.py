@@ -0,0 +1,125 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+RowState: the compact state of the rows of a batch job.
+Author: CodeDigger
+Description: This module defines the RowState and RowGroups classes, which keep what a batch job knows about its
+rows in numpy arrays: a status flag and the index of the answer in the result for every input row, and the
+groups of the rows with the same input. The text of the inputs, the prompts and the answers stays on disk, in
+the input and the ResultStore, and is only read a chunk at a time, so a job of 10M rows needs a few tens of
+bytes per row.
+"""
+import numpy as np
+
+
+class RowState:
+    """
+    The status of every input row of a batch job, and where its answer is in the result.
+    """
+    TODO = 0
+    DONE = 1
+
+    def __init__(self, size):
+        """
+        :param size: the number of input rows
+        """
+        self.status = np.zeros(size, dtype=np.uint8)
+        # The index of the row of the answer in the result, -1 when the row has none yet
+        self.result_index = np.full(size, -1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.status)
+
+    def mark_done(self, positions, first_index=None):
+        """
+        Marks input rows as answered.
+
+        :param positions: the positions of the input rows
+        :param first_index: the index in the result of the answer of the first row, the others follow it,
+            or None when the rows were answered before this job
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        self.status[positions] = self.DONE
+        if first_index is not None:
+            self.result_index[positions] = first_index + np.arange(len(positions))
+
+    def todo(self):
+        """
+        :return: the positions of the rows not answered yet
+        """
+        return np.flatnonzero(self.status == self.TODO)
+
+    def done(self):
+        """
+        :return: the number of rows answered
+        """
+        return int(np.count_nonzero(self.status == self.DONE))
+
+
+class RowGroups:
+    """
+    The rows of a batch job grouped by input, with the groups in the order of their first row.
+    """
+
+    def __init__(self, positions, keys):
+        """
+        :param positions: the positions of the rows
+        :param keys: the input hash of every row, see dedup.input_hashes
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        self.keys, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True,
+                                                      return_counts=True)
+        by_first = np.argsort(first, kind="stable")
+        # The rank of every sorted key, in first row order
+        self._rank = np.empty(len(by_first), dtype=np.int64)
+        self._rank[by_first] = np.arange(len(by_first))
+        self.first = positions[first[by_first]]
+        self._members = positions[np.argsort(self._rank[inverse], kind="stable")]
+        self._sizes = counts[by_first]
+        self._starts = np.concatenate(([0], np.cumsum(self._sizes)[:-1])).astype(np.int64)
+
+    def __len__(self):
+        return len(self.first)
+
+    def members(self, group):
+        """
+        :param group: the number of the group
+        :return: the positions of the rows of the group
+        """
+        start = self._starts[group]
+        return self._members[start:start + self._sizes[group]]
+
+    def find(self, keys):
+        """
+        Finds the groups of some input hashes.
+
+        :param keys: an array of input hashes
+        :return: an array of the group numbers, -1 for the hashes of no group
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        found = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[found] == keys, self._rank[found], -1)
@@ -0,0 +1,282 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+SoakTest: the load and soak test of the batch engine.
+Author: CodeDigger
+Description: This module defines the SoakTest class, which drives the ChatGPT wrapper and the batch loop (the
+BatchEngine and the ResultStore, as the UI uses them) against a local MockBackend for a large number of
+requests, with injected failures and periodic resets. Along the way it samples the memory of the process and
+its browsers, the open file descriptors, the browser processes and the latency, and at the end it fails when
+one of them grew past its threshold. Leaks only show after hours of batch, this is how to find them in minutes.
+"""
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from .batch_engine import BatchEngine, BatchTask
+from .chatgpt_wrapper import ChatGPT
+from .job_queue import Job
+from .mock_backend import MockBackend
+from .result_store import ResultStore
+
+
+def _proc_children(pid):
+    """
+    Lists the descendants of a process from /proc, when psutil is not installed.
+    """
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as f:
+                # The name of the process is in parentheses and may contain spaces
+                parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    children, todo = [], [pid]
+    while len(todo) > 0:
+        parent = todo.pop()
+        for child, child_parent in parents.items():
+            if child_parent == parent:
+                children.append(child)
+                todo.append(child)
+    return children
+
+
+def _proc_rss(pid):
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def process_stats():
+    """
+    Measures this process and the browsers it started.
+
+    :return: a dict with the rss (bytes, this process plus its children), fds (open file descriptors of this
+        process) and browsers (number of child processes)
+    """
+    if psutil is not None:
+        process = psutil.Process()
+        children = process.children(recursive=True)
+        rss = process.memory_info().rss
+        for child in children:
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                continue
+        fds = process.num_fds() if hasattr(process, "num_fds") else process.num_handles()
+        return {"rss": rss, "fds": fds, "browsers": len(children)}
+    pid = os.getpid()
+    children = _proc_children(pid)
+    return {"rss": _proc_rss(pid) + sum(_proc_rss(child) for child in children),
+            "fds": len(os.listdir("/proc/self/fd")),
+            "browsers": len(children)}
+
+
+class _SoakSession:
+    """
+    A ChatGPT session which times its questions and resets itself every reset_every questions.
+    """
+
+    def __init__(self, session, test):
+        self.session = session
+        self.test = test
+        self.asked = 0
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def ask(self, message, conversation_id="", parent_message_id=""):
+        if self.test.reset_every and self.asked > 0 and self.asked % self.test.reset_every == 0:
+            self.session.reset()
+            self.test.count("resets")
+        self.asked += 1
+        start = time.time()
+        answer = self.session.ask(message, conversation_id, parent_message_id)
+        self.test.record_latency(time.time() - start)
+        return answer
+
+    def reset(self):
+        self.test.count("resets")
+        self.session.reset()
+
+
+class SoakTest:
+    """
+    Runs many requests through the batch engine against a MockBackend and checks the resources stay flat.
+    """
+    # The latency of a window is compared with the one of the first window
+    LATENCY_WINDOW = 500
+    # The mock answers in milliseconds, so a stalled stream is given up on quickly
+    IDLE_TIMEOUT = 2
+
+    def __init__(self, requests=100000, workers=2, batch_size=1000, failure_rate=0.01, reset_every=1000,
+                 sample_every=30, max_rss_growth=256, max_fd_growth=64, max_browsers=None, max_latency_drift=2.0,
+                 report_path=None, headless=True):
+        """
+        :param requests: the number of questions to ask
+        :param workers: the number of parallel sessions
+        :param batch_size: the number of questions of a batch, the result is compacted after every batch
+        :param failure_rate: the share of the requests the mock backend fails
+        :param reset_every: reset a session every this many questions, 0 to only reset on failures
+        :param sample_every: the seconds between two samples
+        :param max_rss_growth: the most MB the memory may grow after the first batch
+        :param max_fd_growth: the most file descriptors which may open after the first batch
+        :param max_browsers: the most browser processes at any time, 16 per worker by default
+        :param max_latency_drift: the most the median latency may grow, as a ratio of the first window
+        :param report_path: the JSON lines file the samples are written to, or None
+        :param headless: whether the browsers are headless
+        """
+        self.requests = requests
+        self.workers = workers
+        self.batch_size = batch_size
+        self.failure_rate = failure_rate
+        self.reset_every = reset_every
+        self.sample_every = sample_every
+        self.max_rss_growth = max_rss_growth * 1024 * 1024
+        self.max_fd_growth = max_fd_growth
+        self.max_browsers = max_browsers or 16 * workers
+        self.max_latency_drift = max_latency_drift
+        self.report_path = report_path
+        self.headless = headless
+        self.samples = []
+        self.counters = {"answered": 0, "failed": 0, "resets": 0}
+        self._latencies = []
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def record_latency(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def _window_latency(self, end=None):
+        with self._lock:
+            window = self._latencies[-self.LATENCY_WINDOW:] if end is None else self._latencies[:end]
+        return statistics.median(window) if len(window) > 0 else None
+
+    def sample(self, start_time):
+        """
+        Takes a sample of the resources and the latency, and writes it to the report.
+        """
+        sample = dict(process_stats())
+        sample.update(self.counters)
+        sample["elapsed"] = time.time() - start_time
+        sample["latency"] = self._window_latency()
+        self.samples.append(sample)
+        if self.report_path is not None:
+            with open(self.report_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(sample) + "\n")
+        print("[soak] %(elapsed).0fs answered=%(answered)d failed=%(failed)d resets=%(resets)d "
+              "rss=%(rss)d fds=%(fds)d browsers=%(browsers)d latency=%(latency)s" % sample)
+        return sample
+
+    def check(self):
+        """
+        Compares the samples with the thresholds.
+
+        :return: the list of the thresholds exceeded, empty when the test passed
+        """
+        failures = []
+        if len(self.samples) < 2:
+            return ["Not enough samples to judge, run more requests"]
+        baseline, last = self.samples[0], self.samples[-1]
+        rss_growth = last["rss"] - baseline["rss"]
+        if rss_growth > self.max_rss_growth:
+            failures.append("The memory grew by %.0f MB" % (rss_growth / 1024 / 1024))
+        fd_growth = last["fds"] - baseline["fds"]
+        if fd_growth > self.max_fd_growth:
+            failures.append("%d more file descriptors are open" % fd_growth)
+        browsers = max(sample["browsers"] for sample in self.samples)
+        if browsers > self.max_browsers:
+            failures.append("%d browser processes were running" % browsers)
+        first_latency = self._window_latency(self.LATENCY_WINDOW)
+        last_latency = self._window_latency()
+        if first_latency and last_latency and last_latency / first_latency > self.max_latency_drift:
+            failures.append("The median latency went from %.2fs to %.2fs" % (first_latency, last_latency))
+        return failures
+
+    def run(self):
+        """
+        Runs the soak test.
+
+        :return: the list of the thresholds exceeded, empty when the test passed
+        """
+        backend = MockBackend(failure_rate=self.failure_rate).start()
+        engine = BatchEngine(
+            session_factory=lambda profile: _SoakSession(
+                ChatGPT(shared=False, profile=profile, base_url=backend.url, headless=self.headless,
+                        idle_timeout=self.IDLE_TIMEOUT), self),
+            waiting_time=0)
+        engine.ensure_workers(self.workers, profiles=("soak",))
+        job = Job(user="soak", prompt_id="soak")
+        start_time = last_sample = time.time()
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                store = ResultStore(folder, "soak", ["input", "result"])
+                for batch_start in range(0, self.requests, self.batch_size):
+                    count = min(self.batch_size, self.requests - batch_start)
+                    tasks = [BatchTask(batch_start + index, "question %d" % (batch_start + index))
+                             for index in range(count)]
+                    for task in engine.run(tasks, job):
+                        if task.error is not None or task.answer is None:
+                            self.count("failed")
+                        else:
+                            self.count("answered")
+                        store.append([{"input": task.prompt, "result": task.answer}])
+                        if time.time() - last_sample >= self.sample_every:
+                            self.sample(start_time)
+                            last_sample = time.time()
+                    # The first batch warms up the browsers and the caches, it is the baseline
+                    if batch_start == 0:
+                        self.samples = []
+                        self.sample(start_time)
+                        last_sample = time.time()
+                # Folded once, like at the end of a job, compacting every batch would rewrite the result each time
+                store.compact()
+                self.sample(start_time)
+        finally:
+            engine.close()
+            backend.stop()
+        failures = self.check()
+        print("[soak] %s" % ("passed" if len(failures) == 0 else "failed: " + "; ".join(failures)))
+        return failures
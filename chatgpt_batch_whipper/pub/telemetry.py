@@ -0,0 +1,272 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+BatchTelemetry: the progress of a batch job.
+Author: CodeDigger
+Description: This module defines the BatchTelemetry class, which counts the rows of a batch job by state (pending,
+queued, in flight, done, failed, cached), measures the rows answered per second over rolling windows, estimates the time
+left including the pauses of the rate limits, and tells the time the workers spent waiting against working. The
+same numbers are shown by the UI, written to a status JSON file next to the result for the command line and other
+tools, and served by the coordinator of a distributed job.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+STATES = ("pending", "queued", "in_flight", "done", "failed", "cached")
+
+
+def status_path(folder, result_no):
+    """
+    :param folder: the folder of the result files
+    :param result_no: the number of the result
+    :return: the path of the status file of the batch job of a result
+    """
+    return os.path.join(folder, "%s.status.json" % result_no)
+
+
+def read_status(path):
+    """
+    Reads a status file.
+
+    :param path: the status file
+    :return: the status dict written by BatchTelemetry, or None when there is none
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _duration(seconds):
+    if seconds is None:
+        return "-"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh %02dm" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm %02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+def format_status(status):
+    """
+    Formats a status in one line, e.g. for the UI or the command line.
+
+    :param status: the dict of BatchTelemetry.snapshot
+    :return: str
+    """
+    counts = status["counts"]
+    # The status files written before the queued rows were counted apart have no queued count
+    queued = counts.get("queued", 0)
+    finished = status["total"] - counts["pending"] - queued - counts["in_flight"]
+    text = ("%d/%d rows | %.2f rows/s (1m) | ETA %s | queued %d | in flight %d | failed %d | cached %d | "
+            "waited %s, worked %s") % (
+        finished, status["total"], status["rates"]["60"], _duration(status["eta"]), queued, counts["in_flight"],
+        counts["failed"], counts["cached"], _duration(status["waiting"]), _duration(status["working"]))
+    if status["blocked_for"] > 0:
+        text += " | paused by the rate limits for %s" % _duration(status["blocked_for"])
+    return text
+
+
+class BatchTelemetry:
+    """
+    The counts, the rates and the ETA of a batch job. The counts are of input rows, so a question answering several
+    identical rows moves all of them. The submitted rows are queued until a worker of the engine takes their task,
+    then in flight until their answer comes back.
+    """
+    # The rolling windows of the rates, in seconds
+    WINDOWS = (10, 60, 300)
+    # The least seconds between two writes of the status file
+    WRITE_EVERY = 1.0
+
+    def __init__(self, total, engine=None, path=None, done=0, job=None, rows=None):
+        """
+        :param total: the number of rows of the job
+        :param engine: the BatchEngine of the job, for the waiting and working times and the rate limit pauses
+        :param path: the status file to write, or None
+        :param done: the rows done before the job started, e.g. by a previous run
+        :param job: the Job of the engine the rows are submitted with, for the tasks taken by the workers, or None
+        :param rows: a callable giving the number of rows of a task key, 1 per task by default
+        """
+        self.total = total
+        self.engine = engine
+        self.path = path
+        self.job = job
+        self.rows = rows or (lambda key: 1)
+        self.counts = dict.fromkeys(STATES, 0)
+        self.counts["pending"] = total - done
+        self.counts["done"] = done
+        self.start_time = time.time()
+        self.finished = False
+        self._answered = deque()
+        self._engine_start = engine.timings() if engine is not None else None
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def move(self, rows, from_state, to_state):
+        """
+        Moves rows from a state to another.
+
+        :param rows: the number of rows
+        :param from_state: one of STATES
+        :param to_state: one of STATES
+        """
+        with self._lock:
+            self.counts[from_state] -= rows
+            self.counts[to_state] += rows
+
+    def set_counts(self, **counts):
+        """
+        Sets the counts of some states, for a caller which tracks the states itself, e.g. the coordinator.
+        """
+        with self._lock:
+            self.counts.update(counts)
+
+    def submitted(self, rows=1):
+        self.move(rows, "pending", "queued")
+
+    def cached(self, rows=1):
+        self.move(rows, "pending", "cached")
+
+    def answered(self, rows=1, failed=False):
+        self.move(rows, "queued", "failed" if failed else "done")
+        self.record(rows)
+
+    def current_counts(self):
+        """
+        :return: the dict of the counts by state, the submitted rows whose task a worker has taken in flight
+        """
+        with self._lock:
+            counts = dict(self.counts)
+        if self.job is not None:
+            taken = sum(self.rows(task.key) for task in self.job.running.copy())
+            taken = min(taken, counts["queued"])
+            counts["queued"] -= taken
+            counts["in_flight"] += taken
+        return counts
+
+    def record(self, rows=1):
+        """
+        Counts rows answered now, for the rates.
+
+        :param rows: the number of rows
+        """
+        now = time.time()
+        with self._lock:
+            self._answered.append((now, rows))
+            while self._answered[0][0] < now - max(self.WINDOWS):
+                self._answered.popleft()
+
+    def rate(self, window):
+        """
+        Returns the rows answered per second over the last seconds. The rate is measured on the wall clock, so the
+        pauses of the rate limits within the window lower it.
+
+        :param window: the seconds to look back
+        :return: float
+        """
+        now = time.time()
+        window = min(window, max(now - self.start_time, 1e-3))
+        with self._lock:
+            rows = sum(count for answered_time, count in self._answered if answered_time >= now - window)
+        return rows / window
+
+    def blocked_for(self):
+        """
+        :return: the seconds until an account of the engine can ask again, 0 when one can ask now
+        """
+        return self.engine.blocked_for() if self.engine is not None else 0.0
+
+    def eta(self):
+        """
+        Estimates the seconds left: the pause of the rate limits going on, plus the rows left at the rate of the
+        longest window.
+
+        :return: float, or None before the first answer
+        """
+        left = self.counts["pending"] + self.counts["queued"] + self.counts["in_flight"]
+        if left == 0:
+            return 0.0
+        rate = self.rate(max(self.WINDOWS))
+        if rate <= 0:
+            return None
+        return self.blocked_for() + left / rate
+
+    def snapshot(self):
+        """
+        :return: a JSON-able dict of the progress, see format_status
+        """
+        waiting = working = 0.0
+        if self.engine is not None:
+            timings = self.engine.timings()
+            waiting = timings["waiting"] - self._engine_start["waiting"]
+            working = timings["working"] - self._engine_start["working"]
+        return {"total": self.total,
+                "counts": self.current_counts(),
+                "rates": {str(window): self.rate(window) for window in self.WINDOWS},
+                "eta": self.eta(),
+                "elapsed": time.time() - self.start_time,
+                "waiting": waiting,
+                "working": working,
+                "blocked_for": self.blocked_for(),
+                "finished": self.finished,
+                "updated": time.time()}
+
+    def format(self):
+        return format_status(self.snapshot())
+
+    def fraction(self):
+        """
+        :return: the share of the rows not pending, queued nor in flight, between 0 and 1
+        """
+        if self.total == 0:
+            return 1.0
+        left = self.counts["pending"] + self.counts["queued"] + self.counts["in_flight"]
+        return min(1.0, max(0.0, 1 - left / self.total))
+
+    def write(self, force=False):
+        """
+        Writes the status file, at most every WRITE_EVERY seconds unless forced.
+
+        :param force: whether to write even if the last write is recent
+        """
+        if self.path is None or (not force and time.time() - self._written < self.WRITE_EVERY):
+            return
+        self._written = time.time()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        """
+        Marks the job finished and writes the last status.
+        """
+        self.finished = True
+        self.write(force=True)
@@ -0,0 +1,126 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+PromptTemplate: the templates of the batch prompts.
+Author: CodeDigger
+Description: This module defines the PromptTemplate class. A saved prompt can reference the input columns by
+name, e.g. "Translate {{title}} and {{description}}". The template is compiled once per job into its literal
+parts and its fields, then rendered for the whole input frame at once with vectorised string concatenation.
+Only the names of existing columns are fields, any other brace in the prompt is plain text, and the values are
+never formatted, so braces in the prompt or in the data are always safe.
+A prompt without fields keeps the old behaviour: the value of the target column is appended to it.
+"""
+import hashlib
+import json
+import re
+
+import pandas as pd
+
+_FIELD = re.compile(r"\{\{\s*([^{}]+?)\s*\}\}")
+
+
+class PromptTemplate:
+    """
+    A prompt compiled into literal parts and input fields.
+    """
+    # What a prompt without fields is followed by, before the input
+    INPUT_SEPARATOR = "\n\t\t"
+
+    def __init__(self, text, columns=None, default_column=None):
+        """
+        :param text: the prompt text
+        :param columns: the columns of the input, only their names are fields, or None to take every {{name}}
+        :param default_column: the column appended to a prompt without fields, None when only render_input is used
+        """
+        self.text = text
+        self.literals = []
+        self.fields = []
+        start = 0
+        for match in _FIELD.finditer(text):
+            name = match.group(1)
+            if columns is not None and name not in columns:
+                continue
+            self.literals.append(text[start:match.start()])
+            self.fields.append(name)
+            start = match.end()
+        self.literals.append(text[start:])
+        if len(self.fields) == 0:
+            self.literals = [text + self.INPUT_SEPARATOR, ""]
+            self.fields = [default_column]
+        # The distinct fields, in the order of their first use
+        self.columns = list(dict.fromkeys(self.fields))
+        # A hash of the compiled prompt, it changes with the prompt text or its fields, e.g. so only the answers
+        # to the same prompt are reused
+        compiled = json.dumps([self.literals, self.fields], ensure_ascii=False)
+        self.key = hashlib.sha1(compiled.encode("utf-8")).hexdigest()[:16]
+
+    def inputs(self, data):
+        """
+        Returns the input of every row: the value of the field when there is one, otherwise the values of the
+        fields as a JSON object. It is what the result keeps and what identical rows are found by.
+
+        :param data: the input DataFrame
+        :return: a list
+        """
+        if len(self.columns) == 1:
+            return data[self.columns[0]].tolist()
+        values = data[self.columns]
+        # One dumps per row: splitting a JSON lines text would also split on the line breaks of unicode,
+        # e.g. U+2028, which stay raw inside the values
+        records = values.astype(object).where(values.notna(), None).to_dict("records")
+        return [json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) for record in records]
+
+    def render(self, data):
+        """
+        Renders the prompt of every row of a DataFrame.
+
+        :param data: the input DataFrame
+        :return: a list of str
+        """
+        rendered = pd.Series(self.literals[0], index=data.index, dtype=object)
+        for field, literal in zip(self.fields, self.literals[1:]):
+            rendered = rendered + data[field].fillna("").astype(str) + literal
+        return rendered.tolist()
+
+    def render_input(self, input_text):
+        """
+        Renders the prompt of one input, as returned by inputs, e.g. to redo a row of the result.
+
+        :param input_text: the input
+        :return: str
+        """
+        if len(self.columns) == 1:
+            values = {self.columns[0]: input_text}
+        else:
+            try:
+                values = json.loads(input_text)
+            except (TypeError, ValueError):
+                values = {}
+        parts = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            value = values.get(field)
+            parts.append("" if value is None or value != value else str(value))
+            parts.append(literal)
+        return "".join(parts)
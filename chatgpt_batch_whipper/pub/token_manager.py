@@ -0,0 +1,139 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+TokenManager: the lifecycle of the ChatGPT session token.
+Author: CodeDigger
+Description: This module defines the TokenManager class, which keeps the session of a browser profile (and its
+accessToken) for all the ChatGPT instances and worker threads using that profile. It reads when the token
+expires and has it refreshed ahead of time, while the current token is still valid, so a request never goes
+out with an expired token.
+"""
+import base64
+import json
+import threading
+import time
+from datetime import datetime
+
+
+class TokenManager:
+    """
+    The session of one browser profile, shared by every page using that profile.
+    """
+    # Refresh the token this many seconds before it expires
+    REFRESH_MARGIN = 10 * 60
+    # Used when the session tells nothing about its expiry
+    DEFAULT_LIFETIME = 60 * 60
+    _managers = {}
+    _managers_lock = threading.Lock()
+
+    def __init__(self):
+        self.session = None
+        self.expires_at = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_profile(cls, profile):
+        """
+        Returns the TokenManager of a browser profile.
+
+        :param profile: the name or the directory of the profile
+        :return: the TokenManager
+        """
+        with cls._managers_lock:
+            if profile not in cls._managers:
+                cls._managers[profile] = cls()
+            return cls._managers[profile]
+
+    @staticmethod
+    def _jwt_expiry(token):
+        """
+        Reads the "exp" claim of a JWT access token.
+
+        :return: the expiry as a timestamp, or None
+        """
+        try:
+            payload = token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+        except Exception:
+            return None
+
+    @classmethod
+    def parse_expiry(cls, session):
+        """
+        Reads when a session expires, from the "exp" claim of its accessToken and its "expires" field.
+
+        :param session: the session returned by /api/auth/session
+        :return: the expiry as a timestamp
+        """
+        expiries = []
+        if "accessToken" in session:
+            token_expiry = cls._jwt_expiry(session["accessToken"])
+            if token_expiry is not None:
+                expiries.append(token_expiry)
+        if "expires" in session:
+            try:
+                expiries.append(datetime.strptime(session["expires"].replace("Z", "+0000"),
+                                                  "%Y-%m-%dT%H:%M:%S.%f%z").timestamp())
+            except ValueError:
+                pass
+        return min(expiries) if len(expiries) > 0 else time.time() + cls.DEFAULT_LIFETIME
+
+    def _valid(self, now):
+        return self.session is not None and "accessToken" in self.session and now < self.expires_at
+
+    def get(self, fetch):
+        """
+        Returns a valid session. When the token is about to expire, one caller refreshes it with its own page
+        while the other callers keep using the current token.
+
+        :param fetch: a callable returning a new session, or None when it could not get one
+        :return: the session
+        """
+        now = time.time()
+        if self._valid(now) and now < self.expires_at - self.REFRESH_MARGIN:
+            return self.session
+        # Without a valid token everyone waits for the refresh, otherwise only one caller refreshes
+        if not self._lock.acquire(blocking=not self._valid(now)):
+            return self.session
+        try:
+            if self.session is None or time.time() >= self.expires_at - self.REFRESH_MARGIN:
+                session = fetch()
+                if session is not None:
+                    self.session = session
+                    self.expires_at = self.parse_expiry(session)
+            return self.session
+        finally:
+            self._lock.release()
+
+    def invalidate(self, session):
+        """
+        Marks a session as expired, e.g. after the server refused its token.
+
+        :param session: the session which was refused, a newer session is kept
+        """
+        with self._lock:
+            if self.session is session:
+                self.expires_at = 0.0
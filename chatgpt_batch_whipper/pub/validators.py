@@ -0,0 +1,254 @@
+"""
+MIT License
+
+Copyright (c) 2023, CodeDigger
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+---
+
+Validators: reply validation for batch jobs.
+Author: CodeDigger
+Description: This module defines the output validators used by the batch job to decide whether a reply from
+ChatGPT has the expected shape (CSV with a fixed number of columns, a regex, a JSON document), and a
+ValidationStage which runs them off the submission thread and collects failed rows into a repair queue.
+"""
+import csv
+import io
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
+
+
+class OutputValidator:
+    """
+    Accepts any non-empty reply. Base class of all the validators.
+    """
+    name = "any"
+    REPAIR_PROMPT = "%s\n\nDo not include any explanation in your reply."
+
+    def validate(self, answer):
+        """
+        Checks a reply.
+
+        :param answer: the reply from ChatGPT
+        :return: True if the reply is acceptable
+        """
+        return answer is not None and len(answer.strip()) > 0
+
+    def repair_prompt(self, prompt_text):
+        """
+        Builds the prompt used to ask again for a reply that failed the validation.
+
+        :param prompt_text: the prompt of the failed row, rendered with its input
+        :return: the prompt text
+        """
+        return self.REPAIR_PROMPT % prompt_text
+
+
+class CsvColumnValidator(OutputValidator):
+    """
+    Accepts a reply which is a CSV where every line has the same number of fields.
+    """
+    name = "csv"
+
+    def __init__(self, columns=None, delimiter=","):
+        """
+        :param columns: the expected number of fields per line, or None to only require the lines to agree
+        :param delimiter: the CSV delimiter
+        """
+        self.columns = columns
+        self.delimiter = delimiter
+
+    def validate(self, answer):
+        if not super().validate(answer):
+            return False
+        try:
+            rows = [row for row in csv.reader(io.StringIO(answer.strip()), delimiter=self.delimiter, strict=True)
+                    if len(row) > 0]
+        except csv.Error:
+            return False
+        if len(rows) == 0:
+            return False
+        columns = self.columns if self.columns is not None else len(rows[0])
+        return all(len(row) == columns for row in rows)
+
+
+class RegexValidator(OutputValidator):
+    """
+    Accepts a reply which fully matches a regular expression.
+    """
+    name = "regex"
+
+    def __init__(self, pattern):
+        """
+        :param pattern: the regular expression the whole reply has to match
+        """
+        try:
+            self.pattern = re.compile(pattern, re.DOTALL)
+        except re.error as error:
+            raise ValueError("Invalid regex: %s" % error) from error
+
+    def validate(self, answer):
+        return super().validate(answer) and self.pattern.fullmatch(answer.strip()) is not None
+
+
+class JsonSchemaValidator(OutputValidator):
+    """
+    Accepts a reply which is a JSON document matching a JSON schema.
+    The schema is checked with jsonschema when it is installed, otherwise only the
+    top level "type" and "required" keywords are checked.
+    """
+    name = "json"
+    REPAIR_PROMPT = "%s\n\nReply with JSON only, without any explanation."
+    JSON_TYPES = {"object": dict, "array": list, "string": str, "number": (int, float), "integer": int,
+                  "boolean": bool, "null": type(None)}
+
+    def __init__(self, schema=None):
+        """
+        :param schema: the JSON schema as a dict, or None to accept any JSON document
+        :raise ValueError: when the schema is not a valid JSON schema
+        """
+        self.schema = schema or {}
+        if not isinstance(self.schema, dict):
+            raise ValueError("Invalid JSON schema: it has to be a JSON object")
+        if jsonschema is not None:
+            # Checked once here, an invalid schema would otherwise fail every validation in the thread pool
+            try:
+                jsonschema.validators.validator_for(self.schema).check_schema(self.schema)
+            except jsonschema.SchemaError as error:
+                raise ValueError("Invalid JSON schema: %s" % error.message) from error
+
+    def validate(self, answer):
+        if not super().validate(answer):
+            return False
+        try:
+            document = json.loads(answer.strip())
+        except ValueError:
+            return False
+        if jsonschema is not None:
+            try:
+                jsonschema.validate(document, self.schema)
+                return True
+            except jsonschema.ValidationError:
+                return False
+        schema_type = self.schema.get("type")
+        expected_type = self.JSON_TYPES.get(schema_type)
+        if expected_type is not None and not isinstance(document, expected_type):
+            return False
+        # A bool is an int in python, but not a number in JSON
+        if schema_type in ("number", "integer") and isinstance(document, bool):
+            return False
+        required = self.schema.get("required", [])
+        return len(required) == 0 or (isinstance(document, dict) and all(key in document for key in required))
+
+
+def build_validator(spec):
+    """
+    Builds a validator from the spec typed in the UI.
+
+    Supported specs:
+        "" or "any"          -> OutputValidator
+        "csv" or "csv:3"     -> CsvColumnValidator, optionally with the number of columns
+        "regex:<pattern>"    -> RegexValidator
+        "json" or "json:{}"  -> JsonSchemaValidator, optionally with the schema
+
+    :param spec: the validator spec
+    :return: an OutputValidator
+    """
+    spec = (spec or "").strip()
+    name, _, arg = spec.partition(":")
+    name = name.strip().lower()
+    if name in ("", OutputValidator.name):
+        return OutputValidator()
+    if name == CsvColumnValidator.name:
+        return CsvColumnValidator(int(arg) if len(arg.strip()) > 0 else None)
+    if name == RegexValidator.name:
+        return RegexValidator(arg)
+    if name == JsonSchemaValidator.name:
+        try:
+            schema = json.loads(arg) if len(arg.strip()) > 0 else None
+        except ValueError as error:
+            raise ValueError("Invalid JSON schema: %s" % error) from error
+        return JsonSchemaValidator(schema)
+    raise ValueError("Unknown validator: %s" % spec)
+
+
+class ValidationStage:
+    """
+    Validates replies in a thread pool so the submission loop never waits on it.
+    Rows which fail the validation end up in the repair queue.
+    """
+
+    def __init__(self, validator, workers=2):
+        """
+        :param validator: the OutputValidator to use
+        :param workers: the number of validation threads
+        """
+        self.validator = validator
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = []
+        self._repair_queue = []
+
+    def check(self, key, input_text, answer):
+        """
+        Queues a reply for validation and returns immediately.
+
+        :param key: the id of the reply, e.g. the index of the row or the key of the input
+        :param input_text: the input of the row
+        :param answer: the reply to validate
+        """
+        self._pending.append((key, input_text, self._executor.submit(self.validator.validate, answer)))
+        self.collect()
+
+    def collect(self):
+        """
+        Moves the validations done to the repair queue, without waiting for the others.
+        Only the replies which failed are kept, so the stage holds no more than the validations in flight.
+        """
+        done = 0
+        # Stops at the first validation in flight, so the repair queue keeps the order of the replies
+        for key, input_text, future in self._pending:
+            if not future.done():
+                break
+            if not future.result():
+                self._repair_queue.append((key, input_text))
+            done += 1
+        del self._pending[:done]
+
+    def drain(self):
+        """
+        Waits for the queued validations.
+
+        :return: the repair queue, a list of (key, input_text) of the replies which failed
+        """
+        for key, input_text, future in self._pending:
+            if not future.result():
+                self._repair_queue.append((key, input_text))
+        repair_queue, self._repair_queue = self._repair_queue, []
+        self._pending = []
+        return repair_queue
+
+    def close(self):
+        self._executor.shutdown(wait=True)
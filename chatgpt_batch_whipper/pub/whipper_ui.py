@@ -30,6 +30,7 @@ Description: This module defines a UIControl class for Streamlit, which provides
 Disclaimer: This software is provided "as is" and without any express or implied warranties, including, without limitation, the implied warranties of merchantability and fitness for a particular purpose. The author and contributors of this module shall not be liable for any direct, indirect, incidental, special, exemplary, or consequential damages (including, but not limited to, procurement of substitute goods or services; loss of use, data, or profits; or business interruption) however caused and on any theory of liability, whether in contract, strict liability, or tort (including negligence or otherwise) arising in any way out of the use of this software, even if advised of the possibility of such damage.
 """
 import time
+import uuid
 
 import streamlit as st
 from st_aggrid import GridOptionsBuilder, AgGrid, JsCode
@@ -38,15 +39,26 @@ import base64
 import os
 import csv
 from PIL import Image
+import numpy as np
 import pandas as pd
 from .chatgpt_wrapper import ChatGPT
+from .validators import build_validator, ValidationStage
+from .parsers import build_parser, ParseStage
+from .dedup import group_inputs, input_hashes
+from .batch_engine import BatchEngine, BatchTask
+from .job_queue import Job
+from .result_view import ResultView
+from .result_store import NO_INPUT_ROW_ID, ResultStore, format_row_id, input_row_hashes, input_row_ids, row_keys
+from .row_state import RowGroups, RowState
+from .exporter import ResultExporter
+from .telemetry import BatchTelemetry, status_path
+from .templates import PromptTemplate
+from .replay import Recorder, ReplayArchive, ReplaySession
 
 
 class WhipperUI:
-    BOT = None
     TABLE_FONTSIZE = "17px"
     HOME_PATH = "./%s"
-    WAITING_TIME = 10
     PROMPT_PATH = HOME_PATH % "prompt_master.csv"
     ICON_FILE = "icon.png"
     RESULT_FILE = HOME_PATH % "buff/"
@@ -54,6 +66,12 @@ class WhipperUI:
     GPT_INPUT_COL = "input"
     CHECK_COL = "Is false"
     COMMENT_COL = "Comment"
+    ROW_ID_COL = "row_id"
+    # The key of the prompt a row was answered with, see PromptTemplate.key
+    PROMPT_KEY_COL = "prompt_key"
+    PRIORITIES = {"Normal": Job.NORMAL, "High": Job.HIGH, "Low": Job.LOW}
+    # The rows read, hashed or rendered at a time by a batch job
+    CHUNK_SIZE = 10000
     INPUT_FOLD = HOME_PATH % "inputs"
     CHECKBOR_RENDDER = JsCode("""
        class CheckboxRenderer{
@@ -118,10 +136,30 @@ class WhipperUI:
         st.title("Chat GPT batch job")
         self._set_background(self.HOME_PATH % 'background.png')
 
-    def __init__(self):
+    def __init__(self, record_path=None, replay_path=None, replay_speed=1.0):
+        """
+        :param record_path: the archive to record the questions and their answers to, or None
+        :param replay_path: the archive to answer from instead of ChatGPT, or None
+        :param replay_speed: how many times faster than recorded the replayed answers come, 0 for no waiting
+        """
+        self.record_path = record_path
+        self.replay_path = replay_path
+        self.replay_speed = replay_speed
         self._set_up_page()
         return
 
+    def _session_factory(self):
+        """
+        :return: the session factory of the BatchEngine, or None for the default ChatGPT sessions
+        """
+        if self.replay_path is not None:
+            archive = ReplayArchive.get(self.replay_path)
+            return lambda profile: ReplaySession(archive, self.replay_speed, profile)
+        if self.record_path is not None:
+            recorder = Recorder.get(self.record_path)
+            return lambda profile: ChatGPT(shared=False, profile=profile, recorder=recorder)
+        return None
+
     @staticmethod
     def _get_base64(bin_file):
         """
@@ -182,19 +220,23 @@ class WhipperUI:
             # If the file exists, load the data as a pandas DataFrame
             prompts_df = pd.read_csv(self.PROMPT_PATH)
             prompts_df[["conversation_id", "parent_message_id"]].fillna("", inplace=True)
+            if "profile" not in prompts_df.columns:
+                # Prompts saved before the auth profiles were all asked with the default one
+                prompts_df["profile"] = ChatGPT.default_profile
         else:
             # If the file doesn't exist, create an empty DataFrame with the default columns
-            default_columns = ["Date", "No", "prompt", "conversation_id", "parent_message_id"]
+            default_columns = ["Date", "No", "prompt", "conversation_id", "parent_message_id", "profile"]
             prompts_df = pd.DataFrame(columns=default_columns)
 
         return prompts_df
 
-    def _create_table(self, data, check_col=None, comment_col=None, pagesize=100):
+    def _create_table(self, data, check_col=None, comment_col=None, pagesize=100, hidden_cols=()):
         """
         Creates an Ag-Grid table from a pandas DataFrame.
 
         :param data: the pandas DataFrame to use as the data source for the table
         :param comment_col: the name of the column to use for comments, if any
+        :param hidden_cols: the columns kept in the data but not shown
         """
         # Create an Ag-Grid options builder from the pandas DataFrame
         indexs = None
@@ -223,38 +265,28 @@ class WhipperUI:
             gb.configure_column(check_col, editable=True, cellRenderer=self.CHECKBOR_RENDDER)
         if comment_col is not None:
             gb.configure_column(comment_col, editable=True)
+        for hidden_col in hidden_cols:
+            gb.configure_column(hidden_col, hide=True)
 
         grid_options = gb.build()
         grid_options['getRowStyle'] = self.DEFAULT_CELL_JS
         result = AgGrid(data, gridOptions=grid_options, enable_enterprise_modules=True, allow_unsafe_jscode=True)[
             "data"]
         if indexs is not None:
-            result["index"] = indexs
+            # The grid gives the rows back in the order they were given
+            result["index"] = indexs.to_numpy()
         return result
 
-    def _load_result(self, result_no):
+    def _result_store(self, result_no):
         """
-        Loads the result data from a CSV file.
+        Returns the ResultStore of a result.
 
-        :param result_no: the number of the result to load
-        :return: a pandas DataFrame containing the result data
+        :param result_no: the number of the result
+        :return: a ResultStore
         """
-        # Create the result file directory if it doesn't exist
-        if not os.path.exists(self.RESULT_FILE):
-            os.makedirs(self.RESULT_FILE)
-
-        # Construct the file path for the specified result number
-        file_path = os.path.join(self.RESULT_FILE, f"{result_no}.csv")
-
-        if os.path.isfile(file_path):
-            # If the file exists, load the data as a pandas DataFrame
-            result_df = pd.read_csv(file_path)
-        else:
-            # If the file doesn't exist, create an empty DataFrame with the default columns
-            default_columns = [self.GPT_RESULT_COL, self.GPT_INPUT_COL, self.CHECK_COL, self.COMMENT_COL]
-            result_df = pd.DataFrame(columns=default_columns)
-
-        return result_df
+        default_columns = [self.GPT_RESULT_COL, self.GPT_INPUT_COL, self.CHECK_COL, self.COMMENT_COL,
+                           self.ROW_ID_COL, self.PROMPT_KEY_COL]
+        return ResultStore(self.RESULT_FILE, result_no, default_columns)
 
     @staticmethod
     def _list_prompts(prompts_df):
@@ -318,11 +350,12 @@ class WhipperUI:
     def reformat_back(text):
         """
         Replaces a placeholder string with newline characters.
+        Only the placeholder is replaced, so the other braces of the text are kept as they are.
 
         :param text: the text to reformat
         :return: the reformatted text
         """
-        return text.format(pun="\n")
+        return text.replace("{pun}", "\n")
 
     def on_set(self, prompt_no, prompt_text):
         """
@@ -353,19 +386,18 @@ class WhipperUI:
 
         :param result_no: the number of the result to delete the cache file for
         """
-        cache_name = os.path.join(self.RESULT_FILE, f"{result_no}.csv")
         try:
-            os.remove(cache_name)
+            self._result_store(result_no).delete()
         except OSError as error:
             print(f"An error occurred: {error}")
 
-    def on_auth(self):
+    def on_auth(self, profile=ChatGPT.default_profile):
         """
-        Deletes a cache file for a specified result number.
+        Opens a browser to log in to ChatGPT with an auth profile.
 
-        :param result_no: the number of the result to delete the cache file for
+        :param profile: the name of the auth profile
         """
-        ChatGPT(headless=False)
+        ChatGPT(headless=False, profile=profile or ChatGPT.default_profile)
 
     def on_delete_prompt(self, prompt_no):
         """
@@ -390,16 +422,21 @@ class WhipperUI:
         except csv.Error:
             return False
 
-    def save_review_data(self, data, no):
+    def _result_view(self, result_no):
         """
-        Saves a DataFrame with checked results to a cache file.
+        Returns the ResultView of a result, kept in the session so a rerun only reads the result again when it
+        changed on disk.
 
-        :param data: the DataFrame with checked results to save
-        :param result_no: the number of the result to save the checked data for
+        :param result_no: the number of the result
+        :return: a ResultView
         """
-        cache_name = ("%s%s.csv") % (self.RESULT_FILE, no)
-        data[self.CHECK_COL] = [True if s == True else False for s in data[self.CHECK_COL]]
-        data.to_csv(cache_name, encoding='utf-8-sig', index=False)
+        view = st.session_state.get("result_view")
+        if view is None or view.result_no != result_no:
+            view = ResultView(self._result_store(result_no), result_no, self.CHECK_COL, self.COMMENT_COL)
+            st.session_state["result_view"] = view
+        elif view.stale():
+            view.reload()
+        return view
 
     def _load_saved_input_data(self, selected_prompt_no):
         if selected_prompt_no is not None:
@@ -409,131 +446,520 @@ class WhipperUI:
                 pass
         return None
 
-    def _update_reviewdata(self, data_old, data_new):
-        data_new = data_new[[self.CHECK_COL, self.COMMENT_COL]]
-        result = data_old.join(data_new, how="left", rsuffix='_new')
-        result = result.fillna("")
-        new_checks = []
-        new_comments = []
-        new_check_col = self.CHECK_COL + '_new'
-        new_comment_col = self.COMMENT_COL + '_new'
-        for i, row in result.iterrows():
-            if row[new_check_col] == row[new_check_col]:
-                new_checks += [row[new_check_col]]
-            else:
-                new_checks += [row[self.CHECK_COL]]
-            if row[new_comment_col] == row[new_comment_col]:
-                new_comments += [row[new_comment_col]]
-            else:
-                new_comments += [row[self.COMMENT_COL]]
-        result[self.CHECK_COL] = new_checks
-        result[self.COMMENT_COL] = new_comments
-        result = result.drop([new_check_col, new_comment_col], axis=1)
-        return result
+    def _batch_tasks(self, template, groups, conversation, rendered=None):
+        """
+        Builds one BatchTask per distinct input.
+
+        :param template: the PromptTemplate of the prompt
+        :param groups: a dict of input key to (input text, row indexes), see dedup.group_inputs
+        :param conversation: the (conversation id, parent message id, auth profile) of the prompt
+        :param rendered: a dict of row id to its rendered prompt, otherwise the prompts are rendered from the inputs
+        :return: a list of BatchTask
+        """
+        if rendered is not None:
+            return [BatchTask(key, rendered[row_ids[0]], *conversation) for key, (_, row_ids) in groups.items()]
+        return [BatchTask(key, template.render_input(input_text), *conversation)
+                for key, (input_text, _) in groups.items()]
+
+    @staticmethod
+    def _check_task(task):
+        """
+        Reports a task which failed or had to be resubmitted.
 
-    def _submit(self, prompt, conversation_id, parent_message_id):
-        res = self.BOT.ask(prompt)
-        failed = False
-        while res is None:
-            st.error("Process failed  will resubmit it after %d minutes" % (self.WAITING_TIME // 60))
-            st.empty()
-            time.sleep(self.WAITING_TIME)
-            self.BOT.reset()
-            res = self.BOT.ask(prompt,
-                               conversation_id,
-                               parent_message_id)
-            failed = True
-        if failed:
-            st.success("Process resumed!")
-        return res
-
-    def on_do(self, prompt_id, data, target_column, no_explain, do_false_only):
+        :param task: the answered BatchTask
+        :return: False if the task failed and the batch has to stop
+        """
+        if task.error is not None:
+            st.error("Process failed: %s" % task.error)
+            return False
+        if task.retries > 0:
+            st.warning("Process failed and was resubmitted %d times." % task.retries)
+        return True
+
+    def _repair(self, engine, job, store, repair_queue, validator, template, groups, state, conversation,
+                parse_stage=None):
+        """
+        Asks again for the rows which failed the reply validation.
+
+        :param engine: the BatchEngine
+        :param job: the Job of the batch
+        :param store: the ResultStore to update
+        :param repair_queue: a list of (input key, input text) of the inputs to redo
+        :param validator: the OutputValidator the rows failed
+        :param template: the PromptTemplate of the prompt, the inputs are redone with their rendered prompt
+        :param groups: the RowGroups of the inputs of this batch
+        :param state: the RowState of the batch, with the index in the result of every row
+        :param conversation: the (conversation id, parent message id, auth profile) of the prompt
+        :param parse_stage: the ParseStage the redone replies are parsed with, or None
+        """
+        if len(repair_queue) == 0:
+            return
+        tasks = [BatchTask(key, validator.repair_prompt(template.render_input(input_text)), *conversation)
+                 for key, input_text in repair_queue]
+        with st.spinner("Redoing %d replies which failed the validation..." % len(repair_queue)):
+            for task in engine.run(tasks, job):
+                if not self._check_task(task):
+                    break
+                row_indexes = state.result_index[groups.members(task.key)]
+                store.update([(row_index, {self.GPT_RESULT_COL: task.answer, self.CHECK_COL: task.truncated,
+                                           self.PROMPT_KEY_COL: template.key})
+                              for row_index in row_indexes])
+                if parse_stage is not None:
+                    parse_stage.submit(row_indexes, task.answer)
+
+    def _input_hashes(self, template, data, positions):
+        """
+        Hashes the inputs of some rows, a chunk at a time, see dedup.input_hashes.
+
+        :param template: the PromptTemplate of the prompt
+        :param data: the input DataFrame
+        :param positions: the positions of the rows
+        :return: a numpy array of uint64
+        """
+        keys = np.empty(len(positions), dtype=np.uint64)
+        for start in range(0, len(positions), self.CHUNK_SIZE):
+            chunk = positions[start:start + self.CHUNK_SIZE]
+            keys[start:start + len(chunk)] = input_hashes(template.inputs(data.iloc[chunk]))
+        return keys
+
+    def _cached_answers(self, store, groups, template):
+        """
+        Reads the answers a result already has for the inputs of a batch, a chunk at a time.
+        Only the answers to the same prompt are reused: not the rows checked as false, nor the rows answered
+        before the prompt was edited, or before the rows kept the key of their prompt.
+
+        :param store: the ResultStore of the prompt
+        :param groups: the RowGroups of the batch
+        :param template: the PromptTemplate of the prompt
+        :return: a generator of (group, answer)
+        """
+        columns = [self.GPT_INPUT_COL, self.GPT_RESULT_COL, self.CHECK_COL, self.PROMPT_KEY_COL]
+        for chunk in store.iter_chunks(self.CHUNK_SIZE, columns):
+            chunk = chunk[(chunk[self.CHECK_COL] != True) & chunk[self.GPT_RESULT_COL].notna()
+                          & (chunk[self.PROMPT_KEY_COL] == template.key)]
+            found = groups.find(input_hashes(chunk[self.GPT_INPUT_COL]))
+            for group, answer in zip(found[found >= 0], chunk[self.GPT_RESULT_COL].to_numpy()[found >= 0]):
+                yield int(group), answer
+
+    def _adopt_legacy_rows(self, store, processed_data, row_ids):
+        """
+        Gives a row id to the rows of a result written before the results had one, see ResultStore.is_legacy.
+        Those results were resumed by row count, so their rows are matched to the input rows by position.
+
+        :param store: the ResultStore of the result
+        :param processed_data: the result DataFrame
+        :param row_ids: the row ids of the input rows
+        :return: the result DataFrame with the row ids
+        """
+        legacy = self.ROW_ID_COL not in processed_data.columns
+        if legacy:
+            processed_data[self.ROW_ID_COL] = None
+        missing = processed_data[self.ROW_ID_COL].isna()
+        missing &= processed_data.index < len(row_ids)
+        if missing.any():
+            processed_data.loc[missing, self.ROW_ID_COL] = [row_ids[index] for index in processed_data.index[missing]]
+        if legacy or missing.any():
+            # Saved with the column, so the result is not taken as legacy again
+            store.save(processed_data)
+        return processed_data
+
+    def _redo_false(self, engine, job, store, processed_data, template, conversation, parse_stage=None,
+                    status_file=None):
+        """
+        Asks again for the rows checked as false.
+        Only the redone rows are written, and they are unchecked as they are done, so an interrupted redo
+        resumes with the rows left.
+
+        :param engine: the BatchEngine
+        :param job: the Job of the redo
+        :param store: the ResultStore of the prompt
+        :param processed_data: the result DataFrame
+        :param template: the PromptTemplate of the prompt
+        :param conversation: the (conversation id, parent message id, auth profile) of the prompt
+        :param parse_stage: the ParseStage the redone replies are parsed with, or None
+        :param status_file: the status file to write the progress to, or None
+        """
+        condition = processed_data[self.CHECK_COL] == True
+        row_indexs = processed_data[condition].index
+        # Every distinct false input is asked once, and its answer goes to all the rows with that input
+        groups = group_inputs([(row_index, processed_data.at[row_index, self.GPT_INPUT_COL])
+                               for row_index in row_indexs])
+        num = len(groups)
+        telemetry = BatchTelemetry(len(row_indexs), engine, status_file, job=job,
+                                   rows=lambda key: len(groups[key][1]))
+        progress_bar = st.progress(0.0)
+        status_box = st.empty()
+        coalesced = 0
+        truncated = 0
+        tasks = self._batch_tasks(template, groups, conversation)
+        # The tasks are all handed to the engine at once
+        telemetry.submitted(len(row_indexs))
+        for task in engine.run(tasks, job):
+            telemetry.answered(len(groups[task.key][1]), failed=task.error is not None or task.truncated)
+            if not self._check_task(task):
+                break
+            coalesced += task.joined
+            truncated += task.truncated
+            # A cut answer stays false, so the next redo asks it again
+            store.update([(row_index, {self.GPT_RESULT_COL: task.answer, self.CHECK_COL: task.truncated,
+                                       self.PROMPT_KEY_COL: template.key})
+                          for row_index in groups[task.key][1]])
+            if parse_stage is not None:
+                parse_stage.submit(groups[task.key][1], task.answer)
+            self._show_progress(progress_bar, status_box, telemetry)
+        telemetry.close()
+        self._close_parse_stage(parse_stage)
+        store.compact()
+        progress_bar.empty()
+        self._show_saved_requests(len(row_indexs) - num, coalesced)
+        self._show_truncated(truncated)
+
+    def on_do(self, prompt_id, data, target_column, no_explain, do_false_only, validator_spec="csv", workers=1,
+              user="", priority=Job.NORMAL, profiles=None, hourly_cap=None, adaptive=False, parser_spec=""):
         """
         Uses the ChatGPT API to generate responses for prompts in a DataFrame.
 
-        :param prompt: the prompt text to use for generating responses
         :param prompt_id: the id of the prompt
-        :param conversation_id: the id of the conversation
         :param data: the DataFrame with prompts to generate responses for
-        :param target_column: the column of the DataFrame with the prompts to use for generating responses
+        :param target_column: the column of the DataFrame with the inputs, when the prompt references no column
         :param no_explain: whether to prompt the user to avoid including explanations in their responses
+        :param do_false_only: whether to redo only the rows checked as false
+        :param validator_spec: the spec of the validator used to check the replies when no_explain is set
+        :param workers: the number of ChatGPT sessions to submit with in parallel, per account
+        :param user: the name of the user, the sessions are shared fairly between the users
+        :param priority: the priority of the job against the jobs of the other users
+        :param profiles: the auth profiles of the accounts to submit with
+        :param hourly_cap: the most questions an account sends in an hour, or None for no limit
+        :param adaptive: whether the number of sessions in use adapts to the latency and the failures, up to workers
+        :param parser_spec: the spec of the parser which turns the replies into columns, empty to keep them raw
         """
-        if self.BOT is None:
-            with st.spinner('Wait for connect to chatGPT...'):
-                self.BOT = ChatGPT()
+        profiles = profiles or [ChatGPT.default_profile]
+        with st.spinner('Wait for connect to chatGPT...'):
+            engine = BatchEngine.get(workers, profiles, hourly_cap, adaptive, self._session_factory())
+        if any(engine.accounts[profile].hourly_cap != hourly_cap or (profile in engine.limiters) != adaptive
+               for profile in profiles):
+            st.info("The accounts keep the hourly cap and the load adaptation they were started with, "
+                    "the other users may be running jobs on them.")
         prompts_df = self._load_prompts()
         setting = prompts_df[prompts_df["No"] == prompt_id]
 
         if len(setting) == 1:
             prompt = setting['prompt'].values[0]
-            conversation_id = setting['conversation_id'].values[0]
-            parent_message_id = setting['parent_message_id'].values[0]
+            profile = setting['profile'].values[0]
+            # The conversation of the prompt, and the account it lives in
+            conversation = (setting['conversation_id'].values[0],
+                            setting['parent_message_id'].values[0],
+                            profile if profile == profile and len(profile) > 0 else ChatGPT.default_profile)
         else:
             st.error("There is multiple prompts but currently we can only do one.")
             return
         if len(prompt) == 0:
             st.error("There is no prompt to do.")
 
-        cache_name = ("%s%s.csv") % (self.RESULT_FILE, prompt_id)
-        processed_data = self._load_result(prompt_id)
-        if do_false_only:
-            progress_bar = st.progress(0)
-            condition = processed_data[self.CHECK_COL] == True
-            row_indexs = processed_data[condition].index
-            i = 0
-            num = len(row_indexs)
-            for row_index in row_indexs:
-                progress_bar.progress(i * 100 // num)
-                prompt_text = "%s\n\t\t%s" % (prompt, processed_data.at[row_index, self.GPT_INPUT_COL])
-                processed_data.at[row_index, self.GPT_RESULT_COL] = self._submit(prompt_text, conversation_id,
-                                                                                 parent_message_id)
-                processed_data.to_csv(cache_name, encoding='utf-8-sig', index=False)
-                i += 1
-            return
-        if data is not None and target_column is not None:
-            prompts_inputs = [text for text in data[target_column]]
-        else:
-            prompts_inputs = [""]
+        # A redo of the false rows needs no input file, it is a batch all the same
+        single_shoot = not do_false_only and (data is None or target_column is None)
+        # A single shoot goes to the interactive lane so it never waits behind a batch
+        # A single shoot continues the conversation of the prompt, so it stays on the account of the conversation
+        pinned_profile = conversation[2] if single_shoot and conversation[2] in profiles else None
+        job = Job(user, prompt_id, priority, interactive=single_shoot, profile=pinned_profile)
+        store = self._result_store(prompt_id)
+        # Compiled once for the job, the prompt can reference several input columns by name
+        template = PromptTemplate(prompt, data.columns if data is not None else None, target_column)
+        parse_stage = None
+        validator = None
+        validation_stage = None
+        if not single_shoot:
+            try:
+                parser = build_parser(parser_spec)
+                # Only the replies of a new batch are validated, a redo asks the rows checked as false
+                validator = build_validator(validator_spec) if no_explain and not do_false_only else None
+            except ValueError as error:
+                st.error(str(error))
+                return
+            # The replies are parsed in other processes as they come in
+            parse_stage = ParseStage(parser, store) if parser is not None else None
+        try:
+            if do_false_only:
+                self._redo_false(engine, job, store, store.load(), template, conversation, parse_stage,
+                                 status_path(self.RESULT_FILE, prompt_id))
+                return
+            if single_shoot:
+                conversation = self._single_shoot(engine, job, store, prompt, conversation)
+                self._save_conversation(prompts_df, prompt_id, prompt, conversation)
+                return
+            # The job only keeps arrays about its rows, the text is read from the input and the result when needed
+            hashes, occurrences = input_row_hashes(data)
+            state = RowState(len(data))
+            # Only a result without any row id is matched to the input by position, once
+            if store.is_legacy(self.ROW_ID_COL):
+                self._adopt_legacy_rows(store, store.load(), input_row_ids(data))
+            done_keys = store.done_row_keys(self.ROW_ID_COL)
+            # The checkpoint is the set of the input rows already in the result, whatever their order
+            state.mark_done(np.flatnonzero(np.isin(row_keys(hashes, occurrences), done_keys)))
+            del done_keys
+            todo = state.todo()
+            groups = RowGroups(todo, self._input_hashes(template, data, todo))
+            if validator is not None:
+                validation_stage = ValidationStage(validator)
+            telemetry = BatchTelemetry(len(state), engine, status_path(self.RESULT_FILE, prompt_id), state.done(),
+                                       job=job, rows=lambda key: len(groups.members(key)))
+            progress_bar = st.progress(telemetry.fraction())
+            status_box = st.empty()
+
+            def append(group, answer, truncated=False):
+                positions = groups.members(group)
+                inputs = template.inputs(data.iloc[positions])
+                # A cut answer is kept checked as false, so it is not reused and the redo asks it again
+                first = store.append([{self.ROW_ID_COL: format_row_id(hashes[position], occurrences[position]),
+                                       self.GPT_INPUT_COL: input_text, self.GPT_RESULT_COL: answer,
+                                       self.CHECK_COL: truncated, self.PROMPT_KEY_COL: template.key}
+                                      for position, input_text in zip(positions, inputs)])
+                state.mark_done(positions, first)
+                return inputs[0]
+
+            # Every distinct input is asked once, unless an answer of a previous job can be reused
+            groups_hit = 0
+            for group, answer in self._cached_answers(store, groups, template):
+                if state.status[groups.first[group]] == RowState.TODO:
+                    append(group, answer)
+                    groups_hit += 1
+                    telemetry.cached(len(groups.members(group)))
+                    if parse_stage is not None:
+                        parse_stage.submit(state.result_index[groups.members(group)], answer)
+            saved = len(todo) - len(groups) + groups_hit
+            self._show_progress(progress_bar, status_box, telemetry)
+
+            def tasks(asked_conversation):
+                # The prompts are rendered a chunk at a time, as the workers need them
+                for start in range(0, len(groups), self.CHUNK_SIZE):
+                    firsts = groups.first[start:start + self.CHUNK_SIZE]
+                    for offset, prompt_text in enumerate(template.render(data.iloc[firsts])):
+                        if state.status[firsts[offset]] == RowState.TODO:
+                            telemetry.submitted(len(groups.members(start + offset)))
+                            yield BatchTask(start + offset, prompt_text, *asked_conversation)
+
+            coalesced = 0
+            truncated = 0
+            for task in engine.run(tasks(conversation), job, window=4 * engine.workers):
+                telemetry.answered(len(groups.members(task.key)), failed=task.error is not None or task.truncated)
+                if not self._check_task(task):
+                    break
+                coalesced += task.joined
+                truncated += task.truncated
+                conversation = (task.conversation_id, task.parent_message_id, task.profile)
+                input_text = append(task.key, task.answer, task.truncated)
+                if parse_stage is not None:
+                    parse_stage.submit(state.result_index[groups.members(task.key)], task.answer)
+                if validation_stage is not None and not task.truncated:
+                    validation_stage.check(task.key, input_text, task.answer)
+                self._show_progress(progress_bar, status_box, telemetry)
+            telemetry.close()
+            if validation_stage is not None:
+                self._repair(engine, job, store, validation_stage.drain(), validator, template, groups, state,
+                             conversation, parse_stage)
+            self._close_parse_stage(parse_stage)
+            store.compact()
+            self._save_conversation(prompts_df, prompt_id, prompt, conversation)
+            progress_bar.empty()
+            self._show_saved_requests(saved, coalesced)
+            self._show_truncated(truncated)
+            self._show_limit_history(engine)
+        finally:
+            # The pools are shut down however the job ends, e.g. on a failed session or a stopped page
+            if validation_stage is not None:
+                validation_stage.close()
+            if parse_stage is not None:
+                parse_stage.close()
+
+    def _save_conversation(self, prompts_df, prompt_id, prompt, conversation):
+        """
+        Saves the conversation a prompt was last asked in, so the next job of the prompt continues it.
 
-        if data is not None:
-            num = len(data)
-            i = len(processed_data)
-        else:
-            num = 1
-            i = 0
-        bar_index = i * 100 // num
-        progress_bar = st.progress(bar_index)
-        for prompts_input in prompts_inputs[i: ]:
-            prompt_text = "%s\n\t\t%s" % (prompt, prompts_input)
-            res = self._submit(prompt_text, conversation_id, parent_message_id)
-            conversation_id = self.BOT.get_conversation_id()
-            parent_message_id = self.BOT.get_parent_message_id()
-            if no_explain and not self.is_csv_format(res):
-                prompt_text = "Do not include any explanation in your reply, please redo the \n\t\t%s." % prompts_input
-                res = self._submit(prompt_text, conversation_id, parent_message_id)
-            new_s = i * 100 // num
-            if new_s > bar_index:
-                progress_bar.progress(bar_index)
-                bar_index = new_s
-            i += 1
-            new_row = pd.DataFrame([[prompts_input, res]], columns=[self.GPT_INPUT_COL, self.GPT_RESULT_COL])
-            processed_data = pd.concat([processed_data, new_row],
-                                       ignore_index=True)
-            processed_data.to_csv(cache_name, encoding='utf-8-sig', index=False)
-            # Create a new row for the prompts DataFrame with the current date, prompt number, and prompt text
+        :param prompts_df: the prompts DataFrame
+        :param prompt_id: the id of the prompt
+        :param prompt: the prompt text
+        :param conversation: the (conversation id, last message id, auth profile) of the conversation
+        """
+        # Create a new row for the prompts DataFrame with the current date, prompt number, and prompt text
         new_row = {"Date": datetime.now().strftime('%Y-%m-%d'),
                    "No": prompt_id,
                    "prompt": prompt,
-                   "conversation_id": conversation_id,
-                   "parent_message_id": parent_message_id
+                   "conversation_id": conversation[0],
+                   "parent_message_id": conversation[1],
+                   "profile": conversation[2]
                    }
         # Update the row with the new prompt text in the DataFrame
-        prompts_df.loc[prompts_df["No"] == prompt_id] = list(new_row.values())
+        prompts_df.loc[prompts_df["No"] == prompt_id, list(new_row.keys())] = list(new_row.values())
         # Save the updated prompts data to the CSV file
         prompts_df.to_csv(self.PROMPT_PATH, encoding='utf-8-sig', index=False)
-        progress_bar.empty()
+
+    @staticmethod
+    def approx_tokens(text):
+        """
+        Estimates the number of tokens of a text, with the usual rule of thumb of 4 characters per token.
+
+        :param text: the text
+        :return: the estimated number of tokens
+        """
+        return max(1, len(text) // 4) if len(text) > 0 else 0
+
+    def _single_shoot(self, engine, job, store, prompt, conversation):
+        """
+        Asks the prompt alone and shows the answer as it streams in, with the time to the first token
+        and the token rate. Clicking Cancel stops the stream, the session is kept open.
+
+        :param engine: the BatchEngine
+        :param job: the interactive Job
+        :param store: the ResultStore of the prompt
+        :param prompt: the prompt text
+        :param conversation: the (conversation id, parent message id, auth profile) of the prompt
+        :return: the conversation after the answer
+        """
+        # Any click reruns the script, which stops this stream and cancels the job at the next chunk
+        st.button("Cancel", key="cancel_single_shoot")
+        stats = st.empty()
+        answer_box = st.empty()
+        task = BatchTask(None, prompt, *conversation)
+        answer = ""
+        start_time = time.time()
+        first_token_time = None
+        with st.spinner("Waiting for the first token..."):
+            for chunk in engine.stream(task, job):
+                now = time.time()
+                if first_token_time is None:
+                    first_token_time = now
+                answer += chunk
+                answer_box.markdown(answer)
+                rate = self.approx_tokens(answer) / max(now - first_token_time, 1e-3)
+                stats.caption("Time to first token: %.2fs | %.1f tokens/s" % (first_token_time - start_time, rate))
+        if not self._check_task(task):
+            return conversation
+        if task.joined:
+            stats.caption("Answered together with %d identical questions asked at the same time" % task.coalesced)
+        if task.truncated:
+            reason = ("the %s timeout" % task.timeout.replace("_", " ")) if task.timeout is not None \
+                else "an early end of the stream"
+            st.warning("The answer was cut by %s, it may be incomplete." % reason)
+        # A single shoot answers no input row, its id keeps it out of the checkpoint of the batches
+        store.append([{self.ROW_ID_COL: NO_INPUT_ROW_ID, self.GPT_INPUT_COL: "", self.GPT_RESULT_COL: task.answer}])
+        store.compact()
+        return task.conversation_id, task.parent_message_id, task.profile
+
+    @staticmethod
+    def _show_saved_requests(saved, coalesced=0):
+        """
+        Reports how many requests the deduplication of the inputs saved.
+
+        :param saved: the number of requests saved
+        :param coalesced: the number of questions which shared the answer of an identical question in flight
+        """
+        if saved > 0:
+            st.info("%d requests were saved by reusing the answers of identical inputs." % saved)
+        if coalesced > 0:
+            st.info("%d questions shared the answer of an identical question asked at the same time." % coalesced)
+
+    @staticmethod
+    def _show_progress(progress_bar, status_box, telemetry):
+        """
+        Shows the progress of a job, with its rate and ETA, and writes its status file.
+
+        :param progress_bar: the st.progress of the job
+        :param status_box: the st.empty the status line goes to
+        :param telemetry: the BatchTelemetry of the job
+        """
+        progress_bar.progress(telemetry.fraction())
+        status_box.caption(telemetry.format())
+        telemetry.write()
+
+    @staticmethod
+    def _close_parse_stage(parse_stage):
+        """
+        Waits for the replies left to parse, and reports the ones which could not be parsed.
+
+        :param parse_stage: the ParseStage of the job, or None
+        """
+        if parse_stage is None:
+            return
+        with st.spinner("Parsing the replies..."):
+            parse_stage.drain()
+        parse_stage.close()
+        if parse_stage.failed > 0:
+            st.warning("%d replies could not be parsed, their parsed columns are left empty." % parse_stage.failed)
+
+    @staticmethod
+    def _show_truncated(truncated):
+        """
+        Reports how many answers were cut before the end of their stream.
+
+        :param truncated: the number of answers kept partial
+        """
+        if truncated > 0:
+            st.warning("%d answers were cut before the end of their stream and are kept partial, they are checked "
+                       "as false so the redo asks them again." % truncated)
+
+    def _show_export(self, result_no, columns):
+        """
+        Shows the export of a result. The file is only written when asked for, not on every rerun.
+
+        :param result_no: the number of the result
+        :param columns: the columns of the result
+        """
+        st.markdown("##### Export the result")
+        format_col, columns_col, prepare_col = st.columns(3)
+        fmt = format_col.selectbox("Format", ResultExporter.available_formats(), key="export_format")
+        selected_columns = columns_col.multiselect("Columns", list(columns),
+                                                   default=[column for column in columns if column != self.ROW_ID_COL],
+                                                   key="export_columns")
+        path = os.path.join(self.RESULT_FILE, "exports", "%s.%s" % (result_no, fmt))
+        if prepare_col.button("Prepare download"):
+            with st.spinner("Exporting..."):
+                ResultExporter(self._result_store(result_no)).export(path, fmt, selected_columns or None)
+            st.session_state["export_path"] = path
+        if st.session_state.get("export_path") == path and os.path.isfile(path):
+            with open(path, "rb") as f:
+                st.download_button(label="Download %s" % os.path.basename(path), data=f,
+                                   file_name=os.path.basename(path), mime=ResultExporter.FORMATS[fmt])
+
+    @staticmethod
+    def _show_limit_history(engine):
+        """
+        Shows how the adaptive concurrency limit of every account moved, to tune it.
+
+        :param engine: the BatchEngine
+        """
+        history = {profile: changes for profile, changes in engine.limit_history().items() if len(changes) > 0}
+        if len(history) == 0:
+            return
+        with st.expander("Adaptive concurrency"):
+            for profile, changes in history.items():
+                st.markdown("###### %s" % profile)
+                changes = pd.DataFrame(changes)
+                changes["time"] = pd.to_datetime(changes["time"], unit="s")
+                st.line_chart(changes.set_index("time")[["limit", "in_flight"]])
+                st.dataframe(changes.tail(20))
+
+    def _show_user_settings(self):
+        """
+        Shows the settings of the user in the sidebar.
+
+        :return: the name of the user, the priority of their jobs, the auth profiles to submit with,
+            the hourly cap per account and the profile to auth
+        """
+        if "whipper_user" not in st.session_state:
+            st.session_state["whipper_user"] = "user-%s" % uuid.uuid4().hex[:8]
+        user = st.sidebar.text_input("Your name", key="whipper_user")
+        priority = st.sidebar.selectbox("Priority of your jobs", list(self.PRIORITIES.keys()))
+        st.sidebar.markdown("##### Accounts")
+        available_profiles = ChatGPT.list_profiles()
+        profiles = st.sidebar.multiselect("Auth profiles to submit with", available_profiles,
+                                          default=available_profiles)
+        hourly_cap = st.sidebar.number_input("Questions per hour per account (0 for no limit)", min_value=0, value=0)
+        auth_profile = st.sidebar.text_input("Profile to auth", ChatGPT.default_profile,
+                                             help="Log in with the Auth button to create or refresh this profile")
+        return user, self.PRIORITIES[priority], profiles, hourly_cap or None, auth_profile
 
     def show_prompt_ui(self):
+        user, priority, profiles, hourly_cap, auth_profile = self._show_user_settings()
         prompts_df = self._load_prompts()
         selected_prompt_no = self._list_prompts(prompts_df)
         setting = prompts_df[prompts_df["No"] == selected_prompt_no]
@@ -548,12 +974,28 @@ class WhipperUI:
         mode = st.radio("", ('Single shoot', 'Fully Automatic(Batch job)'))
         uploaded_file = None
         no_explain = False
+        validator_spec = "csv"
+        parser_spec = ""
+        workers = 1
+        adaptive = False
         if mode == 'Fully Automatic(Batch job)':
             file_select, no_explain_check = st.columns([3, 1])
+            workers = no_explain_check.number_input("Parallel sessions per account", min_value=1, max_value=8,
+                                                    value=1)
+            adaptive = no_explain_check.checkbox("Adapt to the load", value=False,
+                                                 help="Use fewer sessions when ChatGPT slows down or fails, "
+                                                      "up to the parallel sessions")
             no_explain = no_explain_check.checkbox("No explanation in the reply", value=True,
                                                    key=None)
+            if no_explain:
+                validator_spec = no_explain_check.text_input("Reply validator", validator_spec,
+                                                             help="csv, csv:<columns>, regex:<pattern> or json:<schema>")
+            parser_spec = no_explain_check.text_input("Reply parser", parser_spec,
+                                                      help="Turns the replies into parsed_* columns: csv, csv:header, "
+                                                           "table, json or regex:<pattern with named groups>. "
+                                                           "Empty keeps the replies as they are")
             uploaded_file = file_select.file_uploader("Select a CSV file")
-        result_data = self._load_result(selected_prompt_no)
+        result_view = self._result_view(selected_prompt_no)
         data = self._load_saved_input_data(selected_prompt_no)
         prompt_name_title, select_column_title = st.columns(2)
         prompt_name_input, select_column = st.columns(2)
@@ -581,10 +1023,14 @@ class WhipperUI:
         st.markdown("##### Please write you prompt")
         prompt = st.text_area('',
                               prompt_default,
-                              height=200)
+                              height=200,
+                              help="Reference the input columns by name with {{column}}, "
+                                   "otherwise the selected column is appended to the prompt")
+        if data is not None:
+            template = PromptTemplate(prompt, data.columns, target_column)
+            st.caption("Input columns used: %s" % ", ".join(template.columns))
         auth_bth, add_btn, process_btn, = st.columns(3)
         set_btn, delete_btn_cache, delete_btn_prompt = st.columns(3)
-        download_btn, _ = st.columns(2)
         add_btn.button('Add',
                        on_click=self.on_add,
                        args=(prompt, prompt_name))
@@ -602,30 +1048,28 @@ class WhipperUI:
                                 args=(selected_prompt_no,))
         auth_bth.button('Auth',
                         on_click=self.on_auth,
-                        args=())
+                        args=(auth_profile,))
         st.markdown("[Go to chatGPT](https://chat.openai.com/chat)")
         if data is not None:
             st.markdown("### The input data ")
             self._create_table(data, pagesize=10)
         show_false_only = False
-        if len(result_data) > 0:
+        if len(result_view.data) > 0:
             st_title, show_false_only_cb = st.columns(2)
             st_title.markdown("### The processed result")
             show_false_only = show_false_only_cb.checkbox("Show only false data", value=False)
-            result_data = result_data[[self.GPT_INPUT_COL, self.GPT_RESULT_COL, self.CHECK_COL, self.COMMENT_COL]]
-            result_data.reset_index(inplace=True)
-            if show_false_only:
-                data_table = result_data[result_data[self.CHECK_COL]]
-            else:
-                data_table = result_data
-            data_review = self._create_table(data_table, self.CHECK_COL, self.COMMENT_COL)
-            result_data = self._update_reviewdata(result_data, data_review)
-            download_btn.download_button(
-                label="Download",
-                data=result_data.to_csv().encode('utf-8'),
-                file_name="%s.csv" % (selected_prompt_no),
-                mime='text/csv')
-            self.save_review_data(result_data, selected_prompt_no)
+            columns = list(result_view.data.columns)
+            review_columns = [column for column in [self.GPT_INPUT_COL, self.GPT_RESULT_COL, self.CHECK_COL,
+                                                    self.COMMENT_COL, self.ROW_ID_COL] if column in columns]
+            # The parsed columns are shown after the review columns
+            data_table = result_view.table(review_columns + [column for column in columns
+                                                             if column not in review_columns],
+                                           show_false_only)
+            data_review = self._create_table(data_table, self.CHECK_COL, self.COMMENT_COL,
+                                             hidden_cols=[self.ROW_ID_COL] if self.ROW_ID_COL in columns else ())
+            # Only the rows edited in the grid are written
+            result_view.apply(data_review)
+            self._show_export(selected_prompt_no, columns)
 
         process_btn.button('Submit',
                            on_click=self.on_do,
@@ -633,4 +1077,12 @@ class WhipperUI:
                                  data,
                                  target_column,
                                  no_explain,
-                                 show_false_only))
+                                 show_false_only,
+                                 validator_spec,
+                                 workers,
+                                 user,
+                                 priority,
+                                 profiles,
+                                 hourly_cap,
+                                 adaptive,
+                                 parser_spec))
@@ -31,10 +31,18 @@ Description: This module defines a UIControl class for Streamlit, which provides
 Disclaimer: This software is provided "as is" and without any express or implied warranties, including, without limitation, the implied warranties of merchantability and fitness for a particular purpose. The author and contributors of this module shall not be liable for any direct, indirect, incidental, special, exemplary, or consequential damages (including, but not limited to, procurement of substitute goods or services; loss of use, data, or profits; or business interruption) however caused and on any theory of liability, whether in contract, strict liability, or tort (including negligence or otherwise) arising in any way out of the use of this software, even if advised of the possibility of such damage.
 """
 
+import argparse
+
 from pub.whipper_ui import WhipperUI
 
 if __name__ == "__main__":
-    whipper_ui = WhipperUI()
+    # The arguments after "--" of streamlit run, see run_chatgpt ui
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--record", default=None)
+    parser.add_argument("--replay", default=None)
+    parser.add_argument("--speed", type=float, default=1.0)
+    args, _ = parser.parse_known_args()
+    whipper_ui = WhipperUI(args.record, args.replay, args.speed)
     #set_up_page() has to be putted at the first line.
     whipper_ui.show_prompt_ui()
 
@@ -0,0 +1,129 @@
+"""
+The workers of the batch engine, with sessions which answer at once.
+"""
+import threading
+
+import pytest
+
+pytest.importorskip("playwright.sync_api")
+
+from chatgpt_batch_whipper.pub.batch_engine import BatchEngine, BatchTask
+
+
+class _Session:
+    closed = []
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    def ask(self, message, conversation_id="", parent_message_id=""):
+        return "Answer to: %s" % message
+
+    def reset(self):
+        pass
+
+    def get_conversation_id(self):
+        return None
+
+    def get_parent_message_id(self):
+        return None
+
+    def close(self):
+        self.closed.append(self.profile)
+
+
+def test_close_stops_the_workers_and_closes_their_sessions():
+    engine = BatchEngine(session_factory=_Session, waiting_time=0)
+    engine.IDLE_TIME = 0.1
+    engine.ensure_workers(2, profiles=("a",))
+    threads = [worker for worker, _ in engine._workers]
+    answers = [task.answer for task in engine.run([BatchTask(key, "q%d" % key) for key in range(10)])]
+    assert sorted(answers) == sorted("Answer to: q%d" % key for key in range(10))
+    engine.close(timeout=5)
+    assert not any(thread.is_alive() for thread in threads)
+    assert set(_Session.closed) == {"a"}
+    assert engine.workers == 0
+
+
+class _LoggedOutSession(_Session):
+    last_failed = True
+    last_error = "The ChatGPT session of the profile a is not usable, log in again"
+    resets = 0
+
+    def ask(self, message, conversation_id="", parent_message_id=""):
+        return "Your ChatGPT session is not usable."
+
+    def reset(self):
+        _LoggedOutSession.resets += 1
+
+
+class _FailingSession(_Session):
+    last_failed = True
+    last_error = None
+
+    def ask(self, message, conversation_id="", parent_message_id=""):
+        return "Failed to read response from ChatGPT."
+
+
+def _run_one(session_factory):
+    engine = BatchEngine(session_factory=session_factory, waiting_time=0, failed_retries=2)
+    engine.IDLE_TIME = 0.1
+    engine.ensure_workers(1, profiles=("a",))
+    try:
+        return next(iter(engine.run([BatchTask(0, "q")])))
+    finally:
+        engine.close(timeout=5)
+
+
+def test_unusable_session_fails_the_task_at_once():
+    task = _run_one(_LoggedOutSession)
+    assert "not usable" in str(task.error)
+    assert task.retries == 0
+    assert _LoggedOutSession.resets == 0
+
+
+def test_failures_are_retried_a_bounded_number_of_times():
+    task = _run_one(_FailingSession)
+    assert task.error is not None
+    assert task.retries == 2
+
+
+def test_settings_of_an_account_are_kept_for_the_running_jobs():
+    engine = BatchEngine(session_factory=_Session, waiting_time=0)
+    engine.IDLE_TIME = 0.1
+    try:
+        engine.ensure_workers(1, profiles=("a",), hourly_cap=10, adaptive=True)
+        limiter = engine.limiters["a"]
+        engine.ensure_workers(2, profiles=("a", "b"), hourly_cap=None, adaptive=False)
+        assert engine.accounts["a"].hourly_cap == 10
+        assert engine.limiters["a"] is limiter and limiter.max_limit == 2
+        assert engine.accounts["b"].hourly_cap is None and "b" not in engine.limiters
+    finally:
+        engine.close(timeout=5)
+
+
+class _StreamingSession(_Session):
+    go_on = threading.Event()
+
+    def ask_stream(self, message, conversation_id="", parent_message_id=""):
+        yield "Answer "
+        self.go_on.wait(5)
+        yield "to: "
+        yield message
+
+
+def test_follower_of_a_cancelled_stream_gets_the_answer_once():
+    engine = BatchEngine(session_factory=_StreamingSession, waiting_time=0)
+    engine.IDLE_TIME = 0.1
+    engine.ensure_workers(2, profiles=("a", "b"))
+    try:
+        leader = engine.stream(BatchTask(0, "q"))
+        assert next(leader) == "Answer "
+        follower = engine.stream(BatchTask(1, "q"))
+        assert next(follower) == "Answer "
+        leader.close()
+        _StreamingSession.go_on.set()
+        assert "Answer " + "".join(follower) == "Answer to: q"
+        assert engine.flights.hits == 1
+    finally:
+        engine.close(timeout=5)
@@ -0,0 +1,36 @@
+"""
+The adaptive limit on the questions in flight.
+"""
+import random
+
+from chatgpt_batch_whipper.pub.concurrency import AdaptiveLimiter
+
+
+def _run_windows(limiter, windows, latency):
+    # Every window starts with all the slots taken, so a healthy window raises the limit
+    for _ in range(windows):
+        taken = 0
+        while limiter.acquire(timeout=0):
+            taken += 1
+        for _ in range(limiter.WINDOW):
+            limiter.record(latency())
+        for _ in range(taken):
+            limiter.release()
+
+
+def test_steady_latency_spread_keeps_the_limit_up():
+    rng = random.Random(7)
+    limiter = AdaptiveLimiter(8, initial=4)
+    # A p95 about 2.3 times the median, the usual spread of the answer times
+    _run_windows(limiter, 40, lambda: rng.lognormvariate(0, 0.5))
+    assert [entry["reason"] for entry in limiter.history].count("latency") == 0
+    assert int(limiter.limit) == 8
+
+
+def test_slowdown_cuts_the_limit():
+    rng = random.Random(7)
+    limiter = AdaptiveLimiter(8, initial=4)
+    _run_windows(limiter, 10, lambda: rng.lognormvariate(0, 0.5))
+    _run_windows(limiter, 3, lambda: 3 * rng.lognormvariate(0, 0.5))
+    assert limiter.history[-1]["reason"] == "latency"
+    assert int(limiter.limit) < 8
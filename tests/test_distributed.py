@@ -0,0 +1,48 @@
+"""
+The coordinator of a batch job over several machines.
+"""
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("playwright.sync_api")
+
+from chatgpt_batch_whipper.pub.distributed import Coordinator
+from chatgpt_batch_whipper.pub.result_store import ResultStore
+
+
+@pytest.fixture
+def coordinator(tmp_path):
+    store = ResultStore(str(tmp_path), "1", ["result", "input", "Is false", "row_id"])
+    data = pd.DataFrame({"title": ["a", "b", "c"]})
+    coordinator = Coordinator(store, "Translate", data, "title", port=0)
+    yield coordinator
+    coordinator._server.server_close()
+
+
+def test_bad_report_keeps_the_rows(coordinator):
+    lease = coordinator.lease("w")
+    rows = lease["rows"]
+    with pytest.raises(ValueError):
+        coordinator.report(lease["lease_id"], [{"row_id": rows[0]["row_id"], "answer": "A"},
+                                               {"row_id": rows[1]["row_id"]}])
+    assert len(coordinator.prompts) == 3
+    coordinator.report(lease["lease_id"], [{"row_id": row["row_id"], "answer": "A"} for row in rows])
+    assert coordinator.finished.is_set()
+
+
+def test_bad_body_is_a_400(coordinator):
+    threading.Thread(target=coordinator._server.serve_forever, daemon=True).start()
+    try:
+        request = urllib.request.Request(coordinator.url + "/lease", data=b"not json",
+                                         headers={"Content-Type": "application/json"})
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request, timeout=5)
+        assert error.value.code == 400
+        assert "error" in json.loads(error.value.read())
+    finally:
+        coordinator._server.shutdown()
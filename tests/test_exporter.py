@@ -0,0 +1,42 @@
+"""
+The export of a result, chunk by chunk.
+"""
+import json
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+
+from chatgpt_batch_whipper.pub.exporter import ResultExporter
+
+
+class _Store:
+    # Only the part of a ResultStore the exporter reads
+    def __init__(self, data):
+        self.data = data
+
+    def iter_chunks(self, chunk_size=10000, columns=None):
+        data = self.data if columns is None else self.data[columns]
+        for start in range(0, len(data), chunk_size):
+            yield data.iloc[start:start + chunk_size]
+
+
+def test_jsonl_has_no_empty_lines(tmp_path):
+    data = pd.DataFrame({"input": ["a", "b", "c", "d", "e"], "result": ["1", "2", "3", "4", "5"]})
+    path = ResultExporter(_Store(data), chunk_size=2).export(str(tmp_path / "result.jsonl"), "jsonl")
+    with open(path, encoding="utf-8") as f:
+        lines = f.read().split("\n")
+    assert lines[-1] == ""
+    lines = lines[:-1]
+    assert all(len(line) > 0 for line in lines)
+    assert [json.loads(line)["input"] for line in lines] == ["a", "b", "c", "d", "e"]
+
+
+def test_missing_engine_fails_before_writing(tmp_path, monkeypatch):
+    monkeypatch.setattr("chatgpt_batch_whipper.pub.exporter.pyarrow", None)
+    with pytest.raises(ValueError, match="pip install pyarrow"):
+        ResultExporter.check_format("parquet")
+    data = pd.DataFrame({"input": ["a"], "result": ["1"]})
+    with pytest.raises(ValueError):
+        ResultExporter(_Store(data)).export(str(tmp_path / "exports" / "result.parquet"), "parquet")
+    assert not (tmp_path / "exports").exists()
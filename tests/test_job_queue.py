@@ -0,0 +1,22 @@
+"""
+The fair queue of the batch engine.
+"""
+from chatgpt_batch_whipper.pub.job_queue import Job, JobQueue
+
+
+def test_release_forgets_the_flow_of_a_finished_job():
+    tasks = JobQueue()
+    for lease in range(100):
+        job = Job("worker", "lease-%d" % lease)
+        tasks.put(job, lease)
+        assert tasks.get(timeout=0) == (job, lease)
+        tasks.release(job)
+    assert tasks._flows == {}
+
+
+def test_release_keeps_a_flow_with_queued_tasks():
+    tasks = JobQueue()
+    job = Job("user", "prompt")
+    tasks.put(job, 1)
+    tasks.release(job)
+    assert len(tasks) == 1
@@ -0,0 +1,44 @@
+"""
+The specs of the reply parsers.
+"""
+import pytest
+
+from chatgpt_batch_whipper.pub.parsers import AnswerParser, ParseStage, build_parser
+
+
+def test_invalid_regex_is_a_value_error():
+    with pytest.raises(ValueError, match="Invalid regex"):
+        build_parser("regex:(?P<name>")
+
+
+def test_regex_parser_reads_named_groups():
+    parser = build_parser(r"regex:(?P<name>\w+) - (?P<price>\d+)")
+    assert parser.parse("cheese - 12") == {"name": "cheese", "price": "12"}
+
+
+class _BrokenParser(AnswerParser):
+    def parse(self, answer):
+        if answer == "boom":
+            raise RuntimeError("the parser broke")
+        return {"value": answer}
+
+
+class _Store:
+    def __init__(self):
+        self.changes = []
+
+    def update(self, changes):
+        self.changes.extend(changes)
+
+
+def test_parser_errors_are_parse_failures():
+    store = _Store()
+    stage = ParseStage(_BrokenParser(), store, workers=1, batch_size=2)
+    try:
+        for row_index, answer in enumerate(["a", "boom", "c"]):
+            stage.submit([row_index], answer)
+        stage.drain()
+    finally:
+        stage.close()
+    assert stage.failed == 1
+    assert sorted(store.changes) == [(0, {"parsed_value": "a"}), (2, {"parsed_value": "c"})]
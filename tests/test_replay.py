@@ -0,0 +1,34 @@
+"""
+The replay of a recorded question.
+"""
+import pytest
+
+pytest.importorskip("playwright.sync_api")
+
+from chatgpt_batch_whipper.pub.accounts import Account
+from chatgpt_batch_whipper.pub.replay import ReplaySession
+
+
+class _Archive:
+    # Hands out the records of one prompt in the order they were recorded, like a ReplayArchive
+    path = "test"
+
+    def __init__(self, records):
+        self.records = list(records)
+
+    def take(self, prompt):
+        return self.records.pop(0) if len(self.records) > 0 else None
+
+
+def _record(status, events, failed=False):
+    return {"events": events, "duration": 0.0, "status": status, "failed": failed, "truncated": False,
+            "timeout": None, "answer_conversation_id": None, "answer_parent_message_id": None}
+
+
+def test_recorded_cap_is_replayed_as_a_failure():
+    session = ReplaySession(_Archive([_record(Account.CAP_STATUS, [], failed=True),
+                                      _record(200, [[0.0, "Bonjour"]])]), speed=0)
+    assert session.ask("Hello") is None
+    assert session.last_status != Account.CAP_STATUS
+    assert session.last_failed
+    assert session.ask("Hello") == "Bonjour"
@@ -0,0 +1,61 @@
+"""
+The result CSV and its journal, read back a chunk at a time.
+"""
+import os
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+
+from chatgpt_batch_whipper.pub.result_store import ResultStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ResultStore(str(tmp_path), "1", ["input", "result"])
+    store.save(pd.DataFrame({"input": ["a", "b", "c"], "result": ["r1", "r2", "r3"], "Comment": [None, None, None]}))
+    # A new store, as a new job opens the result
+    store = ResultStore(str(tmp_path), "1", ["input", "result"])
+    store.append([{"input": "d", "result": "r4"}, {"input": "e", "result": "r5"}])
+    store.update([(1, {"result": "r2 bis", "Comment": "redone"}), (3, {"result": "r4 bis"})])
+    store.update([(1, {"result": "r2 ter"})])
+    return store
+
+
+def test_chunks_apply_the_journal(store):
+    chunks = list(store.iter_chunks(2))
+    assert [len(chunk) for chunk in chunks] == [2, 1, 2]
+    data = pd.concat(chunks)
+    assert list(data.index) == [0, 1, 2, 3, 4]
+    assert list(data["result"]) == ["r1", "r2 ter", "r3", "r4 bis", "r5"]
+    assert data.at[1, "Comment"] == "redone"
+    assert list(data.columns) == ["input", "result", "Comment"]
+    loaded = store.load()
+    assert list(loaded["result"]) == list(data["result"])
+
+
+def test_chunks_of_some_columns(store):
+    data = pd.concat(store.iter_chunks(2, ["result", "row_id"]))
+    assert list(data.columns) == ["result", "row_id"]
+    assert list(data["result"]) == ["r1", "r2 ter", "r3", "r4 bis", "r5"]
+    assert data["row_id"].isna().all()
+
+
+def test_length_and_compact(store):
+    assert len(ResultStore(os.path.dirname(store.csv_path), "1", [])) == 5
+    assert store.append([{"input": "f", "result": "r6"}]) == 5
+    store.compact()
+    reopened = ResultStore(os.path.dirname(store.csv_path), "1", [])
+    assert len(reopened) == 6
+    assert list(reopened.load()["result"]) == ["r1", "r2 ter", "r3", "r4 bis", "r5", "r6"]
+
+
+def test_append_while_iterating(store):
+    # A job appends the answers it reuses while it reads the result
+    for chunk in store.iter_chunks(2, ["input", "result"]):
+        for value in chunk["result"]:
+            if value in ("r4 bis", "r5"):
+                store.append([{"input": "again", "result": "copy of " + value}])
+    assert len(store) == 7
+    assert store.append([{"input": "g", "result": "r7"}]) == 7
+    assert list(store.load()["result"])[7] == "r7"
@@ -0,0 +1,39 @@
+"""
+The end of an answer stream, against the local MockBackend. Needs playwright and its firefox.
+"""
+import pytest
+
+pytest.importorskip("playwright.sync_api")
+
+from chatgpt_batch_whipper.pub.chatgpt_wrapper import ChatGPT
+from chatgpt_batch_whipper.pub.mock_backend import MockBackend
+
+
+def _ask(backend, prompt):
+    bot = ChatGPT(shared=False, profile="test-stream", base_url=backend.url)
+    try:
+        return bot.ask(prompt)
+    finally:
+        bot._cleanup()
+
+
+def test_complete_stream_is_not_truncated():
+    backend = MockBackend().start()
+    try:
+        answer = _ask(backend, "one two three four five six")
+    finally:
+        backend.stop()
+    assert answer == "Answer to: one two three four five six"
+    assert not answer.truncated
+
+
+def test_cut_stream_is_truncated():
+    backend = MockBackend(failure_rate=1.0, failure_kinds=("cut",)).start()
+    try:
+        answer = _ask(backend, "one two three four five six")
+    finally:
+        backend.stop()
+    assert answer is not None
+    assert "Answer to: one two three four five six".startswith(answer)
+    assert answer.truncated
+    assert answer.timeout is None
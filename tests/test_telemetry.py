@@ -0,0 +1,35 @@
+"""
+The counts of the progress of a batch job.
+"""
+from chatgpt_batch_whipper.pub.job_queue import Job
+from chatgpt_batch_whipper.pub.telemetry import BatchTelemetry, format_status
+
+
+class _Task:
+    def __init__(self, key):
+        self.key = key
+
+
+def test_only_the_tasks_taken_by_a_worker_are_in_flight():
+    job = Job()
+    sizes = {0: 2, 1: 3, 2: 1}
+    telemetry = BatchTelemetry(6, job=job, rows=sizes.get)
+    telemetry.submitted(6)
+    assert telemetry.current_counts()["queued"] == 6 and telemetry.current_counts()["in_flight"] == 0
+    taken = _Task(1)
+    job.running.add(taken)
+    counts = telemetry.current_counts()
+    assert (counts["pending"], counts["queued"], counts["in_flight"]) == (0, 3, 3)
+    assert "queued 3 | in flight 3" in telemetry.format()
+    job.running.discard(taken)
+    telemetry.answered(3)
+    counts = telemetry.current_counts()
+    assert (counts["queued"], counts["in_flight"], counts["done"]) == (3, 0, 3)
+    assert telemetry.fraction() == 0.5
+
+
+def test_status_written_without_queued_rows_is_formatted():
+    status = BatchTelemetry(4).snapshot()
+    del status["counts"]["queued"]
+    status["counts"].update(pending=1, in_flight=2)
+    assert format_status(status).startswith("1/4 rows")
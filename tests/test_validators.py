@@ -0,0 +1,53 @@
+"""
+The reply validators and the prompts which redo the replies failing them.
+"""
+import pytest
+
+from chatgpt_batch_whipper.pub.validators import (CsvColumnValidator, JsonSchemaValidator, OutputValidator,
+                                                   ValidationStage, build_validator)
+
+
+def test_invalid_regex_is_a_value_error():
+    with pytest.raises(ValueError, match="Invalid regex"):
+        build_validator("regex:(")
+
+
+def test_repair_prompt_keeps_the_prompt():
+    prompt = "Translate to French: cheese"
+    assert OutputValidator().repair_prompt(prompt).startswith(prompt + "\n")
+    assert JsonSchemaValidator().repair_prompt(prompt).startswith(prompt + "\n")
+
+
+def test_validation_stage_keeps_only_the_failed_replies():
+    stage = ValidationStage(CsvColumnValidator(2))
+    try:
+        for key in range(100):
+            stage.check(key, "input %d" % key, "a,b" if key % 10 else "a")
+        for _, _, future in list(stage._pending):
+            future.result()
+        stage.collect()
+        assert stage._pending == []
+        assert stage.drain() == [(key, "input %d" % key) for key in range(0, 100, 10)]
+        assert stage.drain() == []
+    finally:
+        stage.close()
+
+
+def test_invalid_json_schema_is_a_value_error():
+    with pytest.raises(ValueError, match="Invalid JSON schema"):
+        build_validator("json:{not json}")
+    with pytest.raises(ValueError, match="Invalid JSON schema"):
+        build_validator("json:[1, 2]")
+
+
+def test_invalid_json_schema_keyword_is_a_value_error():
+    pytest.importorskip("jsonschema")
+    with pytest.raises(ValueError, match="Invalid JSON schema"):
+        build_validator('json:{"type": "no such type"}')
+
+
+def test_json_integer_type():
+    validator = build_validator('json:{"type": "integer"}')
+    assert validator.validate("42")
+    assert not validator.validate('"42"')
+    assert not validator.validate("true")